@@ -0,0 +1,164 @@
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict
+
+# Admission control: per-route concurrency limits and a per-user rate limit.
+#
+# Routes fall into classes (ROUTE_CLASSES), and <CLASS>_MAX_CONCURRENCY caps how
+# many requests of a class a server process runs at once (0: no cap). A request
+# that finds its class full waits up to ADMISSION_QUEUE_TIMEOUT_MS for a slot,
+# behind at most ADMISSION_MAX_WAITING others, and is otherwise turned away with
+# 503 and Retry-After. Capping the expensive feed and search classes keeps them
+# from taking every worker thread and Mongo connection, so likes and other cheap
+# writes keep their latency when the feed is saturated.
+#
+# With RATE_LIMIT_PER_S set, every user also gets a token bucket of
+# RATE_LIMIT_BURST requests, refilled at RATE_LIMIT_PER_S; a request without a
+# token gets 429 and the seconds until the next one in Retry-After. The user is
+# the client address. Clients choose their X-User-Id, so it names the user only
+# with RATE_LIMIT_TRUST_USER_HEADER=on, behind a proxy that sets it.
+#
+# Limits and buckets are per process. RouteLimit serves app.py's threads,
+# AsyncRouteLimit the event loop of asgi_app.py.
+
+# View function -> route class; routes not listed (/metrics, /cleanup) are never limited
+ROUTE_CLASSES = {
+    "get_feed": "feed",
+    "search_posts": "search",
+    "get_post_likes": "reads",
+    "get_posts_comments": "reads",
+    "get_follow_list": "reads",
+    "get_users": "reads",
+    "get_posts": "reads",
+    "create_user": "writes",
+    "update_user": "writes",
+    "create_post": "writes",
+    "add_comment": "writes",
+    "add_like": "writes",
+    "remove_like": "writes",
+    "follow_user": "writes",
+    "unfollow_user": "writes",
+    "bulk_create_users": "bulk",
+    "bulk_create_posts": "bulk",
+    "bulk_follow_users": "bulk",
+    "bulk_add_likes": "bulk",
+}
+CLASSES = ("feed", "search", "reads", "writes", "bulk")
+
+# Users whose buckets are kept; the least recently seen are forgotten first
+MAX_TRACKED_USERS = 100000
+
+
+# Class of a request's endpoint, which may carry a blueprint prefix ("api.get_feed")
+def route_class(endpoint):
+    if not endpoint:
+        return None
+    return ROUTE_CLASSES.get(endpoint.rsplit(".", 1)[-1])
+
+
+def class_limits(config):
+    limits = {}
+    for name in CLASSES:
+        limit = config[f"{name.upper()}_MAX_CONCURRENCY"]
+        if limit:
+            limits[name] = limit
+    return limits
+
+
+class RouteLimit:
+    def __init__(self, limit, max_waiting):
+        self.slots = threading.BoundedSemaphore(limit)
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    # Take a slot within `timeout` seconds; False if the queue is full or the time runs out
+    def acquire(self, timeout):
+        if self.slots.acquire(blocking=False):
+            return True
+        with self.lock:
+            if self.waiting >= self.max_waiting:
+                return False
+            self.waiting += 1
+        try:
+            return self.slots.acquire(timeout=timeout)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    def release(self):
+        self.slots.release()
+
+
+class AsyncRouteLimit:
+    def __init__(self, limit, max_waiting):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        self.slots = None
+
+    # Called once the event loop is running
+    def start(self):
+        self.slots = asyncio.Semaphore(self.limit)
+
+    async def acquire(self, timeout):
+        if not self.slots.locked():
+            await self.slots.acquire()
+            return True
+        if self.waiting >= self.max_waiting:
+            return False
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        self.slots.release()
+
+
+def route_limits(config, limit_class):
+    return {
+        name: limit_class(limit, config["ADMISSION_MAX_WAITING"])
+        for name, limit in class_limits(config).items()
+    }
+
+
+class TokenBuckets:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        # user -> (tokens, monotonic time of the last update), least recently seen first
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Take a token for `user`; returns 0, or the seconds until a token is available
+    def take(self, user, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(user, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            if not wait:
+                tokens -= 1
+            self.buckets[user] = (tokens, now)
+            if len(self.buckets) > MAX_TRACKED_USERS:
+                self.buckets.popitem(last=False)
+            return wait
+
+
+def token_buckets(config):
+    if not config["RATE_LIMIT_PER_S"]:
+        return None
+    return TokenBuckets(config["RATE_LIMIT_PER_S"], config["RATE_LIMIT_BURST"])
+
+
+# Retry-After for a rate-limited request: whole seconds, at least 1
+def retry_after(wait):
+    return str(max(1, math.ceil(wait)))
@@ -1,295 +1,784 @@
-from flask import Flask, jsonify, request
+from flask import Blueprint, Flask, Response, current_app, g, jsonify, request, stream_with_context
 from flask_pymongo import PyMongo
 from bson.objectid import ObjectId
-from bson.errors import InvalidId
-from datetime import datetime
-
-app = Flask(__name__)
+from datetime import datetime, timedelta
+from itertools import islice
+import click
+from werkzeug.local import LocalProxy
+import sys
+import threading
+
+import admission
+import archive
+import bulk
+import comments
+import feed
+import follows
+import indexes
+import json_provider
+import likers
+import metrics
+import mongo_options
+import multi_get
+import profile_cache
+import search
+import timeline
+import versions
+import write_behind
+from config import load_config
+from pagination import encode_bucket_cursor, split_page
+from validation import (
+    validate_object_id, validate_test_database, validate_date_format, build_ids, build_user, build_user_update, build_post, build_comment,
+    validate_liker, validate_followee, build_follow, build_like,
+    build_follow_list_query, build_comments_query, build_feed_query, build_search
+)
+
+api = Blueprint("api", __name__, cli_group=None)
+
+# The handles routes work with: a database, its write-behind queue (None unless WRITE_BEHIND is on)
+# and the cache of its user names
+class Mongo:
+    def __init__(self, cx, db, config):
+        self.cx = cx
+        self.db = db
+        self.write_queue = write_behind.WriteBehind(db, config) if config["WRITE_BEHIND"] == "on" else None
+        self.profiles = profile_cache.profile_cache(config)
+
+# The request's handles: the app's own, or in test-database mode those of the database the request named
+def current_mongo():
+    return g.get("mongo") or current_app.extensions["mongo"]
+
+mongo = LocalProxy(current_mongo)
+write_queue = LocalProxy(lambda: current_mongo().write_queue)
+
+# Create the app. `overrides` replaces settings read from the environment, e.g.
+# create_app({"MONGO_DBNAME": "test_worker1"}) gives a test worker a database of its own.
+def create_app(overrides=None):
+    app = Flask(__name__)
+    app.config.update(load_config())
+    app.config.update(overrides or {})
+    client = PyMongo(app, event_listeners=[metrics.command_listener], **mongo_options.client_options(app.config))
+    # PyMongo installs its own JSON provider, so ours has to come after it
+    app.json = json_provider.create_provider(app, app.config["JSON_PROVIDER"])
+    db = client.cx[app.config["MONGO_DBNAME"]] if app.config["MONGO_DBNAME"] else client.db
+    app.extensions["mongo"] = Mongo(client.cx, db, app.config)
+    metrics.init_app(app)
+    app.extensions["route_limits"] = admission.route_limits(app.config, admission.RouteLimit)
+    app.extensions["rate_limits"] = admission.token_buckets(app.config)
+    app.before_request(admit_request)
+    app.teardown_request(release_request)
+    app.before_request(select_date_format)
+    if app.config["TEST_DATABASES"] == "on":
+        app.extensions["test_databases"] = {}
+        app.before_request(select_test_database)
+    app.register_blueprint(api)
+    return app
+
+# Helper function to identify who a request counts against for rate limiting: the client address,
+# or the X-User-Id header when a trusted proxy sets it (RATE_LIMIT_TRUST_USER_HEADER=on)
+def request_user():
+    if current_app.config["RATE_LIMIT_TRUST_USER_HEADER"] == "on" and "X-User-Id" in request.headers:
+        return request.headers["X-User-Id"]
+    return request.remote_addr
+
+# Helper function to turn a request away before it runs
+def reject(reason, message, status, retry_after):
+    metrics.REQUESTS_REJECTED.inc(request.method, metrics.route_of(request), reason)
+    response = jsonify({"error": message})
+    response.headers["Retry-After"] = retry_after
+    return response, status
+
+# Admission control (admission.py): take a token from the user's bucket, then a slot of the route's class
+def admit_request():
+    name = admission.route_class(request.endpoint)
+    if not name:
+        return None
+    buckets = current_app.extensions["rate_limits"]
+    if buckets:
+        wait = buckets.take(request_user())
+        if wait:
+            return reject("rate_limit", "Too many requests, retry later", 429, admission.retry_after(wait))
+    limit = current_app.extensions["route_limits"].get(name)
+    if limit:
+        if not limit.acquire(current_app.config["ADMISSION_QUEUE_TIMEOUT_MS"] / 1000):
+            return reject("overload", "Server busy, retry later", 503, "1")
+        g.route_limit = limit
+    return None
+
+# Free the request's slot; teardown runs after a streamed body is sent, and after errors
+def release_request(exception):
+    limit = g.pop("route_limit", None)
+    if limit:
+        limit.release()
+
+# Helper function to set how the request's dates are rendered (json_provider.date_format). Every
+# request sets it, so a worker thread never carries over the format of its previous request.
+def select_date_format():
+    date_format, error = validate_date_format(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    json_provider.date_format.set(date_format)
+    return None
 
-app.config["MONGO_URI"] = "mongodb://mongodb:27017/mydatabase"
-mongo = PyMongo(app)
+test_databases_lock = threading.Lock()
 
-# Helper function to validate ObjectId
-def validate_object_id(id_str):
-    try:
-        return ObjectId(id_str)
-    except InvalidId:
+# Test-database mode: switch the request to the test_* database named in X-Test-Database, if any,
+# so every test can work in a database of its own on one server or in-process app
+def select_test_database():
+    if "X-Test-Database" not in request.headers:
         return None
-
-# Helper function to fetch user by ID
-def get_user(user_id):
-    user = mongo.db.users.find_one({"_id": user_id})
-    if not user:
-        return None, {"error": "User not found"}, 404
-    return user, None, 200
+    name = validate_test_database(request.headers["X-Test-Database"])
+    if not name:
+        return jsonify({"error": "Invalid test database"}), 400
+    databases = current_app.extensions["test_databases"]
+    with test_databases_lock:
+        if name not in databases:
+            default = current_app.extensions["mongo"]
+            databases[name] = Mongo(default.cx, default.cx[name], current_app.config)
+            indexes.ensure_indexes(databases[name].db)
+        g.mongo = databases[name]
+    return None
+
+# Drop the request's test database, closing its write-behind queue first
+def drop_test_database():
+    name = g.mongo.db.name
+    with test_databases_lock:
+        handles = current_app.extensions["test_databases"].pop(name, None)
+    if handles and handles.write_queue:
+        handles.write_queue.close()
+    g.mongo.cx.drop_database(name)
+
+def timeline_mode():
+    return current_app.config["FEED_MODE"] == "timeline"
+
+# Helper function to check whether a user exists without loading it
+def user_exists(user_id):
+    return mongo.db.users.count_documents({"_id": user_id}, limit=1) > 0
+
+# Helper function to check whether a post exists without loading it
+def post_exists(post_id):
+    return mongo.db.posts.count_documents({"_id": post_id}, limit=1) > 0
+
+# Helper function to answer a write to a post that is not in `posts`; archived posts are read-only
+def missing_post(post_id):
+    if archive.archived_ids(mongo.db, [post_id]):
+        return jsonify({"error": "Post is archived"}), 409
+    return jsonify({"error": "Post not found"}), 404
+
+# Helper function to get the database handle for a read route ("feed", "likes" or "comments"),
+# which carries the route's read preference
+def read_db(route):
+    return mongo_options.route_database(mongo.db, current_app.config, route)
+
+# Helper function to fetch many users' names, keyed by _id: from the profile cache,
+# and the rest with a single query
+def get_users_by_id(user_ids, db=None):
+    if db is None:
+        db = mongo.db
+    users, missing = mongo.profiles.get_many(user_ids)
+    metrics.PROFILE_CACHE_LOOKUPS.inc("hit", amount=len(users))
+    if missing:
+        metrics.PROFILE_CACHE_LOOKUPS.inc("miss", amount=len(missing))
+        generation = mongo.profiles.generation
+        found = list(db.users.find(
+            {"_id": {"$in": missing}},
+            {"firstName": 1, "lastName": 1}
+        ))
+        mongo.profiles.put_many(found, generation)
+        users.update((user["_id"], user) for user in found)
+    return users
+
+# Helper function to check whether the client asked for a streamed NDJSON response
+def wants_ndjson():
+    best = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+    return best == "application/x-ndjson"
+
+# Helper function to answer a conditional GET: a 304 response if the client's copy matches `etag`
+def not_modified(etag):
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+# Helper function to answer a write that was not queued because the write-behind queue is full
+def queue_full():
+    response = jsonify({"error": "Too many pending writes, retry later"})
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+# Helper function for read-your-writes in write-behind mode: apply the reader's queued writes first.
+# The reader is the X-User-Id header, or `default_user_id` for routes that name the reader.
+def flush_reader_writes(default_user_id=None):
+    if not write_queue:
+        return
+    user_id = default_user_id
+    if "X-User-Id" in request.headers:
+        user_id = validate_object_id(request.headers["X-User-Id"])
+    if user_id:
+        write_queue.flush_user(user_id)
+
+# Helper function to stream records from a generator, one JSON document per line
+def ndjson_response(records):
+    def generate():
+        for record in records:
+            yield current_app.json.dumps(record) + "\n"
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
 # Create a user profile
-@app.route('/users', methods=['POST'])
+@api.route('/users', methods=['POST'])
 def create_user():
-    data = request.json
-    if not all(key in data for key in ('firstName', 'lastName', 'birthDate', 'bio')):
-        return jsonify({"error": "Missing fields"}), 400
-
-    user = {
-        "firstName": data['firstName'],
-        "lastName": data['lastName'],
-        "birthDate": data['birthDate'],
-        "bio": data['bio'],
-        "following": []
-    }
+    user, error = build_user(request.json)
+    if error:
+        return jsonify({"error": error}), 400
+
     result = mongo.db.users.insert_one(user)
     return jsonify({"message": "User created", "userId": str(result.inserted_id)}), 201
 
+# Get several users' profiles with one query: GET /users?ids=<id>,<id>,...
+@api.route('/users', methods=['GET'])
+def get_users():
+    user_ids, error = build_ids(request.args, current_app.config["MULTI_GET_MAX_IDS"])
+    if error:
+        return jsonify({"error": error}), 400
+
+    users = mongo.db.users.find({"_id": {"$in": user_ids}}, multi_get.USER_FIELDS)
+    return jsonify(multi_get.in_order(user_ids, users, multi_get.user_record)), 200
+
+# Update a user profile; a new name reaches every server's cache and the ETags that show it
+@api.route('/users/<user_id>', methods=['PATCH'])
+def update_user(user_id):
+    user_id = validate_object_id(user_id)
+    if not user_id:
+        return jsonify({"error": "Invalid userId"}), 400
+
+    update, error = build_user_update(request.json)
+    if error:
+        return jsonify({"error": error}), 400
+
+    result = mongo.db.users.update_one({"_id": user_id}, {"$set": update})
+    mongo.profiles.invalidate([user_id])
+    if not result.matched_count:
+        return jsonify({"error": "User not found"}), 404
+    if profile_cache.NAME_FIELDS & update.keys():
+        # The name shows in the followers' feeds and in the likes and comments lists of the posts
+        # the user liked or commented
+        versions.bump(mongo.db.users, [user_id], "postsVersion")
+        versions.bump_names(mongo.db, user_id, datetime.utcnow())
+    return jsonify({"message": "User updated"}), 200
+
+# Get several posts with one query: GET /posts?ids=<id>,<id>,...
+@api.route('/posts', methods=['GET'])
+def get_posts():
+    post_ids, error = build_ids(request.args, current_app.config["MULTI_GET_MAX_IDS"])
+    if error:
+        return jsonify({"error": error}), 400
+
+    posts = list(mongo.db.posts.find({"_id": {"$in": post_ids}}, multi_get.POST_FIELDS))
+    missing = multi_get.missing_ids(post_ids, posts)
+    if missing:
+        posts += mongo.db.posts_archive.find({"_id": {"$in": missing}}, multi_get.POST_FIELDS)
+    return jsonify(multi_get.in_order(post_ids, posts, multi_get.post_record)), 200
+
 # Create a post
-@app.route('/posts', methods=['POST'])
+@api.route('/posts', methods=['POST'])
 def create_post():
-    data = request.json
-    if not all(key in data for key in ('authorId', 'content')):
-        return jsonify({"error": "Missing fields"}), 400
-
-    author_id = validate_object_id(data['authorId'])
-    if not author_id:
-        return jsonify({"error": "Invalid authorId"}), 400
-
-    post = {
-        "author": author_id,
-        "content": data['content'],
-        "createdAt": datetime.utcnow(),
-        "likes": [],
-        "comments": []
-    }
+    post, error = build_post(request.json)
+    if error:
+        return jsonify({"error": error}), 400
+
     result = mongo.db.posts.insert_one(post)
+    if timeline_mode():
+        timeline.fan_out_post(
+            mongo.db, post,
+            current_app.config["TIMELINE_MAX_SIZE"], current_app.config["FANOUT_FOLLOWER_LIMIT"]
+        )
+    versions.bump(mongo.db.users, [post["author"]], "postsVersion")
     return jsonify({"message": "Post created", "postId": str(result.inserted_id)}), 201
 
 # Add a comment to a post
-@app.route('/posts/<post_id>/comments', methods=['POST'])
+@api.route('/posts/<post_id>/comments', methods=['POST'])
 def add_comment(post_id):
     post_id = validate_object_id(post_id)
     if not post_id:
         return jsonify({"error": "Invalid postId"}), 400
 
-    data = request.json
-    if not all(key in data for key in ('authorId', 'text')):
-        return jsonify({"error": "Missing fields"}), 400
-
-    author_id = validate_object_id(data['authorId'])
-    if not author_id:
-        return jsonify({"error": "Invalid authorId"}), 400
-
-    if len(data['text']) > 500:
-        return jsonify({"error": "Comment too long"}), 400
-
-    comment = {
-        "author": author_id,
-        "text": data['text'],
-        "createdAt": datetime.utcnow()
-    }
-    result = mongo.db.posts.update_one(
-        {"_id": post_id},
-        {"$push": {"comments": comment}}
+    comment, error = build_comment(request.json)
+    if error:
+        return jsonify({"error": error}), 400
+
+    if write_queue:
+        # Write-behind: check the post now, append the comment with the next flush
+        post = mongo.db.posts.find_one({"_id": post_id}, {"author": 1})
+        if not post:
+            return missing_post(post_id)
+        try:
+            write_queue.comment(post_id, post["author"], comment)
+        except write_behind.QueueFull:
+            return queue_full()
+        return jsonify({"message": "Comment accepted"}), 202
+
+    author = comments.add_comment(
+        mongo.db, post_id, comment,
+        current_app.config["COMMENT_BUCKET_SIZE"], current_app.config["COMMENT_PREVIEW_SIZE"]
     )
-    if result.matched_count == 0:
-        return jsonify({"error": "Post not found"}), 404
+    if not author:
+        return missing_post(post_id)
+    versions.bump(mongo.db.users, [author], "postsVersion")
     return jsonify({"message": "Comment added"}), 200
 
 # Add a like to a post
-@app.route('/posts/<post_id>/likes', methods=['POST'])
+@api.route('/posts/<post_id>/likes', methods=['POST'])
 def add_like(post_id):
     post_id = validate_object_id(post_id)
     if not post_id:
         return jsonify({"error": "Invalid postId"}), 400
 
-    data = request.json
-    if 'userId' not in data:
-        return jsonify({"error": "Missing userId"}), 400
+    user_id, error = validate_liker(request.json)
+    if error:
+        return jsonify({"error": error}), 400
 
-    user_id = validate_object_id(data['userId'])
-    if not user_id:
-        return jsonify({"error": "Invalid userId"}), 400
+    if write_queue:
+        return queue_like(post_id, user_id)
 
-    post = mongo.db.posts.find_one({"_id": post_id})
+    # Single conditional update: only matches if the user has not liked the post yet
+    post = mongo.db.posts.find_one_and_update(
+        {"_id": post_id, "likes": {"$ne": user_id}},
+        {"$push": {"likes": user_id}, "$inc": {"likeCount": 1, "likesVersion": 1}},
+        projection={"author": 1}
+    )
     if not post:
-        return jsonify({"error": "Post not found"}), 404
+        if not post_exists(post_id):
+            return missing_post(post_id)
+        return jsonify({"error": "User already liked this post"}), 400
+    versions.bump(mongo.db.users, [post["author"]], "postsVersion")
+    return jsonify({"message": "Like added"}), 200
 
-    if user_id in post.get('likes', []):
+# Check a like and queue it for the next write-behind flush
+def queue_like(post_id, user_id):
+    post = mongo.db.posts.find_one({"_id": post_id, "likes": {"$ne": user_id}}, {"author": 1})
+    if not post:
+        if not post_exists(post_id):
+            return missing_post(post_id)
         return jsonify({"error": "User already liked this post"}), 400
+    try:
+        queued = write_queue.like(post_id, post["author"], user_id)
+    except write_behind.QueueFull:
+        return queue_full()
+    if not queued:
+        return jsonify({"error": "User already liked this post"}), 400
+    return jsonify({"message": "Like accepted"}), 202
+
+# Remove a like from a post
+@api.route('/posts/<post_id>/unlike', methods=['POST'])
+def remove_like(post_id):
+    post_id = validate_object_id(post_id)
+    if not post_id:
+        return jsonify({"error": "Invalid postId"}), 400
 
-    mongo.db.posts.update_one(
-        {"_id": post_id},
-        {"$push": {"likes": user_id}}
+    user_id, error = validate_liker(request.json)
+    if error:
+        return jsonify({"error": error}), 400
+
+    # A like of this user's may still be queued; apply it before removing it
+    flush_reader_writes(user_id)
+    post = mongo.db.posts.find_one_and_update(
+        {"_id": post_id, "likes": user_id},
+        {"$pull": {"likes": user_id}, "$inc": {"likeCount": -1, "likesVersion": 1}},
+        projection={"author": 1}
     )
-    return jsonify({"message": "Like added"}), 200
+    if not post:
+        if not post_exists(post_id):
+            return missing_post(post_id)
+        return jsonify({"error": "User has not liked this post"}), 400
+    versions.bump(mongo.db.users, [post["author"]], "postsVersion")
+    return jsonify({"message": "Like removed"}), 200
 
 # Follow a user
-@app.route('/users/<user_id>/follow', methods=['POST'])
+@api.route('/users/<user_id>/follow', methods=['POST'])
 def follow_user(user_id):
     user_id = validate_object_id(user_id)
     if not user_id:
         return jsonify({"error": "Invalid userId"}), 400
 
-    data = request.json
-    follow_id = validate_object_id(data.get('followId'))
-    if not follow_id:
-        return jsonify({"error": "Invalid followId"}), 400
-
-    user, error, status = get_user(user_id)
+    follow_id, error = validate_followee(request.json, 'followId')
     if error:
-        return jsonify(error), status
+        return jsonify({"error": error}), 400
+
+    if not user_exists(user_id):
+        return jsonify({"error": "User not found"}), 404
 
-    if follow_id in user.get('following', []):
+    # A single upsert of the edge; repeating it changes nothing
+    if not follows.follow(mongo.db, user_id, follow_id):
         return jsonify({"message": "Already following this user"}), 400
 
-    mongo.db.users.update_one(
-        {"_id": user_id},
-        {"$push": {"following": follow_id}}
-    )
+    if timeline_mode():
+        timeline.backfill_timeline(mongo.db, user_id, follow_id, current_app.config["TIMELINE_MAX_SIZE"])
+    versions.bump(mongo.db.users, [user_id], "followVersion")
     return jsonify({"message": "Now following the user"}), 200
 
 # Unfollow a user
-@app.route('/users/<user_id>/unfollow', methods=['POST'])
+@api.route('/users/<user_id>/unfollow', methods=['POST'])
 def unfollow_user(user_id):
     user_id = validate_object_id(user_id)
     if not user_id:
         return jsonify({"error": "Invalid userId"}), 400
 
-    data = request.json
-    unfollow_id = validate_object_id(data.get('unfollowId'))
-    if not unfollow_id:
-        return jsonify({"error": "Invalid unfollowId"}), 400
-
-    user, error, status = get_user(user_id)
+    unfollow_id, error = validate_followee(request.json, 'unfollowId')
     if error:
-        return jsonify(error), status
+        return jsonify({"error": error}), 400
+
+    if not user_exists(user_id):
+        return jsonify({"error": "User not found"}), 404
 
-    if unfollow_id not in user.get('following', []):
+    if not follows.unfollow(mongo.db, user_id, unfollow_id):
         return jsonify({"message": "Not following this user"}), 400
 
-    mongo.db.users.update_one(
-        {"_id": user_id},
-        {"$pull": {"following": unfollow_id}}
-    )
+    if timeline_mode():
+        timeline.prune_timeline(mongo.db, user_id, unfollow_id)
+    versions.bump(mongo.db.users, [user_id], "followVersion")
     return jsonify({"message": "Unfollowed the user"}), 200
 
+# Get a page of a user's followers or of the users they follow, newest first
+@api.route('/users/<user_id>/followers', methods=['GET'], defaults={"side": "followers"})
+@api.route('/users/<user_id>/following', methods=['GET'], defaults={"side": "following"})
+def get_follow_list(user_id, side):
+    user_id = validate_object_id(user_id)
+    if not user_id:
+        return jsonify({"error": "Invalid userId"}), 400
+
+    query, error = build_follow_list_query(request.args, current_app.config["FOLLOWS_MAX_PAGE_SIZE"])
+    if error:
+        return jsonify({"error": error}), 400
+    after, limit = query
+
+    user = mongo.db.users.find_one({"_id": user_id}, {"followerCount": 1, "followingCount": 1})
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+
+    edges = follows.read_page(mongo.db, user_id, side, after, limit + 1)
+    edges, next_cursor = split_page(edges, limit, follows.edge_cursor)
+    # Resolve the listed users' names in one query
+    users = get_users_by_id({edge[follows.SIDES[side][1]] for edge in edges})
+    response = jsonify(follows.follow_records(edges, side, users))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    response.headers["X-Total-Count"] = str(follows.total_count(user, side))
+    return response, 200
+
 # Get likes for a post
-@app.route('/posts/<post_id>/likes', methods=['GET'])
+@api.route('/posts/<post_id>/likes', methods=['GET'])
 def get_post_likes(post_id):
     post_id = validate_object_id(post_id)
     if not post_id:
         return jsonify({"error": "Invalid postId"}), 400
 
-    post = mongo.db.posts.find_one({"_id": post_id})
+    flush_reader_writes()
+    db = read_db("likes")
+    if wants_ndjson():
+        batch_size = current_app.config["STREAM_BATCH_SIZE"]
+        if db.posts.find_one({"_id": post_id}, {"_id": 1}):
+            return ndjson_response(db.posts.aggregate(likers.stream_pipeline(post_id), batchSize=batch_size)), 200
+        # An archived post's likes are stored compressed with its comments, so they are read whole
+        archived = archive.find_post(db, post_id)
+        if not archived:
+            return jsonify({"error": "Post not found"}), 404
+        return ndjson_response(iter_likers(db, archived.get('likes', []), batch_size)), 200
+
+    post = db.posts.find_one({"_id": post_id}, {"likes": 1, "likesVersion": 1, "namesChangedAt": 1})
+    post = post or archive.find_post(db, post_id)
     if not post:
         return jsonify({"error": "Post not found"}), 404
 
     likes = post.get('likes', [])
-    users = []
-    for user_id in likes:
-        user, error, status = get_user(user_id)
-        if user:
-            users.append({
-                "userId": str(user["_id"]),
-                "firstName": user["firstName"],
-                "lastName": user["lastName"]
-            })
-    return jsonify(users), 200
-
-# Get all comments for a post
-@app.route('/posts/<post_id>/comments', methods=['GET'])
+    etag = versions.likes_etag(post)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    if profile_cache.names_stale(post, current_app.config["PROFILE_CACHE_TTL_S"]):
+        # A liker was renamed lately, maybe in another process, so no cached name is trusted
+        mongo.profiles.invalidate(likes)
+    response = jsonify(list(iter_likers(db, likes, max(len(likes), 1))))
+    response.set_etag(etag)
+    return response, 200
+
+# Resolve likers in batches of `batch_size` users, keeping the order of the likes array
+def iter_likers(db, likes, batch_size):
+    for chunk in bulk.chunked(likes, batch_size):
+        yield from likers.liker_records(chunk, get_users_by_id(chunk, db))
+
+# Get a page of comments for a post
+@api.route('/posts/<post_id>/comments', methods=['GET'])
 def get_posts_comments(post_id):
     try:
         # Validate the post ID
-        post = mongo.db.posts.find_one({"_id": ObjectId(post_id)})
+        post_id = ObjectId(post_id)
+        stream = wants_ndjson()
+        bucket_size = current_app.config["COMMENT_BUCKET_SIZE"]
+        query, error = build_comments_query(
+            request.args, stream, bucket_size, current_app.config["COMMENTS_MAX_PAGE_SIZE"]
+        )
+        if error:
+            return jsonify({"error": error}), 400
+        cursor, limit = query
+
+        flush_reader_writes()
+        db = read_db("comments")
+        post = db.posts.find_one({"_id": post_id}, {"commentCount": 1, "commentsVersion": 1, "namesChangedAt": 1})
+        archived = None
         if not post:
-            return jsonify({"error": "Post not found"}), 404
-
-        # Retrieve comments
-        comments = post.get("comments", [])
-        comments_with_details = []
-
-        for comment in comments:
-            author = mongo.db.users.find_one({"_id": comment["author"]})
-            if author:
-                comments_with_details.append({
-                    "text": comment["text"],
-                    "createdAt": comment["createdAt"],
-                    "authorFirstName": author["firstName"],
-                    "authorLastName": author["lastName"]
-                })
-
-        return jsonify(comments_with_details), 200
+            # An archived post carries all of its comments
+            post = archived = archive.find_post(db, post_id)
+            if not archived:
+                return jsonify({"error": "Post not found"}), 404
+
+        if stream:
+            # Stream bucket by bucket to the end of the comments, or up to `limit` if given
+            if archived:
+                pages = [comments.read_archived_comments(archived, cursor, None, bucket_size)[0]]
+            else:
+                pages = comments.iter_comment_pages(
+                    db, post_id, cursor, bucket_size, current_app.config["STREAM_BATCH_SIZE"]
+                )
+            records = (record for page in pages for record in comment_details(db, page))
+            return ndjson_response(islice(records, limit)), 200
+
+        etag = versions.comments_etag(post)
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        # Retrieve one page of comments from the buckets
+        if archived:
+            page, next_cursor = comments.read_archived_comments(archived, cursor, limit, bucket_size)
+        else:
+            page, next_cursor = comments.read_comments(db, post_id, cursor, limit, bucket_size)
+        if profile_cache.names_stale(post, current_app.config["PROFILE_CACHE_TTL_S"]):
+            # A commenter was renamed lately, maybe in another process, so no cached name is trusted
+            mongo.profiles.invalidate({comment["author"] for comment in page})
+        response = jsonify(comment_details(db, page))
+        response.set_etag(etag)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = encode_bucket_cursor(*next_cursor)
+        return response, 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/users/<user_id>/feed', methods=['GET'])
+# Attach author names to a page of comments, resolving all authors in one query
+def comment_details(db, page):
+    return comments.comment_records(page, get_users_by_id({comment["author"] for comment in page}, db))
+
+@api.route('/users/<user_id>/feed', methods=['GET'])
 def get_feed(user_id):
     user_id = validate_object_id(user_id)
     if not user_id:
         return jsonify({"error": "Invalid userId"}), 400
 
-    user, error, status = get_user(user_id)
+    stream = wants_ndjson()
+    query, error = build_feed_query(request.args, stream, current_app.config["FEED_MAX_PAGE_SIZE"])
     if error:
-        return jsonify(error), status
+        return jsonify({"error": error}), 400
+    after, skip, limit = query
 
-    following = user.get('following', [])
+    flush_reader_writes(user_id)
+    db = read_db("feed")
+    user = db.users.find_one({"_id": user_id}, {"followVersion": 1})
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+
+    following = follows.following_ids(db, user_id)
+    etag = None
+    if not stream:
+        # The versions are read before the posts, so the ETag never claims newer content than is sent
+        authors = db.users.find(*versions.authors_query(following)) if following else []
+        etag = versions.feed_etag(user, authors)
+        cached = not_modified(etag)
+        if cached:
+            return cached
     if not following:
-        return jsonify([])  # No following, return an empty feed
-
-    page = int(request.args.get('page', 1))
-    limit = 20
-    skip = (page - 1) * limit
-
-    pipeline = [
-        {"$match": {"author": {"$in": following}}},
-        {"$sort": {"createdAt": -1}},
-        {"$skip": skip},
-        {"$limit": limit},
-        {"$lookup": {
-            "from": "users",
-            "localField": "author",
-            "foreignField": "_id",
-            "as": "authorDetails"
-        }},
-        {"$project": {
-            "content": 1,
-            "createdAt": 1,
-            "likes": {"$size": "$likes"},
-            "comments": {
-                "$map": {
-                    "input": "$comments",
-                    "as": "comment",
-                    "in": {
-                        "text": "$$comment.text",
-                        "author": {"$toString": "$$comment.author"},  # Convert ObjectId to string
-                        "createdAt": "$$comment.createdAt"
-                    }
-                }
-            },
-            "authorDetails.firstName": 1,
-            "authorDetails.lastName": 1
-        }}
-    ]
-
-    posts = list(mongo.db.posts.aggregate(pipeline))
-    for post in posts:
-        # Convert ObjectId fields to strings for JSON serialization
-        post["_id"] = str(post["_id"])
-        post["createdAt"] = post["createdAt"].isoformat()  # Convert datetime to ISO format
-        if "authorDetails" in post and post["authorDetails"]:
-            author = post["authorDetails"][0]
-            post["authorFirstName"] = author["firstName"]
-            post["authorLastName"] = author["lastName"]
-            del post["authorDetails"]
-
-    return jsonify(posts), 200
+        # No following, return an empty feed
+        if stream:
+            return ndjson_response([]), 200
+        response = jsonify([])
+        response.set_etag(etag)
+        return response, 200
+
+    # Fetch one extra post to know whether there is a next page
+    if timeline_mode():
+        # Materialized timeline: page through post references, then load just those posts
+        fetch = limit + 1 if limit else current_app.config["TIMELINE_MAX_SIZE"]
+        post_ids = timeline.read_timeline(db, user_id, following, skip, fetch, after)
+        pipeline = feed.timeline_stages(post_ids)
+    else:
+        fetch = limit + 1 if limit else None
+        post_ids = None
+        pipeline = feed.pull_stages(following, after, skip, fetch)
+    details = feed.detail_stages(current_app.config["COMMENT_PREVIEW_SIZE"], json_provider.date_format.get())
+
+    # The page continues in the archive once the posts in `posts` run out
+    def archived_posts(count):
+        hot_total = 0
+        if post_ids is None and skip and not count:
+            hot_total = db.posts.count_documents(feed.pull_match(following, after))
+        stages = feed.archive_stages(following, post_ids, after, skip, fetch, count, hot_total)
+        if stages is None:
+            return []
+        return db.posts_archive.aggregate(stages + details, batchSize=current_app.config["STREAM_BATCH_SIZE"])
+
+    cursor = db.posts.aggregate(pipeline + details, batchSize=current_app.config["STREAM_BATCH_SIZE"])
+    if stream:
+        return ndjson_response(islice(with_archived(cursor, archived_posts), limit)), 200
+
+    posts = list(cursor)
+    posts += archived_posts(len(posts))
+    posts, next_cursor = split_page(posts, limit, feed.next_cursor)
+
+    # The pipeline already emitted the response shape, so the posts are serialized as they are
+    response = jsonify(posts)
+    response.set_etag(etag)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response, 200
+
+# Helper function to stream a feed: its posts from `posts`, then those `archived_posts` continues with
+def with_archived(cursor, archived_posts):
+    count = 0
+    for post in cursor:
+        count += 1
+        yield post
+    yield from archived_posts(count)
+
+# Search post content and comment text, best match first
+@api.route('/search', methods=['GET'])
+def search_posts():
+    terms, error = build_search(request.args, current_app.config["SEARCH_MAX_PAGE_SIZE"])
+    if error:
+        return jsonify({"error": error}), 400
+    query, author_id, after, limit = terms
+
+    # Fetch one extra post to know whether there is a next page
+    pipeline = search.search_stages(
+        query, author_id, after, limit + 1, current_app.config["COMMENT_PREVIEW_SIZE"], json_provider.date_format.get()
+    )
+    posts = list(read_db("search").posts.aggregate(pipeline))
+    posts, next_cursor = split_page(posts, limit, search.next_cursor)
+
+    response = jsonify(posts)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response, 200
+
+# Bulk-create users
+@api.route('/bulk/users', methods=['POST'])
+def bulk_create_users():
+    items, error = bulk.parse_items(
+        request.mimetype, request.get_data(as_text=True), current_app.config["BULK_MAX_ITEMS"], current_app.json.loads
+    )
+    if error:
+        return jsonify({"error": error}), 400
+
+    results, users = bulk.validate_items(items, build_user)
+    failed = bulk.insert_documents(mongo.db.users, users, current_app.config["BULK_CHUNK_SIZE"])
+    user_ids = {index: str(user["_id"]) for index, user in users}
+    bulk.record_writes(user_ids, failed, results, lambda index: {
+        "index": index, "status": 201, "userId": user_ids[index]
+    })
+    return jsonify(bulk.summarize(results)), 200
+
+# Bulk-create posts
+@api.route('/bulk/posts', methods=['POST'])
+def bulk_create_posts():
+    items, error = bulk.parse_items(
+        request.mimetype, request.get_data(as_text=True), current_app.config["BULK_MAX_ITEMS"], current_app.json.loads
+    )
+    if error:
+        return jsonify({"error": error}), 400
+
+    results, posts = bulk.validate_items(items, build_post)
+    failed = bulk.insert_documents(mongo.db.posts, posts, current_app.config["BULK_CHUNK_SIZE"])
+    posts = dict(posts)
+    created = bulk.record_writes(posts, failed, results, lambda index: {
+        "index": index, "status": 201, "postId": str(posts[index]["_id"])
+    })
+    if timeline_mode():
+        for index in created:
+            timeline.fan_out_post(
+                mongo.db, posts[index],
+                current_app.config["TIMELINE_MAX_SIZE"], current_app.config["FANOUT_FOLLOWER_LIMIT"]
+            )
+    versions.bump(mongo.db.users, [posts[index]["author"] for index in created], "postsVersion")
+    return jsonify(bulk.summarize(results)), 200
+
+# Bulk-follow users; items are {"userId": ..., "followId": ...}
+@api.route('/bulk/follows', methods=['POST'])
+def bulk_follow_users():
+    items, error = bulk.parse_items(
+        request.mimetype, request.get_data(as_text=True), current_app.config["BULK_MAX_ITEMS"], current_app.json.loads
+    )
+    if error:
+        return jsonify({"error": error}), 400
+
+    results, follow_items = bulk.validate_items(items, build_follow)
+    for chunk in bulk.chunked(follow_items, current_app.config["BULK_CHUNK_SIZE"]):
+        # One read per chunk reports missing users; the edge upserts report existing follows
+        ops = bulk.plan_follows(chunk, mongo.db.users.find(*bulk.follows_query(chunk)), results)
+        failed, upserted = bulk.upsert_operations(mongo.db.follows, ops, len(chunk))
+        followed = bulk.record_upserts(
+            ops, failed, upserted, results,
+            lambda index: {"index": index, "status": 200}, "Already following this user"
+        )
+        pairs = dict(chunk)
+        if followed:
+            mongo.db.users.bulk_write(follows.counter_updates([pairs[index] for index in followed], 1), ordered=False)
+        if timeline_mode():
+            for index in followed:
+                user_id, follow_id = pairs[index]
+                timeline.backfill_timeline(mongo.db, user_id, follow_id, current_app.config["TIMELINE_MAX_SIZE"])
+        versions.bump(mongo.db.users, [pairs[index][0] for index in followed], "followVersion")
+    return jsonify(bulk.summarize(results)), 200
+
+# Bulk-like posts; items are {"postId": ..., "userId": ...}
+@api.route('/bulk/likes', methods=['POST'])
+def bulk_add_likes():
+    items, error = bulk.parse_items(
+        request.mimetype, request.get_data(as_text=True), current_app.config["BULK_MAX_ITEMS"], current_app.json.loads
+    )
+    if error:
+        return jsonify({"error": error}), 400
+
+    results, likes = bulk.validate_items(items, build_like)
+    for chunk in bulk.chunked(likes, current_app.config["BULK_CHUNK_SIZE"]):
+        # One aggregation per chunk reports missing posts and existing likes for every item
+        posts = list(mongo.db.posts.aggregate(bulk.likes_pipeline(chunk)))
+        missing = {post_id for _, (post_id, _) in chunk} - {post["_id"] for post in posts}
+        archived = archive.archived_ids(mongo.db, missing) if missing else ()
+        ops = bulk.plan_likes(chunk, posts, results, archived)
+        failed = bulk.write_operations(mongo.db.posts, ops, len(chunk))
+        liked = bulk.record_writes(dict(ops), failed, results, lambda index: {"index": index, "status": 200})
+        authors = {post["_id"]: post["author"] for post in posts}
+        pairs = dict(chunk)
+        versions.bump(mongo.db.users, [authors[pairs[index][0]] for index in liked], "postsVersion")
+    return jsonify(bulk.summarize(results)), 200
 
 # Cleanup function to clear database collections
-@app.route('/cleanup', methods=['POST'])
+@api.route('/cleanup', methods=['POST'])
 def cleanup_database():
     try:
-        # Delete all documents from the 'users' and 'posts' collections
+        # A test database is dropped as a whole
+        if "mongo" in g:
+            drop_test_database()
+            return jsonify({"status": "success", "message": "Test database dropped."}), 200
+
+        # Delete all documents from the 'users', 'posts', 'posts_archive', 'follows', 'timelines'
+        # and 'comment_buckets' collections
         mongo.db.users.delete_many({})
         mongo.db.posts.delete_many({})
+        mongo.db.posts_archive.delete_many({})
+        mongo.db.follows.delete_many({})
+        mongo.db.timelines.delete_many({})
+        mongo.db.comment_buckets.delete_many({})
+        mongo.profiles.clear()
         
         # Log a message for confirmation and send a JSON response
         return jsonify({"status": "success", "message": "Database cleanup successful. Collections cleared."}), 200
@@ -297,5 +786,89 @@ def cleanup_database():
         # Handle any errors during cleanup and return error response
         return jsonify({"status": "error", "message": f"Error during database cleanup: {e}"}), 500
 
+# Report the query plan of every route's canonical query: flask --app app explain-queries
+@api.cli.command("explain-queries")
+def explain_queries_command():
+    """Explain each route's canonical query and fail on collection scans."""
+    indexes.ensure_indexes(mongo.db)
+    report = indexes.explain_queries(mongo.db)
+    for row in report:
+        flag = "COLLSCAN" if row["collscan"] else "ok"
+        print(f"{flag:<9} {row['route']:<40} {row['collection']:<16} {' > '.join(row['stages'])}")
+    if any(row["collscan"] for row in report):
+        sys.exit(1)
+
+# Move embedded `following` arrays into the follows collection: flask --app app migrate-follows
+@api.cli.command("migrate-follows")
+def migrate_follows_command():
+    """Convert embedded following arrays into follow edges and rebuild the counters."""
+    indexes.ensure_indexes(mongo.db)
+    migrated = follows.migrate_embedded(mongo.db)
+    print(f"migrated the follows of {migrated} users")
+
+# Move embedded `comments` arrays into comment buckets: flask --app app migrate-comments
+@api.cli.command("migrate-comments")
+def migrate_comments_command():
+    """Move embedded comments into comment_buckets and set commentCount and commentPreview."""
+    indexes.ensure_indexes(mongo.db)
+    migrated = comments.migrate_embedded(
+        mongo.db, current_app.config["COMMENT_BUCKET_SIZE"], current_app.config["COMMENT_PREVIEW_SIZE"]
+    )
+    print(f"migrated the comments of {migrated} posts")
+
+# Copy each post's author into its comment buckets, for searches by author: flask --app app backfill-bucket-authors
+@api.cli.command("backfill-bucket-authors")
+def backfill_bucket_authors_command():
+    """Set the post author on comment buckets written before buckets stored it."""
+    updated = comments.backfill_authors(mongo.db)
+    print(f"backfilled the post author of {updated} comment buckets")
+
+# Set likeCount from the likes array where they disagree: flask --app app backfill-like-counts
+@api.cli.command("backfill-like-counts")
+def backfill_like_counts_command():
+    """Recompute likeCount of posts created before it existed, or whose count went wrong."""
+    # A pipeline update reads the array and sets the count in one atomic write per post,
+    # so likes arriving during the backfill are counted exactly once
+    size = {"$size": {"$ifNull": ["$likes", []]}}
+    stale = {"$expr": {"$ne": ["$likeCount", size]}}
+    authors = {post["author"] for post in mongo.db.posts.find(stale, {"author": 1})}
+    result = mongo.db.posts.update_many(stale, [{"$set": {"likeCount": size}}])
+    # The feed shows like counts, so cached feeds of these authors' followers are now stale
+    versions.bump(mongo.db.users, list(authors), "postsVersion")
+    print(f"backfilled the like count of {result.modified_count} posts")
+
+# Build the timelines of the existing follows, before switching to FEED_MODE=timeline: flask --app app rebuild-timelines
+@api.cli.command("rebuild-timelines")
+def rebuild_timelines_command():
+    """Rebuild every user's timeline from the follow edges."""
+    indexes.ensure_indexes(mongo.db)
+    rebuilt = timeline.rebuild_timelines(
+        mongo.db, current_app.config["TIMELINE_MAX_SIZE"], current_app.config["FANOUT_FOLLOWER_LIMIT"]
+    )
+    print(f"rebuilt timelines from {rebuilt} follows")
+
+# Move old posts into the archive: flask --app app archive-posts [--older-than-days N]
+@api.cli.command("archive-posts")
+@click.option("--older-than-days", type=float, help="Archive posts older than this (default: ARCHIVE_AFTER_DAYS)")
+def archive_posts_command(older_than_days):
+    """Move posts older than the cutoff into posts_archive."""
+    indexes.ensure_indexes(mongo.db)
+    days = current_app.config["ARCHIVE_AFTER_DAYS"] if older_than_days is None else older_than_days
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    archived = archive.archive_posts(
+        mongo.db, cutoff, current_app.config["ARCHIVE_BATCH_SIZE"], current_app.config["COMMENT_PREVIEW_SIZE"]
+    )
+    print(f"archived {archived} posts created before {cutoff.isoformat()}")
+
+# Open the Mongo pool before the process takes requests; gunicorn.conf.py runs this in every worker
+def warm_up(app):
+    with app.app_context():
+        indexes.ensure_indexes(mongo.db)
+        mongo_options.warm_up(mongo.db, app.config, app.config["MONGO_WARMUP_CONNECTIONS"])
+
+app = create_app()
+
 if __name__ == '__main__':
+    with app.app_context():
+        indexes.ensure_indexes(mongo.db)
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,146 @@
+import zlib
+from datetime import datetime
+from itertools import takewhile
+
+import bson
+from pymongo import ReplaceOne
+
+# Hot/cold tiering: old posts move from `posts` into `posts_archive`.
+#
+# `flask --app app archive-posts` moves posts created more than ARCHIVE_AFTER_DAYS
+# ago, ARCHIVE_BATCH_SIZE at a time. An archived post keeps the fields the feed
+# shows, with counts instead of arrays:
+#   {"_id", "author", "content", "createdAt", "likeCount", "commentCount", "commentPreview",
+#    "likesVersion", "commentsVersion", "archivedAt", "details": <zlib-compressed BSON>}
+# `details` holds the likes array and every comment of the post's comment buckets,
+# which are deleted. Recent feeds then no longer pull old likes arrays and comment
+# buckets into Mongo's cache, and an archived post takes a fraction of its old size.
+#
+# Archived posts are read-only: likes and comments on them are refused with 409.
+# Posts move strictly in creation order and nothing moves back, so every archived
+# post is older than every post left in `posts`. A feed page therefore continues
+# into the archive only once `posts` runs out.
+#
+# A post with a comment still being written, or that changes while it is archived
+# (its likesVersion, commentCount or commentsVersion moves), stays in `posts`, and
+# the run stops there: moving newer posts past it would break that order. The next
+# run picks up from it. A post read while it is being archived can show up in both
+# collections for that moment.
+#
+# The `_async` functions are the same reads for the async driver used by asgi_app.py.
+
+COMPRESSION_LEVEL = 6
+
+
+def _compress(likes, comments):
+    return zlib.compress(bson.encode({"likes": likes, "comments": comments}), COMPRESSION_LEVEL)
+
+
+def _compact(post, bucket_comments, preview_size, now):
+    # Posts from before comment buckets embed their comments, and may lack the counters
+    comments = post.get("comments", []) + bucket_comments
+    return {
+        "_id": post["_id"],
+        "author": post["author"],
+        "content": post["content"],
+        "createdAt": post["createdAt"],
+        "likeCount": post.get("likeCount", len(post.get("likes", []))),
+        "commentCount": post.get("commentCount", len(comments)),
+        "commentPreview": post.get("commentPreview", comments[-preview_size:]),
+        "likesVersion": post.get("likesVersion", 0),
+        "commentsVersion": post.get("commentsVersion", 0),
+        "archivedAt": now,
+        "details": _compress(post.get("likes", []), comments),
+    }
+
+
+# Matches the post only while it is as it was read; a missing field matches a missing field
+def _unchanged(post):
+    return {
+        "_id": post["_id"],
+        "likesVersion": post.get("likesVersion"),
+        "commentCount": post.get("commentCount"),
+        "commentsVersion": post.get("commentsVersion"),
+    }
+
+
+def _archive_batch(db, posts, preview_size):
+    post_ids = [post["_id"] for post in posts]
+    bucket_comments = {}
+    buckets = db.comment_buckets.find({"post": {"$in": post_ids}}, {"post": 1, "comments": 1})
+    for bucket in buckets.sort([("post", 1), ("seq", 1)]):
+        bucket_comments.setdefault(bucket["post"], []).extend(bucket["comments"])
+
+    # A comment counted on the post but not yet in its bucket is still being written
+    settled = list(takewhile(
+        lambda post: "commentCount" not in post
+        or post["commentCount"] == len(bucket_comments.get(post["_id"], [])),
+        posts
+    ))
+    if not settled:
+        return 0
+    now = datetime.utcnow()
+    # The archive copy is written first, so a post is never in neither collection
+    db.posts_archive.bulk_write([
+        ReplaceOne({"_id": post["_id"]}, _compact(post, bucket_comments.get(post["_id"], []), preview_size, now),
+                   upsert=True)
+        for post in settled
+    ], ordered=False)
+    # One delete at a time, in order, to stop at the first post that changed since it was read
+    moved = []
+    for post in settled:
+        if not db.posts.delete_one(_unchanged(post)).deleted_count:
+            break
+        moved.append(post["_id"])
+
+    kept = [post["_id"] for post in settled[len(moved):]]
+    if kept:
+        db.posts_archive.delete_many({"_id": {"$in": kept}})
+    if moved:
+        db.comment_buckets.delete_many({"post": {"$in": moved}})
+    return len(moved)
+
+
+# Move the posts created before `cutoff` into the archive, oldest first, until one cannot move yet;
+# returns how many moved
+def archive_posts(db, cutoff, batch_size, preview_size):
+    archived = 0
+    while True:
+        posts = list(
+            db.posts.find({"createdAt": {"$lt": cutoff}}).sort([("createdAt", 1), ("_id", 1)]).limit(batch_size)
+        )
+        if not posts:
+            return archived
+        moved = _archive_batch(db, posts, preview_size)
+        archived += moved
+        if moved < len(posts):
+            return archived
+
+
+# An archived post with its likes and comments unpacked, in the shape of a post in `posts`
+def _expand(document):
+    details = bson.decode(zlib.decompress(document.pop("details")))
+    document["likes"] = details["likes"]
+    document["comments"] = details["comments"]
+    return document
+
+
+# The archived post with `post_id` and its likes and comments, or None
+def find_post(db, post_id):
+    document = db.posts_archive.find_one({"_id": post_id})
+    return _expand(document) if document else None
+
+
+# Which of `post_ids` are archived
+def archived_ids(db, post_ids):
+    return {document["_id"] for document in db.posts_archive.find({"_id": {"$in": list(post_ids)}}, {"_id": 1})}
+
+
+async def find_post_async(db, post_id):
+    document = await db.posts_archive.find_one({"_id": post_id})
+    return _expand(document) if document else None
+
+
+async def archived_ids_async(db, post_ids):
+    cursor = db.posts_archive.find({"_id": {"$in": list(post_ids)}}, {"_id": 1})
+    return {document["_id"] for document in await cursor.to_list(None)}
@@ -0,0 +1,876 @@
+import asyncio
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo import AsyncMongoClient
+from quart import Quart, Response, g, jsonify, request, stream_with_context
+from werkzeug.local import LocalProxy
+
+import admission
+import archive
+import bulk
+import comments
+import feed
+import follows
+import indexes
+import json_provider
+import likers
+import metrics
+import mongo_options
+import multi_get
+import profile_cache
+import search
+import timeline
+import versions
+import write_behind
+from config import load_config
+from pagination import encode_bucket_cursor, split_page
+from validation import (
+    validate_object_id, validate_test_database, validate_date_format, build_ids, build_user, build_user_update, build_post, build_comment,
+    validate_liker, validate_followee, build_follow, build_like,
+    build_follow_list_query, build_comments_query, build_feed_query, build_search
+)
+
+# Asynchronous (ASGI) server: the same API as app.py, served by Quart on PyMongo's
+# async driver so a request waiting on Mongo does not hold a thread.
+#
+#   hypercorn asgi_app:app --bind 0.0.0.0:5000
+#
+# Independent queries within a request run concurrently with asyncio.gather.
+# Request validation (validation.py), the queries and the response records (the data
+# modules) are shared with app.py; the routes here only add the awaits around them.
+
+app = Quart(__name__)
+
+app.config.update(load_config())
+app.json = json_provider.create_provider(app, app.config["JSON_PROVIDER"])
+
+# The handles routes work with: the client, a database, its write-behind queue
+# (None unless WRITE_BEHIND is on; its flusher starts once the database is connected)
+# and the cache of its user names
+class Mongo:
+    def __init__(self, config, client=None, db=None):
+        self.client = client
+        self.db = db
+        self.write_queue = write_behind.AsyncWriteBehind(config) if config["WRITE_BEHIND"] == "on" else None
+        self.profiles = profile_cache.profile_cache(config)
+
+default_mongo = Mongo(app.config)
+# Test databases by name, in TEST_DATABASES mode
+test_databases = {}
+
+# The request's handles: the server's own, or in test-database mode those of the database the request named
+def current_mongo():
+    return g.get("mongo") or default_mongo
+
+mongo = LocalProxy(current_mongo)
+write_queue = LocalProxy(lambda: current_mongo().write_queue)
+
+# Admission control (admission.py); the limits get their semaphores once the event loop runs
+route_limits = admission.route_limits(app.config, admission.AsyncRouteLimit)
+rate_limits = admission.token_buckets(app.config)
+
+@app.before_serving
+async def connect_mongo():
+    for limit in route_limits.values():
+        limit.start()
+    default_mongo.client = AsyncMongoClient(
+        app.config["MONGO_URI"], event_listeners=[metrics.command_listener],
+        **mongo_options.client_options(app.config)
+    )
+    if app.config["MONGO_DBNAME"]:
+        default_mongo.db = default_mongo.client[app.config["MONGO_DBNAME"]]
+    else:
+        default_mongo.db = default_mongo.client.get_default_database()
+    await indexes.ensure_indexes_async(default_mongo.db)
+    # Open the pool before the server accepts requests
+    await mongo_options.warm_up_async(default_mongo.db, app.config, app.config["MONGO_WARMUP_CONNECTIONS"])
+    if default_mongo.write_queue:
+        default_mongo.write_queue.start(default_mongo.db)
+
+@app.after_serving
+async def close_mongo():
+    # Apply the queued writes while the client is still open
+    for handles in [default_mongo, *test_databases.values()]:
+        if handles.write_queue:
+            await handles.write_queue.close()
+    await default_mongo.client.close()
+
+@app.before_request
+async def start_metrics():
+    metrics.start_request(metrics.route_of(request), request.method)
+
+@app.after_request
+async def finish_metrics(response):
+    response.response = MeasuredBody(response.response, metrics.current_request.get(), response.status_code)
+    return response
+
+# Helper class to record a request's metrics once Quart has sent the body it wraps,
+# so streamed responses are measured end to end
+class MeasuredBody:
+    def __init__(self, body, stats, status_code):
+        self.body = body
+        self.stats = stats
+        self.status_code = status_code
+
+    async def __aenter__(self):
+        return await self.body.__aenter__()
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        try:
+            return await self.body.__aexit__(exc_type, exc_value, tb)
+        finally:
+            metrics.finish_request(self.stats, self.status_code)
+
+# Helper function to identify who a request counts against for rate limiting: the client address,
+# or the X-User-Id header when a trusted proxy sets it (RATE_LIMIT_TRUST_USER_HEADER=on)
+def request_user():
+    if app.config["RATE_LIMIT_TRUST_USER_HEADER"] == "on" and "X-User-Id" in request.headers:
+        return request.headers["X-User-Id"]
+    return request.remote_addr
+
+# Helper function to turn a request away before it runs
+def reject(reason, message, status, retry_after):
+    metrics.REQUESTS_REJECTED.inc(request.method, metrics.route_of(request), reason)
+    response = jsonify({"error": message})
+    response.headers["Retry-After"] = retry_after
+    return response, status
+
+# Take a token from the user's bucket, then a slot of the route's class
+@app.before_request
+async def admit_request():
+    name = admission.route_class(request.endpoint)
+    if not name:
+        return None
+    if rate_limits:
+        wait = rate_limits.take(request_user())
+        if wait:
+            return reject("rate_limit", "Too many requests, retry later", 429, admission.retry_after(wait))
+    limit = route_limits.get(name)
+    if limit:
+        if not await limit.acquire(app.config["ADMISSION_QUEUE_TIMEOUT_MS"] / 1000):
+            return reject("overload", "Server busy, retry later", 503, "1")
+        g.route_limit = limit
+    return None
+
+@app.teardown_request
+async def release_request(exception):
+    limit = g.pop("route_limit", None)
+    if limit:
+        limit.release()
+
+# Helper function to set how the request's dates are rendered (json_provider.date_format)
+@app.before_request
+async def select_date_format():
+    date_format, error = validate_date_format(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    json_provider.date_format.set(date_format)
+    return None
+
+# Test-database mode: switch the request to the test_* database named in X-Test-Database, if any,
+# so every test can work in a database of its own on one server
+async def select_test_database():
+    if "X-Test-Database" not in request.headers:
+        return None
+    name = validate_test_database(request.headers["X-Test-Database"])
+    if not name:
+        return jsonify({"error": "Invalid test database"}), 400
+    if name not in test_databases:
+        handles = Mongo(app.config, default_mongo.client, default_mongo.client[name])
+        test_databases[name] = handles
+        await indexes.ensure_indexes_async(handles.db)
+        if handles.write_queue:
+            handles.write_queue.start(handles.db)
+    g.mongo = test_databases[name]
+    return None
+
+if app.config["TEST_DATABASES"] == "on":
+    app.before_request(select_test_database)
+
+# Drop the request's test database, closing its write-behind queue first
+async def drop_test_database():
+    handles = test_databases.pop(g.mongo.db.name, g.mongo)
+    if handles.write_queue:
+        await handles.write_queue.close()
+    await handles.client.drop_database(handles.db.name)
+
+@app.route('/metrics', methods=['GET'])
+async def get_metrics():
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+def timeline_mode():
+    return app.config["FEED_MODE"] == "timeline"
+
+# Helper function to check whether a user exists without loading it
+async def user_exists(user_id):
+    return await mongo.db.users.count_documents({"_id": user_id}, limit=1) > 0
+
+# Helper function to check whether a post exists without loading it
+async def post_exists(post_id):
+    return await mongo.db.posts.count_documents({"_id": post_id}, limit=1) > 0
+
+# Helper function to answer a write to a post that is not in `posts`; archived posts are read-only
+async def missing_post(post_id):
+    if await archive.archived_ids_async(mongo.db, [post_id]):
+        return jsonify({"error": "Post is archived"}), 409
+    return jsonify({"error": "Post not found"}), 404
+
+# Helper function to get the database handle for a read route ("feed", "likes" or "comments"),
+# which carries the route's read preference
+def read_db(route):
+    return mongo_options.route_database(mongo.db, app.config, route)
+
+# Helper function to fetch many users' names, keyed by _id: from the profile cache,
+# and the rest with a single query
+async def get_users_by_id(user_ids, db=None):
+    if db is None:
+        db = mongo.db
+    profiles = mongo.profiles
+    users, missing = profiles.get_many(user_ids)
+    metrics.PROFILE_CACHE_LOOKUPS.inc("hit", amount=len(users))
+    if missing:
+        metrics.PROFILE_CACHE_LOOKUPS.inc("miss", amount=len(missing))
+        generation = profiles.generation
+        found = await db.users.find(
+            {"_id": {"$in": missing}},
+            {"firstName": 1, "lastName": 1}
+        ).to_list(None)
+        profiles.put_many(found, generation)
+        users.update((user["_id"], user) for user in found)
+    return users
+
+# Helper function to check whether the client asked for a streamed NDJSON response
+def wants_ndjson():
+    best = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+    return best == "application/x-ndjson"
+
+# Helper function to stream records from an async generator, one JSON document per line
+def ndjson_response(records):
+    @stream_with_context
+    async def generate():
+        async for record in records:
+            yield (app.json.dumps(record) + "\n").encode()
+    return Response(generate(), mimetype="application/x-ndjson")
+
+# Helper function to answer a conditional GET: a 304 response if the client's copy matches `etag`
+def not_modified(etag):
+    if request.if_none_match.contains(etag):
+        response = Response("", status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+# Helper function to answer a write that was not queued because the write-behind queue is full
+def queue_full():
+    response = jsonify({"error": "Too many pending writes, retry later"})
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+# Helper function for read-your-writes in write-behind mode: apply the reader's queued writes first.
+# The reader is the X-User-Id header, or `default_user_id` for routes that name the reader.
+async def flush_reader_writes(default_user_id=None):
+    if not write_queue:
+        return
+    user_id = default_user_id
+    if "X-User-Id" in request.headers:
+        user_id = validate_object_id(request.headers["X-User-Id"])
+    if user_id:
+        await write_queue.flush_user(user_id)
+
+async def no_records():
+    return
+    yield
+
+# Create a user profile
+@app.route('/users', methods=['POST'])
+async def create_user():
+    user, error = build_user(await request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+
+    result = await mongo.db.users.insert_one(user)
+    return jsonify({"message": "User created", "userId": str(result.inserted_id)}), 201
+
+# Get several users' profiles with one query: GET /users?ids=<id>,<id>,...
+@app.route('/users', methods=['GET'])
+async def get_users():
+    user_ids, error = build_ids(request.args, app.config["MULTI_GET_MAX_IDS"])
+    if error:
+        return jsonify({"error": error}), 400
+
+    users = await mongo.db.users.find({"_id": {"$in": user_ids}}, multi_get.USER_FIELDS).to_list(None)
+    return jsonify(multi_get.in_order(user_ids, users, multi_get.user_record)), 200
+
+# Update a user profile; a new name reaches every server's cache and the ETags that show it
+@app.route('/users/<user_id>', methods=['PATCH'])
+async def update_user(user_id):
+    user_id = validate_object_id(user_id)
+    if not user_id:
+        return jsonify({"error": "Invalid userId"}), 400
+
+    update, error = build_user_update(await request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+
+    result = await mongo.db.users.update_one({"_id": user_id}, {"$set": update})
+    mongo.profiles.invalidate([user_id])
+    if not result.matched_count:
+        return jsonify({"error": "User not found"}), 404
+    if profile_cache.NAME_FIELDS & update.keys():
+        # The name shows in the followers' feeds and in the likes and comments lists of the posts
+        # the user liked or commented
+        await asyncio.gather(
+            versions.bump_async(mongo.db.users, [user_id], "postsVersion"),
+            versions.bump_names_async(mongo.db, user_id, datetime.utcnow())
+        )
+    return jsonify({"message": "User updated"}), 200
+
+# Get several posts with one query: GET /posts?ids=<id>,<id>,...
+@app.route('/posts', methods=['GET'])
+async def get_posts():
+    post_ids, error = build_ids(request.args, app.config["MULTI_GET_MAX_IDS"])
+    if error:
+        return jsonify({"error": error}), 400
+
+    posts = await mongo.db.posts.find({"_id": {"$in": post_ids}}, multi_get.POST_FIELDS).to_list(None)
+    missing = multi_get.missing_ids(post_ids, posts)
+    if missing:
+        posts += await mongo.db.posts_archive.find({"_id": {"$in": missing}}, multi_get.POST_FIELDS).to_list(None)
+    return jsonify(multi_get.in_order(post_ids, posts, multi_get.post_record)), 200
+
+# Create a post
+@app.route('/posts', methods=['POST'])
+async def create_post():
+    post, error = build_post(await request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+
+    result = await mongo.db.posts.insert_one(post)
+    if timeline_mode():
+        await timeline.fan_out_post_async(
+            mongo.db, post,
+            app.config["TIMELINE_MAX_SIZE"], app.config["FANOUT_FOLLOWER_LIMIT"]
+        )
+    await versions.bump_async(mongo.db.users, [post["author"]], "postsVersion")
+    return jsonify({"message": "Post created", "postId": str(result.inserted_id)}), 201
+
+# Add a comment to a post
+@app.route('/posts/<post_id>/comments', methods=['POST'])
+async def add_comment(post_id):
+    post_id = validate_object_id(post_id)
+    if not post_id:
+        return jsonify({"error": "Invalid postId"}), 400
+
+    comment, error = build_comment(await request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+
+    if write_queue:
+        # Write-behind: check the post now, append the comment with the next flush
+        post = await mongo.db.posts.find_one({"_id": post_id}, {"author": 1})
+        if not post:
+            return await missing_post(post_id)
+        try:
+            await write_queue.comment(post_id, post["author"], comment)
+        except write_behind.QueueFull:
+            return queue_full()
+        return jsonify({"message": "Comment accepted"}), 202
+
+    author = await comments.add_comment_async(
+        mongo.db, post_id, comment,
+        app.config["COMMENT_BUCKET_SIZE"], app.config["COMMENT_PREVIEW_SIZE"]
+    )
+    if not author:
+        return await missing_post(post_id)
+    await versions.bump_async(mongo.db.users, [author], "postsVersion")
+    return jsonify({"message": "Comment added"}), 200
+
+# Add a like to a post
+@app.route('/posts/<post_id>/likes', methods=['POST'])
+async def add_like(post_id):
+    post_id = validate_object_id(post_id)
+    if not post_id:
+        return jsonify({"error": "Invalid postId"}), 400
+
+    user_id, error = validate_liker(await request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+
+    if write_queue:
+        return await queue_like(post_id, user_id)
+
+    # Single conditional update: only matches if the user has not liked the post yet
+    post = await mongo.db.posts.find_one_and_update(
+        {"_id": post_id, "likes": {"$ne": user_id}},
+        {"$push": {"likes": user_id}, "$inc": {"likeCount": 1, "likesVersion": 1}},
+        projection={"author": 1}
+    )
+    if not post:
+        if not await post_exists(post_id):
+            return await missing_post(post_id)
+        return jsonify({"error": "User already liked this post"}), 400
+    await versions.bump_async(mongo.db.users, [post["author"]], "postsVersion")
+    return jsonify({"message": "Like added"}), 200
+
+# Check a like and queue it for the next write-behind flush
+async def queue_like(post_id, user_id):
+    post = await mongo.db.posts.find_one({"_id": post_id, "likes": {"$ne": user_id}}, {"author": 1})
+    if not post:
+        if not await post_exists(post_id):
+            return await missing_post(post_id)
+        return jsonify({"error": "User already liked this post"}), 400
+    try:
+        queued = await write_queue.like(post_id, post["author"], user_id)
+    except write_behind.QueueFull:
+        return queue_full()
+    if not queued:
+        return jsonify({"error": "User already liked this post"}), 400
+    return jsonify({"message": "Like accepted"}), 202
+
+# Remove a like from a post
+@app.route('/posts/<post_id>/unlike', methods=['POST'])
+async def remove_like(post_id):
+    post_id = validate_object_id(post_id)
+    if not post_id:
+        return jsonify({"error": "Invalid postId"}), 400
+
+    user_id, error = validate_liker(await request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+
+    # A like of this user's may still be queued; apply it before removing it
+    await flush_reader_writes(user_id)
+    post = await mongo.db.posts.find_one_and_update(
+        {"_id": post_id, "likes": user_id},
+        {"$pull": {"likes": user_id}, "$inc": {"likeCount": -1, "likesVersion": 1}},
+        projection={"author": 1}
+    )
+    if not post:
+        if not await post_exists(post_id):
+            return await missing_post(post_id)
+        return jsonify({"error": "User has not liked this post"}), 400
+    await versions.bump_async(mongo.db.users, [post["author"]], "postsVersion")
+    return jsonify({"message": "Like removed"}), 200
+
+# Follow a user
+@app.route('/users/<user_id>/follow', methods=['POST'])
+async def follow_user(user_id):
+    user_id = validate_object_id(user_id)
+    if not user_id:
+        return jsonify({"error": "Invalid userId"}), 400
+
+    follow_id, error = validate_followee(await request.get_json(), 'followId')
+    if error:
+        return jsonify({"error": error}), 400
+
+    if not await user_exists(user_id):
+        return jsonify({"error": "User not found"}), 404
+
+    if not await follows.follow_async(mongo.db, user_id, follow_id):
+        return jsonify({"message": "Already following this user"}), 400
+
+    if timeline_mode():
+        await timeline.backfill_timeline_async(mongo.db, user_id, follow_id, app.config["TIMELINE_MAX_SIZE"])
+    await versions.bump_async(mongo.db.users, [user_id], "followVersion")
+    return jsonify({"message": "Now following the user"}), 200
+
+# Unfollow a user
+@app.route('/users/<user_id>/unfollow', methods=['POST'])
+async def unfollow_user(user_id):
+    user_id = validate_object_id(user_id)
+    if not user_id:
+        return jsonify({"error": "Invalid userId"}), 400
+
+    unfollow_id, error = validate_followee(await request.get_json(), 'unfollowId')
+    if error:
+        return jsonify({"error": error}), 400
+
+    if not await user_exists(user_id):
+        return jsonify({"error": "User not found"}), 404
+
+    if not await follows.unfollow_async(mongo.db, user_id, unfollow_id):
+        return jsonify({"message": "Not following this user"}), 400
+
+    if timeline_mode():
+        await timeline.prune_timeline_async(mongo.db, user_id, unfollow_id)
+    await versions.bump_async(mongo.db.users, [user_id], "followVersion")
+    return jsonify({"message": "Unfollowed the user"}), 200
+
+# Get a page of a user's followers or of the users they follow, newest first
+@app.route('/users/<user_id>/followers', methods=['GET'], defaults={"side": "followers"})
+@app.route('/users/<user_id>/following', methods=['GET'], defaults={"side": "following"})
+async def get_follow_list(user_id, side):
+    user_id = validate_object_id(user_id)
+    if not user_id:
+        return jsonify({"error": "Invalid userId"}), 400
+
+    query, error = build_follow_list_query(request.args, app.config["FOLLOWS_MAX_PAGE_SIZE"])
+    if error:
+        return jsonify({"error": error}), 400
+    after, limit = query
+
+    user, edges = await asyncio.gather(
+        mongo.db.users.find_one({"_id": user_id}, {"followerCount": 1, "followingCount": 1}),
+        follows.read_page_async(mongo.db, user_id, side, after, limit + 1)
+    )
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+
+    edges, next_cursor = split_page(edges, limit, follows.edge_cursor)
+    # Resolve the listed users' names in one query
+    users = await get_users_by_id({edge[follows.SIDES[side][1]] for edge in edges})
+    response = jsonify(follows.follow_records(edges, side, users))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    response.headers["X-Total-Count"] = str(follows.total_count(user, side))
+    return response, 200
+
+# Get likes for a post
+@app.route('/posts/<post_id>/likes', methods=['GET'])
+async def get_post_likes(post_id):
+    post_id = validate_object_id(post_id)
+    if not post_id:
+        return jsonify({"error": "Invalid postId"}), 400
+
+    await flush_reader_writes()
+    db = read_db("likes")
+    if wants_ndjson():
+        batch_size = app.config["STREAM_BATCH_SIZE"]
+        if await post_exists(post_id):
+            return ndjson_response(iter_streamed_likers(db, post_id, batch_size)), 200
+        # An archived post's likes are stored compressed with its comments, so they are read whole
+        archived = await archive.find_post_async(db, post_id)
+        if not archived:
+            return jsonify({"error": "Post not found"}), 404
+        return ndjson_response(iter_likers(db, archived.get('likes', []), batch_size)), 200
+
+    post = await db.posts.find_one({"_id": post_id}, {"likes": 1, "likesVersion": 1, "namesChangedAt": 1})
+    if not post:
+        post = await archive.find_post_async(db, post_id)
+        if not post:
+            return jsonify({"error": "Post not found"}), 404
+
+    likes = post.get('likes', [])
+    etag = versions.likes_etag(post)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    if profile_cache.names_stale(post, app.config["PROFILE_CACHE_TTL_S"]):
+        # A liker was renamed lately, maybe in another process, so no cached name is trusted
+        mongo.profiles.invalidate(likes)
+    response = jsonify([liker async for liker in iter_likers(db, likes, max(len(likes), 1))])
+    response.set_etag(etag)
+    return response, 200
+
+# Resolve likers in batches of `batch_size` users, keeping the order of the likes array
+async def iter_likers(db, likes, batch_size):
+    for chunk in bulk.chunked(likes, batch_size):
+        for liker in likers.liker_records(chunk, await get_users_by_id(chunk, db)):
+            yield liker
+
+# Stream a post's likers from the server-side join, one cursor batch at a time
+async def iter_streamed_likers(db, post_id, batch_size):
+    cursor = await db.posts.aggregate(likers.stream_pipeline(post_id), batchSize=batch_size)
+    async for liker in cursor:
+        yield liker
+
+# Get a page of comments for a post
+@app.route('/posts/<post_id>/comments', methods=['GET'])
+async def get_posts_comments(post_id):
+    try:
+        # Validate the post ID
+        post_id = ObjectId(post_id)
+        stream = wants_ndjson()
+        bucket_size = app.config["COMMENT_BUCKET_SIZE"]
+        query, error = build_comments_query(request.args, stream, bucket_size, app.config["COMMENTS_MAX_PAGE_SIZE"])
+        if error:
+            return jsonify({"error": error}), 400
+        cursor, limit = query
+
+        await flush_reader_writes()
+        db = read_db("comments")
+        if stream:
+            if not await post_exists(post_id):
+                archived = await archive.find_post_async(db, post_id)
+                if not archived:
+                    return jsonify({"error": "Post not found"}), 404
+                return ndjson_response(iter_archived_comments(db, archived, cursor, limit)), 200
+            return ndjson_response(iter_comments(db, post_id, cursor, limit)), 200
+
+        # The post (and its version) is read before the buckets, so the ETag never claims newer content
+        post = await db.posts.find_one({"_id": post_id}, {"commentCount": 1, "commentsVersion": 1, "namesChangedAt": 1})
+        archived = None
+        if not post:
+            # An archived post carries all of its comments
+            post = archived = await archive.find_post_async(db, post_id)
+            if not archived:
+                return jsonify({"error": "Post not found"}), 404
+
+        etag = versions.comments_etag(post)
+        cached = not_modified(etag)
+        if cached:
+            return cached
+
+        if archived:
+            page, next_cursor = comments.read_archived_comments(archived, cursor, limit, bucket_size)
+        else:
+            page, next_cursor = await comments.read_comments_async(db, post_id, cursor, limit, bucket_size)
+        if profile_cache.names_stale(post, app.config["PROFILE_CACHE_TTL_S"]):
+            # A commenter was renamed lately, maybe in another process, so no cached name is trusted
+            mongo.profiles.invalidate({comment["author"] for comment in page})
+        response = jsonify(await comment_details(db, page))
+        response.set_etag(etag)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = encode_bucket_cursor(*next_cursor)
+        return response, 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Attach author names to a page of comments, resolving all authors in one query
+async def comment_details(db, page):
+    return comments.comment_records(page, await get_users_by_id({comment["author"] for comment in page}, db))
+
+# Stream comments bucket by bucket to the end, or up to `limit` if given
+async def iter_comments(db, post_id, cursor, limit):
+    pages = comments.iter_comment_pages_async(
+        db, post_id, cursor, app.config["COMMENT_BUCKET_SIZE"], app.config["STREAM_BATCH_SIZE"]
+    )
+    sent = 0
+    async for page in pages:
+        for record in await comment_details(db, page):
+            if limit is not None and sent >= limit:
+                return
+            sent += 1
+            yield record
+
+# Stream an archived post's comments from the (seq, offset) `cursor`, up to `limit` if given
+async def iter_archived_comments(db, post, cursor, limit):
+    page, _ = comments.read_archived_comments(post, cursor, limit, app.config["COMMENT_BUCKET_SIZE"])
+    for record in await comment_details(db, page):
+        yield record
+
+@app.route('/users/<user_id>/feed', methods=['GET'])
+async def get_feed(user_id):
+    user_id = validate_object_id(user_id)
+    if not user_id:
+        return jsonify({"error": "Invalid userId"}), 400
+
+    stream = wants_ndjson()
+    query, error = build_feed_query(request.args, stream, app.config["FEED_MAX_PAGE_SIZE"])
+    if error:
+        return jsonify({"error": error}), 400
+    after, skip, limit = query
+
+    await flush_reader_writes(user_id)
+    db = read_db("feed")
+    # The user's follow version and the follow set read are independent, so run them together
+    user, following = await asyncio.gather(
+        db.users.find_one({"_id": user_id}, {"followVersion": 1}),
+        follows.following_ids_async(db, user_id)
+    )
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+
+    etag = None
+    if not stream:
+        # The versions are read before the posts, so the ETag never claims newer content than is sent
+        authors = await db.users.find(*versions.authors_query(following)).to_list(None) if following else []
+        etag = versions.feed_etag(user, authors)
+        cached = not_modified(etag)
+        if cached:
+            return cached
+    if not following:
+        # No following, return an empty feed
+        if stream:
+            return ndjson_response(no_records()), 200
+        response = jsonify([])
+        response.set_etag(etag)
+        return response, 200
+
+    # Fetch one extra post to know whether there is a next page
+    if timeline_mode():
+        fetch = limit + 1 if limit else app.config["TIMELINE_MAX_SIZE"]
+        post_ids = await timeline.read_timeline_async(db, user_id, following, skip, fetch, after)
+        pipeline = feed.timeline_stages(post_ids)
+    else:
+        fetch = limit + 1 if limit else None
+        post_ids = None
+        pipeline = feed.pull_stages(following, after, skip, fetch)
+    details = feed.detail_stages(app.config["COMMENT_PREVIEW_SIZE"], json_provider.date_format.get())
+
+    # The page continues in the archive once the posts in `posts` run out
+    async def archived_posts(count):
+        hot_total = 0
+        if post_ids is None and skip and not count:
+            hot_total = await db.posts.count_documents(feed.pull_match(following, after))
+        stages = feed.archive_stages(following, post_ids, after, skip, fetch, count, hot_total)
+        if stages is None:
+            return None
+        return await db.posts_archive.aggregate(stages + details, batchSize=app.config["STREAM_BATCH_SIZE"])
+
+    cursor = await db.posts.aggregate(pipeline + details, batchSize=app.config["STREAM_BATCH_SIZE"])
+    if stream:
+        async def records():
+            sent = 0
+            async for post in cursor:
+                if limit is not None and sent >= limit:
+                    return
+                sent += 1
+                yield post
+            archived = await archived_posts(sent)
+            if archived is None:
+                return
+            async for post in archived:
+                if limit is not None and sent >= limit:
+                    return
+                sent += 1
+                yield post
+        return ndjson_response(records()), 200
+
+    posts = await cursor.to_list(None)
+    archived = await archived_posts(len(posts))
+    if archived is not None:
+        posts += await archived.to_list(None)
+    posts, next_cursor = split_page(posts, limit, feed.next_cursor)
+
+    # The pipeline already emitted the response shape, so the posts are serialized as they are
+    response = jsonify(posts)
+    response.set_etag(etag)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response, 200
+
+# Search post content and comment text, best match first
+@app.route('/search', methods=['GET'])
+async def search_posts():
+    terms, error = build_search(request.args, app.config["SEARCH_MAX_PAGE_SIZE"])
+    if error:
+        return jsonify({"error": error}), 400
+    query, author_id, after, limit = terms
+
+    # Fetch one extra post to know whether there is a next page
+    pipeline = search.search_stages(
+        query, author_id, after, limit + 1, app.config["COMMENT_PREVIEW_SIZE"], json_provider.date_format.get()
+    )
+    cursor = await read_db("search").posts.aggregate(pipeline)
+    posts, next_cursor = split_page(await cursor.to_list(None), limit, search.next_cursor)
+
+    response = jsonify(posts)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response, 200
+
+# Parse a bulk request body; returns (items, error)
+async def read_bulk_items():
+    body = await request.get_data(as_text=True)
+    return bulk.parse_items(request.mimetype, body, app.config["BULK_MAX_ITEMS"], app.json.loads)
+
+# Bulk-create users
+@app.route('/bulk/users', methods=['POST'])
+async def bulk_create_users():
+    items, error = await read_bulk_items()
+    if error:
+        return jsonify({"error": error}), 400
+
+    results, users = bulk.validate_items(items, build_user)
+    failed = await bulk.insert_documents_async(mongo.db.users, users, app.config["BULK_CHUNK_SIZE"])
+    user_ids = {index: str(user["_id"]) for index, user in users}
+    bulk.record_writes(user_ids, failed, results, lambda index: {
+        "index": index, "status": 201, "userId": user_ids[index]
+    })
+    return jsonify(bulk.summarize(results)), 200
+
+# Bulk-create posts
+@app.route('/bulk/posts', methods=['POST'])
+async def bulk_create_posts():
+    items, error = await read_bulk_items()
+    if error:
+        return jsonify({"error": error}), 400
+
+    results, posts = bulk.validate_items(items, build_post)
+    failed = await bulk.insert_documents_async(mongo.db.posts, posts, app.config["BULK_CHUNK_SIZE"])
+    posts = dict(posts)
+    created = bulk.record_writes(posts, failed, results, lambda index: {
+        "index": index, "status": 201, "postId": str(posts[index]["_id"])
+    })
+    if timeline_mode():
+        for index in created:
+            await timeline.fan_out_post_async(
+                mongo.db, posts[index],
+                app.config["TIMELINE_MAX_SIZE"], app.config["FANOUT_FOLLOWER_LIMIT"]
+            )
+    await versions.bump_async(mongo.db.users, [posts[index]["author"] for index in created], "postsVersion")
+    return jsonify(bulk.summarize(results)), 200
+
+# Bulk-follow users; items are {"userId": ..., "followId": ...}
+@app.route('/bulk/follows', methods=['POST'])
+async def bulk_follow_users():
+    items, error = await read_bulk_items()
+    if error:
+        return jsonify({"error": error}), 400
+
+    results, follow_items = bulk.validate_items(items, build_follow)
+    for chunk in bulk.chunked(follow_items, app.config["BULK_CHUNK_SIZE"]):
+        users = await mongo.db.users.find(*bulk.follows_query(chunk)).to_list(None)
+        ops = bulk.plan_follows(chunk, users, results)
+        failed, upserted = await bulk.upsert_operations_async(mongo.db.follows, ops, len(chunk))
+        followed = bulk.record_upserts(
+            ops, failed, upserted, results,
+            lambda index: {"index": index, "status": 200}, "Already following this user"
+        )
+        pairs = dict(chunk)
+        if followed:
+            await mongo.db.users.bulk_write(
+                follows.counter_updates([pairs[index] for index in followed], 1), ordered=False
+            )
+        if timeline_mode():
+            await asyncio.gather(*(
+                timeline.backfill_timeline_async(mongo.db, *pairs[index], app.config["TIMELINE_MAX_SIZE"])
+                for index in followed
+            ))
+        await versions.bump_async(mongo.db.users, [pairs[index][0] for index in followed], "followVersion")
+    return jsonify(bulk.summarize(results)), 200
+
+# Bulk-like posts; items are {"postId": ..., "userId": ...}
+@app.route('/bulk/likes', methods=['POST'])
+async def bulk_add_likes():
+    items, error = await read_bulk_items()
+    if error:
+        return jsonify({"error": error}), 400
+
+    results, likes = bulk.validate_items(items, build_like)
+    for chunk in bulk.chunked(likes, app.config["BULK_CHUNK_SIZE"]):
+        cursor = await mongo.db.posts.aggregate(bulk.likes_pipeline(chunk))
+        posts = await cursor.to_list(None)
+        missing = {post_id for _, (post_id, _) in chunk} - {post["_id"] for post in posts}
+        archived = await archive.archived_ids_async(mongo.db, missing) if missing else ()
+        ops = bulk.plan_likes(chunk, posts, results, archived)
+        failed = await bulk.write_operations_async(mongo.db.posts, ops, len(chunk))
+        liked = bulk.record_writes(dict(ops), failed, results, lambda index: {"index": index, "status": 200})
+        authors = {post["_id"]: post["author"] for post in posts}
+        pairs = dict(chunk)
+        await versions.bump_async(mongo.db.users, [authors[pairs[index][0]] for index in liked], "postsVersion")
+    return jsonify(bulk.summarize(results)), 200
+
+# Cleanup function to clear database collections
+@app.route('/cleanup', methods=['POST'])
+async def cleanup_database():
+    try:
+        # A test database is dropped as a whole
+        if "mongo" in g:
+            await drop_test_database()
+            return jsonify({"status": "success", "message": "Test database dropped."}), 200
+
+        await asyncio.gather(*(
+            mongo.db[collection].delete_many({})
+            for collection in ('users', 'posts', 'posts_archive', 'follows', 'timelines', 'comment_buckets')
+        ))
+        mongo.profiles.clear()
+        return jsonify({"status": "success", "message": "Database cleanup successful. Collections cleared."}), 200
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Error during database cleanup: {e}"}), 500
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5000)
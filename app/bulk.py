@@ -0,0 +1,228 @@
+import json
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+import follows
+
+DUPLICATE_KEY = 11000
+
+# Helpers for the bulk ingestion routes.
+#
+# Bulk routes accept a JSON array or an NDJSON body (Content-Type: application/x-ndjson),
+# validate every item with the same rules as the single-item routes and write the valid
+# ones with unordered batch writes in bounded chunks. Each item gets its own result:
+#   {"index": 3, "status": 201, "userId": "..."} or {"index": 4, "status": 400, "error": "..."}
+# Everything here except the write helpers is driver-agnostic, so app.py and asgi_app.py share it.
+
+
+# Parse a request body with `loads` (the app's JSON provider); returns (items, error)
+def parse_items(mimetype, body, max_items, loads=json.loads):
+    if mimetype == "application/x-ndjson":
+        items = []
+        for number, line in enumerate(body.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                items.append(loads(line))
+            except ValueError:
+                return None, f"Invalid JSON on line {number}"
+    else:
+        try:
+            items = loads(body)
+        except ValueError:
+            items = None
+        if not isinstance(items, list):
+            return None, "Expected a JSON array or an NDJSON body"
+
+    if len(items) > max_items:
+        return None, f"Too many items (max {max_items})"
+    return items, None
+
+
+def chunked(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def error_result(index, error, status=400):
+    return {"index": index, "status": status, "error": error}
+
+
+# Run `build(item)` -> (value, error) over all items.
+# Returns the results list (with validation errors filled in) and the valid (index, value) pairs.
+def validate_items(items, build):
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            value, error = None, "Invalid item"
+        else:
+            value, error = build(item)
+        if error:
+            results[index] = error_result(index, error)
+        else:
+            valid.append((index, value))
+    return results, valid
+
+
+# Read for one chunk of (index, (userId, followId)) pairs: which of the chunk's users exist
+def follows_query(chunk):
+    return {"_id": {"$in": list({user_id for _, (user_id, _) in chunk})}}, {"_id": 1}
+
+
+# Turn a chunk of follows into edge upserts, recording missing users and repeats within the chunk.
+# Follows that already exist in the database are found from the upsert results.
+def plan_follows(chunk, users, results):
+    existing = {user["_id"] for user in users}
+    seen = set()
+    ops = []
+    for index, (user_id, follow_id) in chunk:
+        if user_id not in existing:
+            results[index] = error_result(index, "User not found", 404)
+        elif (user_id, follow_id) in seen:
+            results[index] = error_result(index, "Already following this user")
+        else:
+            seen.add((user_id, follow_id))
+            ops.append((index, follows.edge_upsert(user_id, follow_id)))
+    return ops
+
+
+# Aggregation for one chunk of (index, (postId, userId)) pairs: which of the chunk's users
+# already liked each post
+def likes_pipeline(chunk):
+    return [
+        {"$match": {"_id": {"$in": list({post_id for _, (post_id, _) in chunk})}}},
+        {"$project": {"author": 1, "liked": {"$filter": {
+            "input": "$likes",
+            "as": "like",
+            "cond": {"$in": ["$$like", list({user_id for _, (_, user_id) in chunk})]}
+        }}}}
+    ]
+
+
+# Turn a chunk of likes into conditional updates, recording missing or `archived` posts and duplicate likes
+def plan_likes(chunk, posts, results, archived=()):
+    liked = {post["_id"]: set(post["liked"]) for post in posts}
+    ops = []
+    for index, (post_id, user_id) in chunk:
+        if post_id in archived:
+            results[index] = error_result(index, "Post is archived", 409)
+        elif post_id not in liked:
+            results[index] = error_result(index, "Post not found", 404)
+        elif user_id in liked[post_id]:
+            results[index] = error_result(index, "User already liked this post")
+        else:
+            liked[post_id].add(user_id)
+            # Same conditional update as add_like, so concurrent likes still count exactly once
+            ops.append((index, UpdateOne(
+                {"_id": post_id, "likes": {"$ne": user_id}},
+                {"$push": {"likes": user_id}, "$inc": {"likeCount": 1, "likesVersion": 1}}
+            )))
+    return ops
+
+
+# Fill in results for written items; returns the indexes that succeeded
+def record_writes(indexes, failed, results, make_result):
+    succeeded = []
+    for index in indexes:
+        if index in failed:
+            results[index] = error_result(index, failed[index], 500)
+        else:
+            results[index] = make_result(index)
+            succeeded.append(index)
+    return succeeded
+
+
+# Fill in results for upserts: written items that inserted nothing already existed.
+# Returns the indexes that inserted a document.
+def record_upserts(indexed_ops, failed, upserted, results, make_result, exists_error):
+    written = []
+    for index, _ in indexed_ops:
+        if index in failed or index in upserted:
+            written.append(index)
+        else:
+            results[index] = error_result(index, exists_error)
+    return record_writes(written, failed, results, make_result)
+
+
+def _write_errors(exc, chunk, ignore_codes=()):
+    return {
+        chunk[error["index"]][0]: error["errmsg"]
+        for error in exc.details["writeErrors"] if error.get("code") not in ignore_codes
+    }
+
+
+# Insert (index, document) pairs; returns {index: error message} for failed inserts
+def insert_documents(collection, indexed_docs, chunk_size):
+    failed = {}
+    for chunk in chunked(indexed_docs, chunk_size):
+        try:
+            collection.insert_many([doc for _, doc in chunk], ordered=False)
+        except BulkWriteError as exc:
+            failed.update(_write_errors(exc, chunk))
+    return failed
+
+
+# Apply (index, write operation) pairs; returns {index: error message} for failed writes
+def write_operations(collection, indexed_ops, chunk_size):
+    failed = {}
+    for chunk in chunked(indexed_ops, chunk_size):
+        try:
+            collection.bulk_write([op for _, op in chunk], ordered=False)
+        except BulkWriteError as exc:
+            failed.update(_write_errors(exc, chunk))
+    return failed
+
+
+# Apply (index, upsert) pairs; returns ({index: error message}, indexes that inserted a document).
+# Duplicate key errors mean a concurrent writer inserted the same document, so they count as existing.
+def upsert_operations(collection, indexed_ops, chunk_size):
+    failed, upserted = {}, set()
+    for chunk in chunked(indexed_ops, chunk_size):
+        try:
+            result = collection.bulk_write([op for _, op in chunk], ordered=False)
+            positions = result.upserted_ids
+        except BulkWriteError as exc:
+            failed.update(_write_errors(exc, chunk, ignore_codes=(DUPLICATE_KEY,)))
+            positions = [item["index"] for item in exc.details["upserted"]]
+        upserted.update(chunk[position][0] for position in positions)
+    return failed, upserted
+
+
+async def insert_documents_async(collection, indexed_docs, chunk_size):
+    failed = {}
+    for chunk in chunked(indexed_docs, chunk_size):
+        try:
+            await collection.insert_many([doc for _, doc in chunk], ordered=False)
+        except BulkWriteError as exc:
+            failed.update(_write_errors(exc, chunk))
+    return failed
+
+
+async def write_operations_async(collection, indexed_ops, chunk_size):
+    failed = {}
+    for chunk in chunked(indexed_ops, chunk_size):
+        try:
+            await collection.bulk_write([op for _, op in chunk], ordered=False)
+        except BulkWriteError as exc:
+            failed.update(_write_errors(exc, chunk))
+    return failed
+
+
+async def upsert_operations_async(collection, indexed_ops, chunk_size):
+    failed, upserted = {}, set()
+    for chunk in chunked(indexed_ops, chunk_size):
+        try:
+            result = await collection.bulk_write([op for _, op in chunk], ordered=False)
+            positions = result.upserted_ids
+        except BulkWriteError as exc:
+            failed.update(_write_errors(exc, chunk, ignore_codes=(DUPLICATE_KEY,)))
+            positions = [item["index"] for item in exc.details["upserted"]]
+        upserted.update(chunk[position][0] for position in positions)
+    return failed, upserted
+
+
+def summarize(results):
+    succeeded = sum(1 for result in results if result["status"] < 400)
+    return {"results": results, "succeeded": succeeded, "failed": len(results) - succeeded}
@@ -0,0 +1,245 @@
+from itertools import groupby
+
+from pymongo import DeleteMany, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import PyMongoError
+
+import versions
+
+# Bucketed comment storage.
+#
+# Comments live in the `comment_buckets` collection in fixed-size buckets per post:
+#   {"post": <postId>, "author": <post's author>, "seq": <bucket number>, "count": n, "comments": [...]}
+# A bucket carries its post's author so that searches by author filter buckets without loading posts.
+# The post itself only keeps `commentCount` and a short `commentPreview` of the
+# newest comments, so post documents and feed payloads stay small.
+# A comment's position in the post's counter picks its bucket, but a rolled back write
+# can leave a bucket short, so readers page with (seq, offset) cursors into the stored arrays.
+# Posts from before the buckets embed a `comments` array; migrate_embedded() moves it.
+# The `_async` functions are the same operations for the async driver used by asgi_app.py.
+
+
+def _counter_update(new_comments, preview_size):
+    return {
+        "$inc": {"commentCount": len(new_comments)},
+        "$push": {"commentPreview": {"$each": new_comments, "$slice": -preview_size}}
+    }
+
+
+# One upsert per bucket the comments fall into, given the post's author and the position of the first one
+def _bucket_upserts(post_id, author, first_position, new_comments, bucket_size):
+    positions = enumerate(new_comments, first_position)
+    updates = []
+    for seq, group in groupby(positions, key=lambda item: item[0] // bucket_size):
+        bucket_comments = [comment for _, comment in group]
+        updates.append(UpdateOne(
+            {"post": post_id, "seq": seq},
+            {
+                "$push": {"comments": {"$each": bucket_comments}},
+                "$inc": {"count": len(bucket_comments)},
+                "$set": {"author": author}
+            },
+            upsert=True
+        ))
+    return updates
+
+
+# Replace a post's buckets with `all_comments`, in order
+def _bucket_rewrite(post_id, author, all_comments, bucket_size):
+    ops = []
+    for seq, start in enumerate(range(0, len(all_comments), bucket_size)):
+        chunk = all_comments[start:start + bucket_size]
+        ops.append(ReplaceOne(
+            {"post": post_id, "seq": seq},
+            {"post": post_id, "author": author, "seq": seq, "count": len(chunk), "comments": chunk},
+            upsert=True
+        ))
+    ops.append(DeleteMany({"post": post_id, "seq": {"$gte": len(ops)}}))
+    return ops
+
+
+# Undo the counter update of comments whose bucket write failed, so the count matches the stored comments
+def _counter_rollback(new_comments):
+    return {
+        "$inc": {"commentCount": -len(new_comments)},
+        "$pull": {"commentPreview": {"$in": new_comments}}
+    }
+
+
+def _page_query(post_id, seq):
+    return {"post": post_id, "seq": {"$gte": seq}}, {"seq": 1, "comments": 1}
+
+
+# Buckets to fetch per round trip for `limit` comments, plus one to tell whether more follow
+def _page_batch_size(limit, bucket_size):
+    return limit // bucket_size + 2
+
+
+# Add comments of `bucket` from `offset` to `page` until it holds `limit`.
+# Returns the cursor of the first comment that did not fit, or None if all fit.
+def _fill(page, bucket, offset, limit):
+    rest = bucket["comments"][offset:]
+    room = limit - len(page)
+    page.extend(rest[:room])
+    if len(rest) > room:
+        return bucket["seq"], offset + room
+    return None
+
+
+# Response records of a page of comments, given their authors keyed by _id; comments of deleted users are left out
+def comment_records(page, authors):
+    return [
+        {
+            "text": comment["text"],
+            "createdAt": comment["createdAt"],
+            "authorFirstName": authors[comment["author"]]["firstName"],
+            "authorLastName": authors[comment["author"]]["lastName"]
+        }
+        for comment in page if comment["author"] in authors
+    ]
+
+
+# Append a comment; returns the post's author, or None if the post does not exist
+def add_comment(db, post_id, comment, bucket_size, preview_size):
+    return add_comments(db, post_id, [comment], bucket_size, preview_size)
+
+
+# Append several comments in order with one counter update; returns like add_comment
+def add_comments(db, post_id, new_comments, bucket_size, preview_size):
+    # The post's counter assigns the comments their positions, which fix their buckets
+    post = db.posts.find_one_and_update(
+        {"_id": post_id},
+        _counter_update(new_comments, preview_size),
+        projection={"commentCount": 1, "author": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not post:
+        return None
+
+    first_position = post["commentCount"] - len(new_comments)
+    try:
+        db.comment_buckets.bulk_write(_bucket_upserts(post_id, post["author"], first_position, new_comments, bucket_size))
+    except PyMongoError:
+        db.posts.update_one({"_id": post_id}, _counter_rollback(new_comments))
+        raise
+    # Only now are the comments readable, so only now may conditional GETs see a new version
+    db.posts.update_one({"_id": post_id}, {"$inc": {"commentsVersion": 1}})
+    return post["author"]
+
+
+# Return up to `limit` comments from the (seq, offset) `cursor` on, oldest first, and the cursor of the
+# comment after them, or None at the end. A failed write can leave a bucket short of the bucket size, so
+# pages walk the stored arrays instead of computing where a position falls.
+def read_comments(db, post_id, cursor, limit, bucket_size):
+    seq, offset = cursor
+    page = []
+    buckets = db.comment_buckets.find(*_page_query(post_id, seq)).sort("seq", 1)
+    with buckets.batch_size(_page_batch_size(limit, bucket_size)):
+        for bucket in buckets:
+            next_cursor = _fill(page, bucket, offset, limit)
+            if next_cursor:
+                return page, next_cursor
+            offset = 0
+    return page, None
+
+
+# Same as read_comments for an archived post, whose comments are one list; a `limit` of None reads to the end
+def read_archived_comments(post, cursor, limit, bucket_size):
+    seq, offset = cursor
+    start = seq * bucket_size + offset
+    end = len(post["comments"]) if limit is None else start + limit
+    page = post["comments"][start:end]
+    if end < len(post["comments"]):
+        return page, divmod(end, bucket_size)
+    return page, None
+
+
+# Yield the comments from the (seq, offset) `cursor` to the end, one bucket-sized list at a time
+def iter_comment_pages(db, post_id, cursor, bucket_size, batch_size):
+    seq, offset = cursor
+    buckets = db.comment_buckets.find(*_page_query(post_id, seq)).sort("seq", 1)
+    for bucket in buckets.batch_size(max(batch_size // bucket_size, 1)):
+        yield bucket["comments"][offset:]
+        offset = 0
+
+
+async def add_comment_async(db, post_id, comment, bucket_size, preview_size):
+    return await add_comments_async(db, post_id, [comment], bucket_size, preview_size)
+
+
+async def add_comments_async(db, post_id, new_comments, bucket_size, preview_size):
+    post = await db.posts.find_one_and_update(
+        {"_id": post_id},
+        _counter_update(new_comments, preview_size),
+        projection={"commentCount": 1, "author": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not post:
+        return None
+
+    first_position = post["commentCount"] - len(new_comments)
+    try:
+        await db.comment_buckets.bulk_write(_bucket_upserts(post_id, post["author"], first_position, new_comments, bucket_size))
+    except PyMongoError:
+        await db.posts.update_one({"_id": post_id}, _counter_rollback(new_comments))
+        raise
+    # Only now are the comments readable, so only now may conditional GETs see a new version
+    await db.posts.update_one({"_id": post_id}, {"$inc": {"commentsVersion": 1}})
+    return post["author"]
+
+
+async def read_comments_async(db, post_id, cursor, limit, bucket_size):
+    seq, offset = cursor
+    page = []
+    buckets = db.comment_buckets.find(*_page_query(post_id, seq)).sort("seq", 1)
+    async with buckets.batch_size(_page_batch_size(limit, bucket_size)):
+        async for bucket in buckets:
+            next_cursor = _fill(page, bucket, offset, limit)
+            if next_cursor:
+                return page, next_cursor
+            offset = 0
+    return page, None
+
+
+async def iter_comment_pages_async(db, post_id, cursor, bucket_size, batch_size):
+    seq, offset = cursor
+    buckets = db.comment_buckets.find(*_page_query(post_id, seq)).sort("seq", 1)
+    async for bucket in buckets.batch_size(max(batch_size // bucket_size, 1)):
+        yield bucket["comments"][offset:]
+        offset = 0
+
+
+# One-off migration of embedded `comments` arrays into buckets, ahead of any bucketed comments
+# of the same post. Run it while comments are not being written. Returns the number of posts migrated.
+def migrate_embedded(db, bucket_size, preview_size):
+    migrated = 0
+    for post in db.posts.find({"comments": {"$exists": True}}, {"author": 1, "comments": 1, "commentCount": 1}):
+        buckets = db.comment_buckets.find({"post": post["_id"]}, {"comments": 1}).sort("seq", 1)
+        stored = [comment for bucket in buckets for comment in bucket["comments"]]
+        if len(stored) == post.get("commentCount", 0):
+            all_comments = post["comments"] + stored
+        else:
+            # An interrupted run already rewrote the buckets, embedded comments first
+            all_comments = stored
+        db.comment_buckets.bulk_write(_bucket_rewrite(post["_id"], post["author"], all_comments, bucket_size))
+        # The buckets are complete before the array goes, so a rerun never loses comments
+        db.posts.update_one({"_id": post["_id"]}, {
+            "$set": {"commentCount": len(all_comments), "commentPreview": all_comments[-preview_size:]},
+            "$unset": {"comments": ""},
+            "$inc": {"commentsVersion": 1}
+        })
+        # The feed shows the comment count and preview of the author's posts
+        versions.bump(db.users, [post["author"]], "postsVersion")
+        migrated += 1
+    return migrated
+
+
+# One-off backfill of the post author into buckets written before buckets stored it; returns the buckets updated
+def backfill_authors(db):
+    missing = {"author": {"$exists": False}}
+    updated = 0
+    for group in db.comment_buckets.aggregate([{"$match": missing}, {"$group": {"_id": "$post"}}]):
+        post = db.posts.find_one({"_id": group["_id"]}, {"author": 1})
+        if post:
+            result = db.comment_buckets.update_many(dict(missing, post=post["_id"]), {"$set": {"author": post["author"]}})
+            updated += result.modified_count
+    return updated
@@ -0,0 +1,75 @@
+import os
+
+# Settings shared by the WSGI (app.py) and ASGI (asgi_app.py) servers, read from the environment
+def load_config():
+    return {
+        "MONGO_URI": os.environ.get("MONGO_URI", "mongodb://mongodb:27017/mydatabase"),
+        # Database to use instead of the one named in MONGO_URI
+        "MONGO_DBNAME": os.environ.get("MONGO_DBNAME", ""),
+        # "on" lets each request pick a test_* database with X-Test-Database (for the test suite)
+        "TEST_DATABASES": os.environ.get("TEST_DATABASES", "off"),
+        # Mongo client settings (see mongo_options.py); 0 or empty keeps the driver's default
+        "MONGO_MAX_POOL_SIZE": int(os.environ.get("MONGO_MAX_POOL_SIZE", 100)),
+        "MONGO_MIN_POOL_SIZE": int(os.environ.get("MONGO_MIN_POOL_SIZE", 0)),
+        "MONGO_MAX_IDLE_TIME_MS": int(os.environ.get("MONGO_MAX_IDLE_TIME_MS", 0)),
+        "MONGO_CONNECT_TIMEOUT_MS": int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 20000)),
+        "MONGO_SERVER_SELECTION_TIMEOUT_MS": int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 30000)),
+        "MONGO_WAIT_QUEUE_TIMEOUT_MS": int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 0)),
+        "MONGO_TIMEOUT_MS": int(os.environ.get("MONGO_TIMEOUT_MS", 0)),
+        # Write concern: "majority", a number of members, or empty for the server's default
+        "MONGO_WRITE_CONCERN": os.environ.get("MONGO_WRITE_CONCERN", ""),
+        "MONGO_WRITE_TIMEOUT_MS": int(os.environ.get("MONGO_WRITE_TIMEOUT_MS", 0)),
+        "MONGO_JOURNAL": os.environ.get("MONGO_JOURNAL", "") == "true",
+        # Read preferences: the client's default, then per read route (empty uses the default)
+        "MONGO_READ_PREFERENCE": os.environ.get("MONGO_READ_PREFERENCE", "primary"),
+        "MONGO_MAX_STALENESS_S": int(os.environ.get("MONGO_MAX_STALENESS_S", 0)),
+        "FEED_READ_PREFERENCE": os.environ.get("FEED_READ_PREFERENCE", ""),
+        "LIKES_READ_PREFERENCE": os.environ.get("LIKES_READ_PREFERENCE", ""),
+        "COMMENTS_READ_PREFERENCE": os.environ.get("COMMENTS_READ_PREFERENCE", ""),
+        "SEARCH_READ_PREFERENCE": os.environ.get("SEARCH_READ_PREFERENCE", ""),
+        # Connections each server process opens before it accepts requests
+        "MONGO_WARMUP_CONNECTIONS": int(os.environ.get("MONGO_WARMUP_CONNECTIONS", 4)),
+        # Feed mode: "pull" aggregates posts on read, "timeline" fans posts out on write
+        "FEED_MODE": os.environ.get("FEED_MODE", "pull"),
+        "TIMELINE_MAX_SIZE": int(os.environ.get("TIMELINE_MAX_SIZE", 800)),
+        "FANOUT_FOLLOWER_LIMIT": int(os.environ.get("FANOUT_FOLLOWER_LIMIT", 10000)),
+        "FEED_MAX_PAGE_SIZE": int(os.environ.get("FEED_MAX_PAGE_SIZE", 100)),
+        "COMMENT_BUCKET_SIZE": int(os.environ.get("COMMENT_BUCKET_SIZE", 50)),
+        "COMMENT_PREVIEW_SIZE": int(os.environ.get("COMMENT_PREVIEW_SIZE", 3)),
+        "COMMENTS_MAX_PAGE_SIZE": int(os.environ.get("COMMENTS_MAX_PAGE_SIZE", 500)),
+        "FOLLOWS_MAX_PAGE_SIZE": int(os.environ.get("FOLLOWS_MAX_PAGE_SIZE", 200)),
+        "SEARCH_MAX_PAGE_SIZE": int(os.environ.get("SEARCH_MAX_PAGE_SIZE", 100)),
+        # Ids accepted by one GET /users?ids= or GET /posts?ids= request
+        "MULTI_GET_MAX_IDS": int(os.environ.get("MULTI_GET_MAX_IDS", 100)),
+        # Per-process cache of user names (see profile_cache.py): entries and seconds they live; size 0 disables
+        "PROFILE_CACHE_SIZE": int(os.environ.get("PROFILE_CACHE_SIZE", 10000)),
+        "PROFILE_CACHE_TTL_S": float(os.environ.get("PROFILE_CACHE_TTL_S", 60)),
+        "BULK_CHUNK_SIZE": int(os.environ.get("BULK_CHUNK_SIZE", 1000)),
+        "BULK_MAX_ITEMS": int(os.environ.get("BULK_MAX_ITEMS", 100000)),
+        # JSON provider: "orjson", "stdlib", or "auto" (orjson when installed)
+        "JSON_PROVIDER": os.environ.get("JSON_PROVIDER", "auto"),
+        # Write-behind for likes and comments: "on" queues them and answers 202, "off" writes them in the request
+        "WRITE_BEHIND": os.environ.get("WRITE_BEHIND", "off"),
+        "WRITE_BEHIND_MAX_QUEUE": int(os.environ.get("WRITE_BEHIND_MAX_QUEUE", 10000)),
+        "WRITE_BEHIND_FLUSH_SIZE": int(os.environ.get("WRITE_BEHIND_FLUSH_SIZE", 500)),
+        "WRITE_BEHIND_FLUSH_INTERVAL_MS": int(os.environ.get("WRITE_BEHIND_FLUSH_INTERVAL_MS", 50)),
+        "WRITE_BEHIND_ENQUEUE_TIMEOUT_MS": int(os.environ.get("WRITE_BEHIND_ENQUEUE_TIMEOUT_MS", 100)),
+        # Admission control (see admission.py): concurrent requests per route class and process, 0 for no cap
+        "FEED_MAX_CONCURRENCY": int(os.environ.get("FEED_MAX_CONCURRENCY", 0)),
+        "SEARCH_MAX_CONCURRENCY": int(os.environ.get("SEARCH_MAX_CONCURRENCY", 0)),
+        "READS_MAX_CONCURRENCY": int(os.environ.get("READS_MAX_CONCURRENCY", 0)),
+        "WRITES_MAX_CONCURRENCY": int(os.environ.get("WRITES_MAX_CONCURRENCY", 0)),
+        "BULK_MAX_CONCURRENCY": int(os.environ.get("BULK_MAX_CONCURRENCY", 0)),
+        "ADMISSION_QUEUE_TIMEOUT_MS": int(os.environ.get("ADMISSION_QUEUE_TIMEOUT_MS", 100)),
+        "ADMISSION_MAX_WAITING": int(os.environ.get("ADMISSION_MAX_WAITING", 16)),
+        # Per-user token bucket: requests per second and burst size; 0 disables
+        "RATE_LIMIT_PER_S": float(os.environ.get("RATE_LIMIT_PER_S", 0)),
+        "RATE_LIMIT_BURST": int(os.environ.get("RATE_LIMIT_BURST", 20)),
+        # "on" rate-limits by the X-User-Id header instead of the client address; only behind a proxy that sets it
+        "RATE_LIMIT_TRUST_USER_HEADER": os.environ.get("RATE_LIMIT_TRUST_USER_HEADER", "off"),
+        # Archival (archive.py): posts older than this many days move to posts_archive, a batch at a time
+        "ARCHIVE_AFTER_DAYS": float(os.environ.get("ARCHIVE_AFTER_DAYS", 365)),
+        "ARCHIVE_BATCH_SIZE": int(os.environ.get("ARCHIVE_BATCH_SIZE", 500)),
+        # Documents fetched per Mongo round trip when streaming NDJSON responses
+        "STREAM_BATCH_SIZE": int(os.environ.get("STREAM_BATCH_SIZE", 500)),
+    }
@@ -0,0 +1,111 @@
+from datetime import datetime
+
+from pagination import encode_cursor, keyset_filter
+
+# Aggregation stages for GET /users/<user_id>/feed, shared by both feed modes and both servers.
+# A feed pipeline is the selection stages of one mode followed by detail_stages(), which
+# emits posts in their response shape (ids and post dates as strings), ready to serialize as is.
+
+# Post dates as the API has always sent them, Python's isoformat() of the stored naive UTC datetime:
+# microseconds, or no fraction when they are zero. The rfc3339 date format (json_provider.date_format)
+# sends every date as RFC 3339 UTC with milliseconds, the precision of Mongo dates, instead.
+ISO_SECONDS = "%Y-%m-%dT%H:%M:%S"
+RFC3339_FORMAT = "%Y-%m-%dT%H:%M:%S.%LZ"
+
+
+def _date_string(path, date_format):
+    if date_format == "rfc3339":
+        return {"$dateToString": {"date": path, "format": RFC3339_FORMAT}}
+    return {"$cond": [
+        {"$eq": [{"$millisecond": path}, 0]},
+        {"$dateToString": {"date": path, "format": ISO_SECONDS}},
+        {"$dateToString": {"date": path, "format": ISO_SECONDS + ".%L000"}}
+    ]}
+
+
+def pull_match(following, after):
+    match = {"author": {"$in": following}}
+    if after:
+        match.update(keyset_filter(after))
+    return match
+
+
+# Pull mode: the followed authors' posts, newest first
+def pull_stages(following, after, skip, limit):
+    stages = [
+        {"$match": pull_match(following, after)},
+        {"$sort": {"createdAt": -1, "_id": -1}},
+        {"$skip": skip}
+    ]
+    if limit:
+        stages.append({"$limit": limit})
+    return stages
+
+
+# Timeline mode: just the posts referenced by one timeline page
+def timeline_stages(post_ids):
+    return [
+        {"$match": {"_id": {"$in": post_ids}}},
+        {"$sort": {"createdAt": -1, "_id": -1}}
+    ]
+
+
+# Archived posts (archive.py) are older than every post in `posts`, so a page that runs past the end
+# of `posts` continues in `posts_archive` with the same selection. Stages for that continuation after
+# `count` posts from `posts`, or None when the page is complete. `post_ids` is the timeline page in
+# timeline mode, else None; `hot_total` counts the matching posts in `posts` and is only needed
+# when `skip` reached past all of them.
+def archive_stages(following, post_ids, after, skip, fetch, count, hot_total=0):
+    if post_ids is not None:
+        return timeline_stages(post_ids) if count < len(post_ids) else None
+    if fetch is not None and count >= fetch:
+        return None
+    skip = 0 if count else max(skip - hot_total, 0)
+    return pull_stages(following, after, skip, fetch - count if fetch else None)
+
+
+# `date_format` is the request's (json_provider.date_format). Comment dates are HTTP dates by
+# default, which the JSON provider renders. `extra` adds projections, e.g. {"score": 1} to keep
+# a field of the selection stages.
+def detail_stages(preview_size, date_format, extra=None):
+    stages = [
+        {"$lookup": {
+            "from": "users",
+            "localField": "author",
+            "foreignField": "_id",
+            "as": "authorDetails"
+        }},
+        {"$project": {
+            "_id": {"$toString": "$_id"},
+            "content": 1,
+            "createdAt": _date_string("$createdAt", date_format),
+            # Posts created before likeCount existed fall back to the array size
+            "likes": {"$ifNull": ["$likeCount", {"$size": "$likes"}]},
+            # Only the newest comments are embedded; the rest live in comment_buckets
+            "commentCount": {"$ifNull": ["$commentCount", {"$size": {"$ifNull": ["$comments", []]}}]},
+            "comments": {
+                "$map": {
+                    "input": {"$ifNull": ["$commentPreview", {"$slice": ["$comments", -preview_size]}]},
+                    "as": "comment",
+                    "in": {
+                        "text": "$$comment.text",
+                        "author": {"$toString": "$$comment.author"},  # Convert ObjectId to string
+                        "createdAt": (
+                            _date_string("$$comment.createdAt", date_format) if date_format == "rfc3339"
+                            else "$$comment.createdAt"
+                        )
+                    }
+                }
+            },
+            # Posts whose author no longer exists get no name fields
+            "authorFirstName": {"$arrayElemAt": ["$authorDetails.firstName", 0]},
+            "authorLastName": {"$arrayElemAt": ["$authorDetails.lastName", 0]}
+        }}
+    ]
+    stages[-1]["$project"].update(extra or {})
+    return stages
+
+
+# Cursor continuing after a post as emitted by detail_stages()
+def next_cursor(post):
+    return encode_cursor(datetime.fromisoformat(post["createdAt"].rstrip("Z")), post["_id"])
@@ -0,0 +1,183 @@
+from collections import Counter
+from datetime import datetime
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from pagination import encode_cursor, keyset_filter
+
+# Follow graph stored as an edge collection.
+#
+# Each follow is one document in `follows`:
+#   {"_id": ..., "follower": <userId>, "followee": <userId>, "createdAt": ...}
+# A unique index on (follower, followee) makes following a single idempotent
+# upsert and unfollowing a single delete. Users carry followerCount and
+# followingCount, changed only when an edge is actually created or removed.
+# Follower/following lists page newest first by (createdAt, _id).
+#
+# Every operation has a PyMongo version and an `_async` version for the async
+# driver used by asgi_app.py; both build their queries with the helpers below.
+
+# Which edge field selects the listed user's edges, and which holds the users to list
+SIDES = {
+    "followers": ("followee", "follower"),
+    "following": ("follower", "followee"),
+}
+
+
+def edge_filter(follower_id, followee_id):
+    return {"follower": follower_id, "followee": followee_id}
+
+
+def _edge_insert():
+    return {"$setOnInsert": {"createdAt": datetime.utcnow()}}
+
+
+def edge_upsert(follower_id, followee_id):
+    return UpdateOne(edge_filter(follower_id, followee_id), _edge_insert(), upsert=True)
+
+
+# Counter updates for a list of (follower, followee) pairs, one update per user
+def counter_updates(pairs, amount):
+    following = Counter(follower_id for follower_id, _ in pairs)
+    followers = Counter(followee_id for _, followee_id in pairs)
+    updates = [UpdateOne({"_id": user_id}, {"$inc": {"followingCount": count * amount}})
+               for user_id, count in following.items()]
+    updates += [UpdateOne({"_id": user_id}, {"$inc": {"followerCount": count * amount}})
+                for user_id, count in followers.items()]
+    return updates
+
+
+def _following_query(user_id):
+    return {"follower": user_id}, {"followee": 1, "_id": 0}
+
+
+def _followers_query(user_id):
+    return {"followee": user_id}, {"follower": 1, "_id": 0}
+
+
+def _page_query(user_id, side, after):
+    match_field, user_field = SIDES[side]
+    query = {match_field: user_id}
+    if after:
+        query.update(keyset_filter(after))
+    return query, {user_field: 1, "createdAt": 1}
+
+
+# Create the edge; returns False if it already existed
+def follow(db, follower_id, followee_id):
+    try:
+        result = db.follows.update_one(edge_filter(follower_id, followee_id), _edge_insert(), upsert=True)
+    except DuplicateKeyError:
+        # A concurrent follow of the same pair inserted the edge first
+        return False
+    if result.upserted_id is None:
+        return False
+    db.users.bulk_write(counter_updates([(follower_id, followee_id)], 1), ordered=False)
+    return True
+
+
+# Remove the edge; returns False if there was none
+def unfollow(db, follower_id, followee_id):
+    result = db.follows.delete_one(edge_filter(follower_id, followee_id))
+    if result.deleted_count == 0:
+        return False
+    db.users.bulk_write(counter_updates([(follower_id, followee_id)], -1), ordered=False)
+    return True
+
+
+# Ids of the users `user_id` follows
+def following_ids(db, user_id):
+    return [edge["followee"] for edge in db.follows.find(*_following_query(user_id))]
+
+
+# Ids of up to `limit` followers of `user_id`
+def follower_ids(db, user_id, limit):
+    return [edge["follower"] for edge in db.follows.find(*_followers_query(user_id)).limit(limit)]
+
+
+# One page of followers or following edges, newest first; fetch limit + 1 to detect a next page
+def read_page(db, user_id, side, after, limit):
+    query, projection = _page_query(user_id, side, after)
+    return list(db.follows.find(query, projection).sort([("createdAt", -1), ("_id", -1)]).limit(limit))
+
+
+def edge_cursor(edge):
+    return encode_cursor(edge["createdAt"], edge["_id"])
+
+
+# Response records of a page of edges, given the listed users keyed by _id; users that are gone are left out
+def follow_records(edges, side, users):
+    user_field = SIDES[side][1]
+    return [
+        {
+            "userId": str(users[edge[user_field]]["_id"]),
+            "firstName": users[edge[user_field]]["firstName"],
+            "lastName": users[edge[user_field]]["lastName"],
+            "followedAt": edge["createdAt"]
+        }
+        for edge in edges if edge[user_field] in users
+    ]
+
+
+# The X-Total-Count of a follower or following list
+def total_count(user, side):
+    return user.get("followerCount" if side == "followers" else "followingCount", 0)
+
+
+async def follow_async(db, follower_id, followee_id):
+    try:
+        result = await db.follows.update_one(edge_filter(follower_id, followee_id), _edge_insert(), upsert=True)
+    except DuplicateKeyError:
+        return False
+    if result.upserted_id is None:
+        return False
+    await db.users.bulk_write(counter_updates([(follower_id, followee_id)], 1), ordered=False)
+    return True
+
+
+async def unfollow_async(db, follower_id, followee_id):
+    result = await db.follows.delete_one(edge_filter(follower_id, followee_id))
+    if result.deleted_count == 0:
+        return False
+    await db.users.bulk_write(counter_updates([(follower_id, followee_id)], -1), ordered=False)
+    return True
+
+
+async def following_ids_async(db, user_id):
+    edges = await db.follows.find(*_following_query(user_id)).to_list(None)
+    return [edge["followee"] for edge in edges]
+
+
+async def follower_ids_async(db, user_id, limit):
+    edges = await db.follows.find(*_followers_query(user_id)).limit(limit).to_list(None)
+    return [edge["follower"] for edge in edges]
+
+
+async def read_page_async(db, user_id, side, after, limit):
+    query, projection = _page_query(user_id, side, after)
+    cursor = db.follows.find(query, projection).sort([("createdAt", -1), ("_id", -1)]).limit(limit)
+    return await cursor.to_list(None)
+
+
+# One-off migration of the embedded `following` arrays into edges, then rebuild the counters
+def migrate_embedded(db, chunk_size=1000):
+    migrated = 0
+    for user in db.users.find({"following": {"$exists": True}}, {"following": 1}):
+        ops = [edge_upsert(user["_id"], followee_id) for followee_id in user["following"]]
+        for start in range(0, len(ops), chunk_size):
+            db.follows.bulk_write(ops[start:start + chunk_size], ordered=False)
+        db.users.update_one({"_id": user["_id"]}, {"$unset": {"following": ""}})
+        migrated += 1
+    rebuild_counters(db)
+    return migrated
+
+
+# Recompute followerCount/followingCount of every user from the edges
+def rebuild_counters(db):
+    db.users.update_many({}, {"$set": {"followerCount": 0, "followingCount": 0}})
+    for field, counter in (("follower", "followingCount"), ("followee", "followerCount")):
+        counts = db.follows.aggregate([{"$group": {"_id": f"${field}", "count": {"$sum": 1}}}])
+        ops = [UpdateOne({"_id": row["_id"]}, {"$set": {counter: row["count"]}}) for row in counts]
+        if ops:
+            db.users.bulk_write(ops, ordered=False)
@@ -0,0 +1,37 @@
+import multiprocessing
+import os
+
+from config import load_config
+
+# Production server for app.py (run from app/): gunicorn -c gunicorn.conf.py app:app
+#
+# Every worker is a process with its own MongoClient, so a server opens up to
+# GUNICORN_WORKERS x MONGO_MAX_POOL_SIZE connections. gthread workers handle
+# GUNICORN_THREADS requests at once each; with a pool smaller than that,
+# requests queue for a connection (up to MONGO_WAIT_QUEUE_TIMEOUT_MS).
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+# Each worker has its own write-behind queue, and read-your-writes (X-User-Id) only sees the
+# queue of the worker that serves the read; so write-behind needs a single worker
+if load_config()["WRITE_BEHIND"] == "on" and workers > 1:
+    raise RuntimeError(f"WRITE_BEHIND=on needs GUNICORN_WORKERS=1, not {workers}")
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+# Seconds a request may run before its worker is restarted, and how long a stopping worker may finish up
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+# Restart workers now and then to cap memory growth; 0 disables
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+# MongoClient is not fork-safe: each worker imports the app, and creates its client, after the fork
+preload_app = False
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG", "-") or None
+
+
+def post_worker_init(worker):
+    # The worker has loaded the app but does not accept connections yet
+    import app
+    app.warm_up(worker.wsgi)
+    worker.log.info("worker %s warmed up %d Mongo connections", worker.pid, worker.wsgi.config["MONGO_WARMUP_CONNECTIONS"])
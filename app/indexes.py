@@ -0,0 +1,144 @@
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+
+# Declarative index registry, applied idempotently at startup by ensure_indexes().
+# create_indexes() is a no-op for indexes that already exist with the same spec.
+INDEXES = {
+    "posts": [
+        # Feed pull path, follow backfill and celebrity pull: author in (...) newest first
+        IndexModel([("author", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)],
+                   name="author_createdAt"),
+        # GET /search; "none" matches whole words without English stemming or stop words,
+        # which would mangle the mostly Lithuanian content
+        IndexModel([("content", TEXT)], name="content_text", default_language="none"),
+        # archive-posts: the oldest posts first, up to the cutoff
+        IndexModel([("createdAt", ASCENDING), ("_id", ASCENDING)], name="createdAt"),
+        # PATCH /users/<id> with a new name: the posts the user liked, whose likes ETag changes
+        IndexModel([("likes", ASCENDING)], name="likes"),
+    ],
+    "posts_archive": [
+        # Feeds that run past the end of `posts`: author in (...) newest first
+        IndexModel([("author", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)],
+                   name="author_createdAt"),
+    ],
+    "follows": [
+        # One edge per pair; the upsert in follow relies on it, and it serves "who does X follow"
+        IndexModel([("follower", ASCENDING), ("followee", ASCENDING)], name="follower_followee", unique=True),
+        # Followers of an author: fan-out on write and GET /users/<id>/followers
+        IndexModel([("followee", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)],
+                   name="followee_createdAt"),
+        # GET /users/<id>/following, newest first
+        IndexModel([("follower", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)],
+                   name="follower_createdAt"),
+    ],
+    "comment_buckets": [
+        # One bucket per (post, seq); unique so concurrent upserts cannot split a bucket
+        IndexModel([("post", ASCENDING), ("seq", ASCENDING)], name="post_seq", unique=True),
+        # GET /search over comment text
+        IndexModel([("comments.text", TEXT)], name="comments_text", default_language="none"),
+        # PATCH /users/<id> with a new name: the posts the user commented, whose comments ETag changes
+        IndexModel([("comments.author", ASCENDING)], name="comments_author"),
+    ],
+}
+
+
+def ensure_indexes(db):
+    for collection, models in INDEXES.items():
+        db[collection].create_indexes(models)
+
+
+async def ensure_indexes_async(db):
+    for collection, models in INDEXES.items():
+        await db[collection].create_indexes(models)
+
+
+# Canonical query of each route, as (route, collection, find command arguments).
+# Ids are placeholders: the plan depends on the query shape, not on the values.
+def canonical_queries():
+    user_id, post_id = ObjectId(), ObjectId()
+    return [
+        ("GET /users/<id>/feed (pull)", "posts", {
+            "filter": {"author": {"$in": [ObjectId(), ObjectId()]}},
+            "sort": {"createdAt": -1, "_id": -1},
+            "limit": 21
+        }),
+        ("GET /users/<id>/feed (archive)", "posts_archive", {
+            "filter": {"author": {"$in": [ObjectId(), ObjectId()]}},
+            "sort": {"createdAt": -1, "_id": -1},
+            "limit": 21
+        }),
+        ("GET /users/<id>/feed (following)", "follows", {
+            "filter": {"follower": user_id},
+            "projection": {"followee": 1, "_id": 0}
+        }),
+        ("GET /users/<id>/feed (timeline)", "timelines", {"filter": {"_id": user_id}}),
+        ("GET /users/<id>/feed (celebrities)", "users", {
+            "filter": {"_id": {"$in": [ObjectId(), ObjectId()]}, "celebrity": True}
+        }),
+        ("POST /posts (fan-out)", "follows", {"filter": {"followee": user_id}}),
+        ("POST /users/<id>/follow", "follows", {"filter": {"follower": user_id, "followee": ObjectId()}}),
+        ("GET /users/<id>/followers", "follows", {
+            "filter": {"followee": user_id},
+            "sort": {"createdAt": -1, "_id": -1},
+            "limit": 51
+        }),
+        ("GET /users/<id>/following", "follows", {
+            "filter": {"follower": user_id},
+            "sort": {"createdAt": -1, "_id": -1},
+            "limit": 51
+        }),
+        ("POST /users/<id>/follow (backfill)", "posts", {
+            "filter": {"author": user_id},
+            "sort": {"createdAt": -1},
+            "limit": 800
+        }),
+        ("GET /posts/<id>/likes", "posts", {"filter": {"_id": post_id}}),
+        ("GET /posts/<id>/likes (users)", "users", {"filter": {"_id": {"$in": [ObjectId(), ObjectId()]}}}),
+        ("GET /posts/<id>/comments", "comment_buckets", {
+            "filter": {"post": post_id, "seq": {"$gte": 0}},
+            "sort": {"seq": 1}
+        }),
+        ("POST /posts/<id>/comments", "comment_buckets", {"filter": {"post": post_id, "seq": 0}}),
+        ("archive-posts", "posts", {
+            "filter": {"createdAt": {"$lt": datetime.utcnow()}},
+            "sort": {"createdAt": 1, "_id": 1},
+            "limit": 500
+        }),
+        ("PATCH /users/<id> (likes)", "posts", {"filter": {"likes": user_id}}),
+        ("PATCH /users/<id> (comments)", "comment_buckets", {"filter": {"comments.author": user_id}}),
+        ("GET /search (posts)", "posts", {"filter": {"$text": {"$search": "search terms"}}}),
+        ("GET /search (comments)", "comment_buckets", {"filter": {"$text": {"$search": "search terms"}}}),
+        ("GET /search?authorId= (comments)", "comment_buckets", {
+            "filter": {"$text": {"$search": "search terms"}, "author": user_id}
+        }),
+    ]
+
+
+def _plan_stages(plan):
+    # Collect every "stage" name in a winning plan, whatever the explain format nesting
+    if isinstance(plan, dict):
+        stages = [plan["stage"]] if "stage" in plan else []
+        for key, value in plan.items():
+            if key != "rejectedPlans":
+                stages.extend(_plan_stages(value))
+        return stages
+    if isinstance(plan, list):
+        return [stage for item in plan for stage in _plan_stages(item)]
+    return []
+
+
+# Run explain on every canonical query; returns a list of report rows
+def explain_queries(db):
+    report = []
+    for route, collection, query in canonical_queries():
+        explain = db.command("explain", dict({"find": collection}, **query), verbosity="queryPlanner")
+        stages = _plan_stages(explain["queryPlanner"]["winningPlan"])
+        report.append({
+            "route": route,
+            "collection": collection,
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages
+        })
+    return report
@@ -0,0 +1,81 @@
+from contextvars import ContextVar
+from datetime import date, datetime, timezone
+
+from bson.objectid import ObjectId
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:  # Optional: without it the stdlib provider is used
+    orjson = None
+
+# JSON providers for both servers (Quart's provider API is Flask's).
+#
+# Both render ObjectId as its hex string. Datetimes follow the request's date format,
+# which both servers set before every request (validation.validate_date_format):
+#   "http"     HTTP dates ("Mon, 01 Jan 2024 12:00:00 GMT"), the API's format from the start
+#   "rfc3339"  RFC 3339 UTC with milliseconds ("2024-01-01T12:00:00.123Z"; Mongo stores naive
+#              UTC datetimes at that precision), opted into with ?dateFormat=rfc3339
+# The feed aggregation formats post dates itself (feed.detail_stages). Switching providers
+# never changes how a date looks. JSON_PROVIDER selects one: "orjson", "stdlib", or "auto"
+# for orjson when it is installed.
+
+date_format = ContextVar("date_format", default="http")
+
+# orjson would print its own ISO format, so it hands dates to _default
+ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME if orjson else 0
+
+
+def _isoformat(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat(timespec="milliseconds") + "Z"
+
+
+def _default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if date_format.get() == "http" and isinstance(value, date):
+        return http_date(value)
+    if isinstance(value, datetime):
+        return _isoformat(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class StdlibJSONProvider(DefaultJSONProvider):
+    sort_keys = False
+
+    @staticmethod
+    def default(value):
+        if isinstance(value, (ObjectId, date)):
+            return _default(value)
+        return DefaultJSONProvider.default(value)
+
+
+class OrjsonProvider(JSONProvider):
+    # ObjectId and dates go through _default
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_default, option=ORJSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=_default, option=ORJSON_OPTIONS)
+        return self._app.response_class(body, mimetype="application/json")
+
+
+def create_provider(app, name):
+    if name == "auto":
+        name = "orjson" if orjson else "stdlib"
+    if name == "orjson":
+        if orjson is None:
+            raise RuntimeError("JSON_PROVIDER is orjson but orjson is not installed")
+        return OrjsonProvider(app)
+    if name == "stdlib":
+        return StdlibJSONProvider(app)
+    raise ValueError(f"Unknown JSON_PROVIDER: {name}")
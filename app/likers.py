@@ -0,0 +1,33 @@
+# GET /posts/<post_id>/likes. A JSON response resolves the likers' names from the
+# profile cache and one $in query (liker_records). A stream is joined by Mongo instead:
+# stream_pipeline unwinds the post's likes array and looks up each liker in `users`, so
+# the app only ever holds one cursor batch of likers instead of the whole array.
+# Likers whose user is gone are left out of both.
+
+
+# Response records of `user_ids` in order, given the users keyed by _id
+def liker_records(user_ids, users):
+    return [
+        {
+            "userId": str(users[user_id]["_id"]),
+            "firstName": users[user_id]["firstName"],
+            "lastName": users[user_id]["lastName"]
+        }
+        for user_id in user_ids if user_id in users
+    ]
+
+
+def stream_pipeline(post_id):
+    return [
+        {"$match": {"_id": post_id}},
+        {"$project": {"likes": 1}},
+        {"$unwind": "$likes"},
+        {"$lookup": {"from": "users", "localField": "likes", "foreignField": "_id", "as": "user"}},
+        {"$unwind": "$user"},
+        {"$project": {
+            "_id": 0,
+            "userId": {"$toString": "$user._id"},
+            "firstName": "$user.firstName",
+            "lastName": "$user.lastName"
+        }}
+    ]
@@ -0,0 +1,197 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import partial
+
+from flask import Response, request
+from pymongo import monitoring
+
+# In-process request and Mongo command metrics, exposed on GET /metrics in the
+# Prometheus text format.
+#
+# A CommandListener passed to the Mongo client attributes every command to the
+# route of the request that issued it, through a ContextVar set when the request
+# starts. Recording is a dict lookup and a few additions under a lock, cheap
+# enough to leave on in production.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COMMAND_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels, buckets):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    labels = _format_labels(self.labels, label_values, [("le", le)])
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labels, label_values)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Request latency by route.",
+    ("method", "route"), LATENCY_BUCKETS
+)
+REQUESTS = Counter("http_requests_total", "Requests by route and status.", ("method", "route", "status"))
+REQUESTS_REJECTED = Counter(
+    "http_requests_rejected_total", "Requests turned away by admission control, by route and reason.",
+    ("method", "route", "reason")
+)
+PROFILE_CACHE_LOOKUPS = Counter(
+    "profile_cache_lookups_total", "User name lookups by the profile cache, by result (hit or miss).", ("result",)
+)
+MONGO_COMMANDS = Counter(
+    "mongo_commands_total", "Mongo commands by issuing route and command.", ("route", "command", "outcome")
+)
+MONGO_COMMAND_LATENCY = Histogram(
+    "mongo_command_duration_seconds", "Mongo command latency by issuing route and command.",
+    ("route", "command"), LATENCY_BUCKETS
+)
+MONGO_COMMANDS_PER_REQUEST = Histogram(
+    "mongo_commands_per_request", "Mongo commands issued per request.",
+    ("method", "route"), COMMAND_COUNT_BUCKETS
+)
+ALL_METRICS = (
+    REQUEST_LATENCY, REQUESTS, REQUESTS_REJECTED, PROFILE_CACHE_LOOKUPS, MONGO_COMMANDS, MONGO_COMMAND_LATENCY,
+    MONGO_COMMANDS_PER_REQUEST
+)
+
+
+class RequestStats:
+    __slots__ = ("route", "method", "started", "commands")
+
+    def __init__(self, route, method):
+        self.route = route
+        self.method = method
+        self.started = time.perf_counter()
+        self.commands = 0
+
+
+# Stats of the request being handled in the current thread or task
+current_request = ContextVar("current_request", default=None)
+
+
+class CommandMetrics(monitoring.CommandListener):
+    def _record(self, event, outcome):
+        stats = current_request.get()
+        route = stats.route if stats else "none"
+        if stats:
+            stats.commands += 1
+        MONGO_COMMANDS.inc(route, event.command_name, outcome)
+        MONGO_COMMAND_LATENCY.observe(event.duration_micros / 1e6, route, event.command_name)
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event, "success")
+
+    def failed(self, event):
+        self._record(event, "failure")
+
+
+command_listener = CommandMetrics()
+
+
+def start_request(route, method):
+    current_request.set(RequestStats(route, method))
+
+
+# Record a request whose body has been sent, given the stats start_request set for it.
+# Servers call it once the body is out, so a streamed response counts its whole stream.
+def finish_request(stats, status_code):
+    if stats:
+        elapsed = time.perf_counter() - stats.started
+        REQUEST_LATENCY.observe(elapsed, stats.method, stats.route)
+        REQUESTS.inc(stats.method, stats.route, str(status_code))
+        MONGO_COMMANDS_PER_REQUEST.observe(stats.commands, stats.method, stats.route)
+
+
+def route_of(req):
+    return req.url_rule.rule if req.url_rule else "unmatched"
+
+
+def render():
+    lines = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+# Install the request hooks and the /metrics route on the Flask app
+def init_app(app):
+    @app.before_request
+    def start_metrics():
+        start_request(route_of(request), request.method)
+
+    @app.after_request
+    def finish_metrics(response):
+        # The WSGI server closes the response after sending the body; the stats stay set until
+        # then, so commands issued while a streamed body is sent still count for the route
+        response.call_on_close(partial(finish_request, current_request.get(), response.status_code))
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return Response(render(), mimetype=CONTENT_TYPE)
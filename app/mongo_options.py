@@ -0,0 +1,109 @@
+import asyncio
+import threading
+
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+
+# Mongo client settings shared by both servers, built from the MONGO_* settings in config.py.
+#
+# client_options() turns them into MongoClient keyword arguments: pool size,
+# timeouts, write concern and the client's default read preference. The feed,
+# likes, comments and search read routes can each override the read preference
+# (FEED_READ_PREFERENCE, ...), so reads that tolerate replication lag can be
+# served by secondaries while writes and every other read use the default.
+# warm_up() opens the pool before a server process accepts requests.
+
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+# Read routes with their own read preference setting
+READ_ROUTES = ("feed", "likes", "comments", "search")
+
+
+def read_preference(name, max_staleness=0):
+    if name not in READ_PREFERENCES:
+        raise ValueError(f"Unknown read preference: {name}")
+    if name == "primary" or not max_staleness:
+        return READ_PREFERENCES[name]()
+    return READ_PREFERENCES[name](max_staleness=max_staleness)
+
+
+def client_options(config):
+    # Fail at startup on a misspelled read preference rather than on the first read
+    read_preference(config["MONGO_READ_PREFERENCE"])
+    for route in READ_ROUTES:
+        route_read_preference(config, route)
+    options = {
+        "maxPoolSize": config["MONGO_MAX_POOL_SIZE"],
+        "minPoolSize": config["MONGO_MIN_POOL_SIZE"],
+        "connectTimeoutMS": config["MONGO_CONNECT_TIMEOUT_MS"],
+        "serverSelectionTimeoutMS": config["MONGO_SERVER_SELECTION_TIMEOUT_MS"],
+        "readPreference": config["MONGO_READ_PREFERENCE"],
+    }
+    # Zero or empty leaves the driver's (or the server's) default in place
+    optional = {
+        "maxIdleTimeMS": config["MONGO_MAX_IDLE_TIME_MS"],
+        "waitQueueTimeoutMS": config["MONGO_WAIT_QUEUE_TIMEOUT_MS"],
+        "timeoutMS": config["MONGO_TIMEOUT_MS"],
+        "w": int(config["MONGO_WRITE_CONCERN"]) if config["MONGO_WRITE_CONCERN"].isdigit()
+        else config["MONGO_WRITE_CONCERN"],
+        "wTimeoutMS": config["MONGO_WRITE_TIMEOUT_MS"],
+        "journal": config["MONGO_JOURNAL"],
+    }
+    if config["MONGO_READ_PREFERENCE"] != "primary":
+        optional["maxStalenessSeconds"] = config["MONGO_MAX_STALENESS_S"]
+    options.update((name, value) for name, value in optional.items() if value)
+    return options
+
+
+# Read preference of a read route, or None when the route uses the client's default
+def route_read_preference(config, route):
+    name = config[f"{route.upper()}_READ_PREFERENCE"]
+    if not name:
+        return None
+    return read_preference(name, config["MONGO_MAX_STALENESS_S"])
+
+
+# The database handle a read route should use; works for PyMongo and async PyMongo handles
+def route_database(db, config, route):
+    preference = route_read_preference(config, route)
+    if preference is None:
+        return db
+    return db.with_options(read_preference=preference)
+
+
+def _warm_up_targets(db, config):
+    yield db
+    for route in READ_ROUTES:
+        if route_read_preference(config, route) is not None:
+            yield route_database(db, config, route)
+
+
+# Select the servers every read preference in use routes to, and open `connections` connections
+def warm_up(db, config, connections):
+    for target in _warm_up_targets(db, config):
+        target.command("ping", read_preference=target.read_preference)
+    # Concurrent commands each check out their own connection, so the pool grows to `connections`
+    connections = max(connections, 1)
+    barrier = threading.Barrier(connections)
+
+    def ping():
+        barrier.wait()
+        db.command("ping")
+
+    threads = [threading.Thread(target=ping) for _ in range(connections - 1)]
+    for thread in threads:
+        thread.start()
+    ping()
+    for thread in threads:
+        thread.join()
+
+
+async def warm_up_async(db, config, connections):
+    for target in _warm_up_targets(db, config):
+        await target.command("ping", read_preference=target.read_preference)
+    await asyncio.gather(*(db.command("ping") for _ in range(connections)))
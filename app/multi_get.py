@@ -0,0 +1,43 @@
+# Multi-get routes: GET /users?ids=... and GET /posts?ids=... load every
+# requested document with one $in query and a projection, and answer them in
+# the order of the ids; ids that do not exist are left out.
+
+USER_FIELDS = {"firstName": 1, "lastName": 1, "birthDate": 1, "bio": 1, "followerCount": 1, "followingCount": 1}
+
+# The feed's post fields without its author lookup and comment preview; authors come from GET /users?ids=
+POST_FIELDS = {"author": 1, "content": 1, "createdAt": 1, "likeCount": 1, "commentCount": 1}
+
+
+def user_record(user):
+    return {
+        "userId": str(user["_id"]),
+        "firstName": user["firstName"],
+        "lastName": user["lastName"],
+        "birthDate": user["birthDate"],
+        "bio": user["bio"],
+        "followerCount": user.get("followerCount", 0),
+        "followingCount": user.get("followingCount", 0)
+    }
+
+
+def post_record(post):
+    return {
+        "_id": str(post["_id"]),
+        "author": str(post["author"]),
+        "content": post["content"],
+        "createdAt": post["createdAt"],
+        "likes": post.get("likeCount", 0),
+        "commentCount": post.get("commentCount", 0)
+    }
+
+
+# Records of the found documents in the order of `ids`
+def in_order(ids, documents, record):
+    by_id = {document["_id"]: document for document in documents}
+    return [record(by_id[_id]) for _id in ids if _id in by_id]
+
+
+# The ids not among the found documents, e.g. posts to look for in the archive
+def missing_ids(ids, documents):
+    found = {document["_id"] for document in documents}
+    return [_id for _id in ids if _id not in found]
@@ -0,0 +1,106 @@
+import base64
+import json
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+
+# Keyset (cursor) pagination over documents sorted by (createdAt desc, _id desc).
+# The cursor is an opaque URL-safe token holding the sort key of the last item returned.
+
+
+def _encode(values):
+    raw = json.dumps(values)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode(token):
+    padded = token + "=" * (-len(token) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded))
+
+
+def encode_cursor(created_at, doc_id):
+    return _encode([created_at.isoformat(), str(doc_id)])
+
+
+# Returns (createdAt, _id), or None if the token is malformed
+def decode_cursor(token):
+    try:
+        created_at, doc_id = _decode(token)
+        return datetime.fromisoformat(created_at), ObjectId(doc_id)
+    except (ValueError, TypeError, InvalidId):
+        return None
+
+
+# Cursor for bucketed sequences (e.g. comments): the bucket number and the index in it of the next item
+def encode_bucket_cursor(seq, offset):
+    return _encode([seq, offset])
+
+
+# Returns (seq, offset), or None if the token is malformed.
+# Tokens holding a single position come from before the bucket was recorded and assume full buckets.
+def decode_bucket_cursor(token, bucket_size):
+    try:
+        values = _decode(token)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or not 1 <= len(values) <= 2:
+        return None
+    if any(not isinstance(value, int) or isinstance(value, bool) or value < 0 for value in values):
+        return None
+    if len(values) == 1:
+        return divmod(values[0], bucket_size)
+    return tuple(values)
+
+
+# Cursor for results ranked by a score (e.g. search), sorted by (score desc, _id asc)
+def encode_rank_cursor(score, doc_id):
+    return _encode([score, str(doc_id)])
+
+
+# Returns (score, _id), or None if the token is malformed
+def decode_rank_cursor(token):
+    try:
+        score, doc_id = _decode(token)
+        if isinstance(score, bool) or not isinstance(score, (int, float)):
+            return None
+        return score, ObjectId(doc_id)
+    except (ValueError, TypeError, InvalidId):
+        return None
+
+
+# A page fetched with one item beyond `limit`: the page, and the cursor after it (None at the end),
+# where `cursor_of` gives the cursor continuing after an item
+def split_page(items, limit, cursor_of):
+    if len(items) > limit:
+        return items[:limit], cursor_of(items[limit - 1])
+    return items, None
+
+
+# Query filter matching documents ranked after the cursor position
+def rank_filter(after, score_field="score", id_field="_id"):
+    score, doc_id = after
+    return {"$or": [
+        {score_field: {"$lt": score}},
+        {score_field: score, id_field: {"$gt": doc_id}}
+    ]}
+
+
+# Query filter matching documents that sort after the cursor position
+def keyset_filter(after, time_field="createdAt", id_field="_id"):
+    created_at, doc_id = after
+    return {"$or": [
+        {time_field: {"$lt": created_at}},
+        {time_field: created_at, id_field: {"$lt": doc_id}}
+    ]}
+
+
+# Same condition as keyset_filter, as an aggregation expression over "$$<var>"
+def keyset_expr(after, var, time_field="createdAt", id_field="_id"):
+    created_at, doc_id = after
+    time_path = f"$${var}.{time_field}"
+    id_path = f"$${var}.{id_field}"
+    return {"$or": [
+        {"$lt": [time_path, created_at]},
+        {"$and": [{"$eq": [time_path, created_at]}, {"$lt": [id_path, doc_id]}]}
+    ]}
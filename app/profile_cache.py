@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+# In-process cache of user names for the routes that attach names to likes,
+# comments and follows (get_users_by_id in both servers).
+#
+# Entries expire PROFILE_CACHE_TTL_S after they were read from Mongo, and the
+# least recently used are evicted beyond PROFILE_CACHE_SIZE (0 disables the
+# cache). Each database's handles carry their own cache. A profile update
+# invalidates its entry in the process that served it; other server processes
+# keep their copy until it expires, except where the likes and comments routes
+# drop it as below.
+#
+# A read that started before an invalidation must not put the old profile
+# back: put_many() drops entries read before the last invalidation, using the
+# generation the caller took before its query.
+#
+# A rename in another process stamps the posts that list the user with
+# namesChangedAt (versions.bump_names). For one TTL after that stamp, names_stale()
+# tells the routes to drop the post's listed users before resolving their names,
+# so a response under the post's new ETag never carries a name cached before it.
+
+# The profile fields the cache holds; changing one of them changes the ETags of the lists that show it
+NAME_FIELDS = {"firstName", "lastName"}
+
+
+# Whether names cached by any process may predate a rename of a user listed on `post`
+def names_stale(post, ttl):
+    renamed = post.get("namesChangedAt")
+    return renamed is not None and datetime.utcnow() - renamed < timedelta(seconds=ttl)
+
+
+class ProfileCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        # user id -> (profile, monotonic expiry time), least recently used first
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    # Cached profiles of `user_ids` keyed by id, and the ids that have to be read from Mongo
+    def get_many(self, user_ids, now=None):
+        if not self.max_size:
+            return {}, list(user_ids)
+        if now is None:
+            now = time.monotonic()
+        found, missing = {}, []
+        with self.lock:
+            for user_id in user_ids:
+                entry = self.entries.get(user_id)
+                if entry and entry[1] > now:
+                    self.entries.move_to_end(user_id)
+                    found[user_id] = entry[0]
+                else:
+                    missing.append(user_id)
+        return found, missing
+
+    # Cache profiles read from Mongo; `generation` is the value of self.generation before the read
+    def put_many(self, profiles, generation, now=None):
+        if not self.max_size:
+            return
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            if generation != self.generation:
+                return
+            for profile in profiles:
+                self.entries[profile["_id"]] = (profile, now + self.ttl)
+                self.entries.move_to_end(profile["_id"])
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_ids):
+        with self.lock:
+            self.generation += 1
+            for user_id in user_ids:
+                self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+
+def profile_cache(config):
+    return ProfileCache(config["PROFILE_CACHE_SIZE"], config["PROFILE_CACHE_TTL_S"])
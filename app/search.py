@@ -0,0 +1,44 @@
+import feed
+from pagination import encode_rank_cursor, rank_filter
+
+# Full-text search over post content and comment text (GET /search), shared by both servers.
+#
+# posts.content and comment_buckets.comments.text each have a text index (indexes.py).
+# A search is one aggregation on posts: the posts whose content matches, unioned with
+# the posts of the comment buckets that match, each post scored by its best textScore.
+# An author filter applies to both sides before the matches are grouped.
+# Results are posts in the feed's response shape plus "score", best first, paged with
+# a (score, _id) cursor. Mongo scores every match before it can sort by score, so a
+# query costs in proportion to the posts and buckets it matches, not to the page size.
+
+
+def search_stages(query, author, after, limit, preview_size, date_format):
+    text = {"$text": {"$search": query}}
+    # A bucket carries its post's author, so both sides drop other authors' matches before scoring
+    match = dict(text, author=author) if author else text
+    stages = [
+        {"$match": match},
+        {"$project": {"score": {"$meta": "textScore"}}},
+        {"$unionWith": {"coll": "comment_buckets", "pipeline": [
+            {"$match": match},
+            {"$project": {"_id": "$post", "score": {"$meta": "textScore"}}}
+        ]}},
+        # A post matched by its content and several comment buckets is one result
+        {"$group": {"_id": "$_id", "score": {"$max": "$score"}}}
+    ]
+    if after:
+        stages.append({"$match": rank_filter(after)})
+    stages += [
+        {"$sort": {"score": -1, "_id": 1}},
+        {"$limit": limit},
+        {"$lookup": {"from": "posts", "localField": "_id", "foreignField": "_id", "as": "post"}},
+        {"$unwind": "$post"},
+        {"$addFields": {"post.score": "$score"}},
+        {"$replaceRoot": {"newRoot": "$post"}}
+    ]
+    return stages + feed.detail_stages(preview_size, date_format, {"score": 1})
+
+
+# Cursor continuing after a result as emitted by search_stages()
+def next_cursor(post):
+    return encode_rank_cursor(post["score"], post["_id"])
@@ -0,0 +1,196 @@
+import asyncio
+
+from pymongo import UpdateOne
+
+import follows
+from pagination import keyset_filter, keyset_expr
+
+# Materialized (fan-out-on-write) timelines.
+#
+# Each user gets one document in the `timelines` collection holding a capped,
+# newest-first array of post references:
+#   {"_id": <userId>, "entries": [{"post": ..., "author": ..., "createdAt": ...}]}
+# Authors with more followers than the fan-out limit are flagged as "celebrity"
+# and their posts are not pushed; readers pull those at read time instead.
+#
+# Every operation has a PyMongo version and an `_async` version for the async
+# driver used by asgi_app.py; both build their queries with the helpers below.
+
+FANOUT_CHUNK_SIZE = 1000
+
+
+def _entry(post):
+    return {"post": post["_id"], "author": post["author"], "createdAt": post["createdAt"]}
+
+
+def _push_entries(entries, max_size):
+    return {"$push": {"entries": {
+        "$each": entries,
+        "$sort": {"createdAt": -1, "post": -1},
+        "$slice": max_size
+    }}}
+
+
+def _fan_out_batches(post, follower_ids, max_size):
+    update = _push_entries([_entry(post)], max_size)
+    for start in range(0, len(follower_ids), FANOUT_CHUNK_SIZE):
+        chunk = follower_ids[start:start + FANOUT_CHUNK_SIZE]
+        yield [UpdateOne({"_id": follower_id}, update, upsert=True) for follower_id in chunk]
+
+
+def _backfill_query(followee_id):
+    return {"author": followee_id}, {"author": 1, "createdAt": 1}
+
+
+def _timeline_page_pipeline(user_id, after, count):
+    return [
+        {"$match": {"_id": user_id}},
+        {"$project": {"entries": {"$slice": [
+            {"$filter": {"input": "$entries", "as": "entry", "cond": keyset_expr(after, "entry", id_field="post")}},
+            count
+        ]}}}
+    ]
+
+
+def _celebrity_query(following):
+    return {"_id": {"$in": following}, "celebrity": True}, {"_id": 1}
+
+
+def _pull_query(celebrities, after):
+    query = {"author": {"$in": celebrities}}
+    if after:
+        query.update(keyset_filter(after))
+    return query, {"createdAt": 1}
+
+
+def _merge_page(timeline, pulled, skip, limit):
+    refs = [(entry["createdAt"], entry["post"]) for entry in (timeline or {}).get("entries", [])]
+    if pulled:
+        seen = {post_id for _, post_id in refs}
+        refs.extend((post["createdAt"], post["_id"]) for post in pulled if post["_id"] not in seen)
+        refs.sort(reverse=True)
+    return [post_id for _, post_id in refs[skip:skip + limit]]
+
+
+# Push a freshly created post into every follower's timeline
+def fan_out_post(db, post, max_size, follower_limit):
+    author_id = post["author"]
+    follower_ids = follows.follower_ids(db, author_id, follower_limit + 1)
+
+    if len(follower_ids) > follower_limit:
+        # Too many followers to fan out on write; switch this author to the pull path
+        db.users.update_one({"_id": author_id}, {"$set": {"celebrity": True}})
+        return 0
+
+    for batch in _fan_out_batches(post, follower_ids, max_size):
+        db.timelines.bulk_write(batch, ordered=False)
+    return len(follower_ids)
+
+
+# Copy the newest posts of a followed author into the follower's timeline
+def backfill_timeline(db, user_id, followee_id, max_size):
+    followee = db.users.find_one({"_id": followee_id}, {"celebrity": 1})
+    if followee and followee.get("celebrity"):
+        return
+    query, projection = _backfill_query(followee_id)
+    posts = db.posts.find(query, projection).sort("createdAt", -1).limit(max_size)
+    entries = [_entry(post) for post in posts]
+    if entries:
+        db.timelines.update_one({"_id": user_id}, _push_entries(entries, max_size), upsert=True)
+
+
+# Rebuild every timeline from the follow edges, e.g. to switch an existing database to timeline mode.
+# Returns the number of follows backfilled.
+def rebuild_timelines(db, max_size, follower_limit):
+    # Authors with too many followers are flagged now rather than on their next post
+    db.users.update_many({"followerCount": {"$gt": follower_limit}}, {"$set": {"celebrity": True}})
+    db.timelines.delete_many({})
+    rebuilt = 0
+    for edge in db.follows.find({}, {"follower": 1, "followee": 1}):
+        backfill_timeline(db, edge["follower"], edge["followee"], max_size)
+        rebuilt += 1
+    return rebuilt
+
+
+# Drop an unfollowed author's posts from the follower's timeline
+def prune_timeline(db, user_id, unfollowed_id):
+    db.timelines.update_one({"_id": user_id}, {"$pull": {"entries": {"author": unfollowed_id}}})
+
+
+# Return the post ids for one feed page, newest first.
+# `after` is an optional (createdAt, postId) keyset cursor; `skip` serves legacy page numbers.
+def read_timeline(db, user_id, following, skip, limit, after=None):
+    if after:
+        result = list(db.timelines.aggregate(_timeline_page_pipeline(user_id, after, skip + limit)))
+        timeline = result[0] if result else None
+    else:
+        timeline = db.timelines.find_one(
+            {"_id": user_id},
+            {"entries": {"$slice": skip + limit}}
+        )
+
+    # Hybrid pull path for followed authors that are not fanned out
+    celebrities = [user["_id"] for user in db.users.find(*_celebrity_query(following))]
+    pulled = []
+    if celebrities:
+        query, projection = _pull_query(celebrities, after)
+        pulled = db.posts.find(query, projection).sort(
+            [("createdAt", -1), ("_id", -1)]
+        ).limit(skip + limit)
+
+    return _merge_page(timeline, list(pulled), skip, limit)
+
+
+async def fan_out_post_async(db, post, max_size, follower_limit):
+    author_id = post["author"]
+    follower_ids = await follows.follower_ids_async(db, author_id, follower_limit + 1)
+
+    if len(follower_ids) > follower_limit:
+        await db.users.update_one({"_id": author_id}, {"$set": {"celebrity": True}})
+        return 0
+
+    await asyncio.gather(*(
+        db.timelines.bulk_write(batch, ordered=False)
+        for batch in _fan_out_batches(post, follower_ids, max_size)
+    ))
+    return len(follower_ids)
+
+
+async def backfill_timeline_async(db, user_id, followee_id, max_size):
+    query, projection = _backfill_query(followee_id)
+    # The celebrity check and the post read are independent, so run them together
+    followee, posts = await asyncio.gather(
+        db.users.find_one({"_id": followee_id}, {"celebrity": 1}),
+        db.posts.find(query, projection).sort("createdAt", -1).limit(max_size).to_list(None)
+    )
+    if followee and followee.get("celebrity"):
+        return
+    entries = [_entry(post) for post in posts]
+    if entries:
+        await db.timelines.update_one({"_id": user_id}, _push_entries(entries, max_size), upsert=True)
+
+
+async def prune_timeline_async(db, user_id, unfollowed_id):
+    await db.timelines.update_one({"_id": user_id}, {"$pull": {"entries": {"author": unfollowed_id}}})
+
+
+async def read_timeline_async(db, user_id, following, skip, limit, after=None):
+    async def read_entries():
+        if after:
+            cursor = await db.timelines.aggregate(_timeline_page_pipeline(user_id, after, skip + limit))
+            result = await cursor.to_list(None)
+            return result[0] if result else None
+        return await db.timelines.find_one({"_id": user_id}, {"entries": {"$slice": skip + limit}})
+
+    timeline, celebrities = await asyncio.gather(
+        read_entries(),
+        db.users.find(*_celebrity_query(following)).to_list(None)
+    )
+    pulled = []
+    if celebrities:
+        query, projection = _pull_query([user["_id"] for user in celebrities], after)
+        pulled = await db.posts.find(query, projection).sort(
+            [("createdAt", -1), ("_id", -1)]
+        ).limit(skip + limit).to_list(None)
+
+    return _merge_page(timeline, pulled, skip, limit)
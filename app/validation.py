@@ -0,0 +1,227 @@
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from datetime import datetime
+import re
+
+from pagination import decode_cursor, decode_bucket_cursor, decode_rank_cursor
+
+# Request validation shared by the single-item, bulk and async routes.
+# The build_*/validate_* helpers return (value, error).
+# The build_*_query helpers read a read route's query string, so both servers accept the same parameters.
+
+
+# Helper function to validate ObjectId
+def validate_object_id(id_str):
+    # ObjectId(None) would generate a fresh id, so a missing value is invalid too
+    if id_str is None:
+        return None
+    try:
+        return ObjectId(id_str)
+    except (InvalidId, TypeError):
+        return None
+
+
+# Helper function to validate a test database name (TEST_DATABASES mode). The test_ prefix
+# keeps a misdirected test run away from real data; Mongo allows 63 characters.
+def validate_test_database(name):
+    if name is None or not re.fullmatch(r"test_[A-Za-z0-9_]{1,58}", name):
+        return None
+    return name
+
+
+# Helper function to validate the optional `limit` of a streamed response; None streams to the end
+def validate_stream_limit(limit):
+    if limit is not None and limit < 0:
+        return None, "Invalid limit"
+    return limit, None
+
+
+# Helper function to validate the dateFormat query parameter: "http" (the default) or "rfc3339"
+def validate_date_format(args):
+    date_format = args.get('dateFormat', 'http')
+    if date_format not in ('http', 'rfc3339'):
+        return None, "Invalid dateFormat"
+    return date_format, None
+
+
+def build_user(data):
+    if not all(key in data for key in ('firstName', 'lastName', 'birthDate', 'bio')):
+        return None, "Missing fields"
+
+    return {
+        "firstName": data['firstName'],
+        "lastName": data['lastName'],
+        "birthDate": data['birthDate'],
+        "bio": data['bio'],
+        "followerCount": 0,
+        "followingCount": 0
+    }, None
+
+
+# Body of PATCH /users/<user_id>: the profile fields to change, as a $set document
+def build_user_update(data):
+    update = {key: data[key] for key in ('firstName', 'lastName', 'birthDate', 'bio') if key in data}
+    if not update:
+        return None, "No fields to update"
+    return update, None
+
+
+def build_post(data):
+    if not all(key in data for key in ('authorId', 'content')):
+        return None, "Missing fields"
+
+    author_id = validate_object_id(data['authorId'])
+    if not author_id:
+        return None, "Invalid authorId"
+
+    return {
+        "author": author_id,
+        "content": data['content'],
+        "createdAt": datetime.utcnow(),
+        "likes": [],
+        "likeCount": 0,
+        "commentCount": 0,
+        "commentPreview": []
+    }, None
+
+
+def build_comment(data):
+    if not all(key in data for key in ('authorId', 'text')):
+        return None, "Missing fields"
+
+    author_id = validate_object_id(data['authorId'])
+    if not author_id:
+        return None, "Invalid authorId"
+
+    if len(data['text']) > 500:
+        return None, "Comment too long"
+
+    return {
+        "_id": ObjectId(),
+        "author": author_id,
+        "text": data['text'],
+        "createdAt": datetime.utcnow()
+    }, None
+
+
+# Query string of GET /search: the search terms, an optional author, the (score, _id) cursor and the page size
+def build_search(args, max_page_size):
+    query = args.get('q', '').strip()
+    if not query:
+        return None, "Missing q"
+
+    if len(query) > 200:
+        return None, "Query too long"
+
+    author_id = None
+    if 'authorId' in args:
+        author_id = validate_object_id(args['authorId'])
+        if not author_id:
+            return None, "Invalid authorId"
+
+    after = None
+    if 'cursor' in args:
+        # Keyset pagination: continue after the (score, _id) of the previous page's last post
+        after = decode_rank_cursor(args['cursor'])
+        if not after:
+            return None, "Invalid cursor"
+    limit = min(max(args.get('limit', 20, type=int), 1), max_page_size)
+    return (query, author_id, after, limit), None
+
+
+# Query string of the follower and following lists: the (createdAt, _id) cursor and the page size
+def build_follow_list_query(args, max_page_size):
+    after = None
+    if 'cursor' in args:
+        after = decode_cursor(args['cursor'])
+        if not after:
+            return None, "Invalid cursor"
+    limit = min(max(args.get('limit', 50, type=int), 1), max_page_size)
+    return (after, limit), None
+
+
+# Query string of GET /posts/<post_id>/comments: the (seq, offset) cursor and the number of comments.
+# A streamed response runs to the end unless `limit` caps it; a page is at most `max_page_size` long.
+def build_comments_query(args, stream, bucket_size, max_page_size):
+    cursor = (0, 0)
+    if 'cursor' in args:
+        cursor = decode_bucket_cursor(args['cursor'], bucket_size)
+        if cursor is None:
+            return None, "Invalid cursor"
+
+    if stream:
+        limit, error = validate_stream_limit(args.get('limit', type=int))
+        if error:
+            return None, error
+    else:
+        limit = min(max(args.get('limit', 100, type=int), 1), max_page_size)
+    return (cursor, limit), None
+
+
+# Query string of GET /users/<user_id>/feed: the (createdAt, _id) cursor, the posts to skip for a
+# `page` number, and the page size. A streamed feed runs to the end unless `limit` caps it.
+def build_feed_query(args, stream, max_page_size):
+    page_size = min(max(args.get('limit', 20, type=int), 1), max_page_size)
+    limit = None if stream and 'limit' not in args else page_size
+    if 'cursor' in args:
+        # Keyset pagination: continue after the (createdAt, _id) of the previous page's last post
+        after = decode_cursor(args['cursor'])
+        if not after:
+            return None, "Invalid cursor"
+        return (after, 0, limit), None
+    page = int(args.get('page', 1))
+    return (None, (page - 1) * page_size, limit), None
+
+
+# Query string of the multi-get routes: ids=<id>,<id>,... (or repeated ids=), duplicates dropped in order
+def build_ids(args, max_ids):
+    values = [value for arg in args.getlist('ids') for value in arg.split(',') if value]
+    if not values:
+        return None, "Missing ids"
+
+    ids = list(dict.fromkeys(validate_object_id(value) for value in values))
+    if len(ids) > max_ids:
+        return None, "Too many ids"
+    if None in ids:
+        return None, "Invalid ids"
+    return ids, None
+
+
+def validate_liker(data):
+    if 'userId' not in data:
+        return None, "Missing userId"
+
+    user_id = validate_object_id(data['userId'])
+    if not user_id:
+        return None, "Invalid userId"
+    return user_id, None
+
+
+# Body of POST /users/<user_id>/follow or /unfollow: the other user, under `key` ("followId" or "unfollowId")
+def validate_followee(data, key):
+    followee_id = validate_object_id(data.get(key))
+    if not followee_id:
+        return None, f"Invalid {key}"
+    return followee_id, None
+
+
+def build_follow(data):
+    user_id = validate_object_id(data.get('userId'))
+    if not user_id:
+        return None, "Invalid userId"
+
+    follow_id = validate_object_id(data.get('followId'))
+    if not follow_id:
+        return None, "Invalid followId"
+    return (user_id, follow_id), None
+
+
+def build_like(data):
+    post_id = validate_object_id(data.get('postId'))
+    if not post_id:
+        return None, "Invalid postId"
+
+    user_id, error = validate_liker(data)
+    if error:
+        return None, error
+    return (post_id, user_id), None
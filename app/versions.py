@@ -0,0 +1,73 @@
+from collections import Counter
+
+from pymongo import UpdateOne
+
+# Version counters behind conditional GETs (ETag / If-None-Match -> 304).
+#
+#   posts.likesVersion     bumped by every like and unlike, in the same write
+#   posts.commentsVersion  bumped after a comment is stored in its bucket
+#   users.followVersion    bumped after the user follows or unfollows someone
+#   users.postsVersion     bumped after the user posts, renames themselves, or one
+#                          of their posts is liked, unliked or commented
+#
+# A rename also bumps likesVersion on the posts the user liked and commentsVersion on
+# the posts they commented, and stamps those posts' namesChangedAt (bump_names), so
+# only the lists that show the name change their ETags.
+#
+# Counters are bumped only once the content write is done, and read routes read
+# them before the content, so a client can never be told its stale copy is current.
+# A feed's ETag pairs the reader's followVersion with the sum of the followed
+# authors' postsVersion: while the follow set is unchanged, the sum grows with
+# every change to the feed.
+
+
+def _increments(ids, field):
+    return [UpdateOne({"_id": doc_id}, {"$inc": {field: count}}) for doc_id, count in Counter(ids).items()]
+
+
+# Increment `field` once per occurrence of each id in `ids`
+def bump(collection, ids, field):
+    updates = _increments(ids, field)
+    if updates:
+        collection.bulk_write(updates, ordered=False)
+
+
+async def bump_async(collection, ids, field):
+    updates = _increments(ids, field)
+    if updates:
+        await collection.bulk_write(updates, ordered=False)
+
+
+def _rename_update(field, now):
+    return {"$inc": {field: 1}, "$max": {"namesChangedAt": now}}
+
+
+# New versions for the likes and comments lists that show `user_id`'s name, after a rename at `now`
+def bump_names(db, user_id, now):
+    db.posts.update_many({"likes": user_id}, _rename_update("likesVersion", now))
+    commented = db.comment_buckets.distinct("post", {"comments.author": user_id})
+    if commented:
+        db.posts.update_many({"_id": {"$in": commented}}, _rename_update("commentsVersion", now))
+
+
+async def bump_names_async(db, user_id, now):
+    await db.posts.update_many({"likes": user_id}, _rename_update("likesVersion", now))
+    commented = await db.comment_buckets.distinct("post", {"comments.author": user_id})
+    if commented:
+        await db.posts.update_many({"_id": {"$in": commented}}, _rename_update("commentsVersion", now))
+
+
+def authors_query(following):
+    return {"_id": {"$in": following}}, {"postsVersion": 1}
+
+
+def likes_etag(post):
+    return f"likes-{post.get('likesVersion', 0)}"
+
+
+def comments_etag(post):
+    return f"comments-{post.get('commentsVersion', 0)}"
+
+
+def feed_etag(user, authors):
+    return f"feed-{user.get('followVersion', 0)}-{sum(author.get('postsVersion', 0) for author in authors)}"
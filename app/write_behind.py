@@ -0,0 +1,294 @@
+import asyncio
+import atexit
+import logging
+import threading
+from collections import Counter
+
+from pymongo import UpdateOne
+
+import comments
+import versions
+
+# Write-behind queue for likes and comments (WRITE_BEHIND=on).
+#
+# On a viral post every like and comment is another update of the same document,
+# and those updates serialize on it. In this mode the routes only validate the
+# write, queue it and answer 202. A flusher applies the queue every
+# WRITE_BEHIND_FLUSH_INTERVAL_MS, or as soon as WRITE_BEHIND_FLUSH_SIZE writes are
+# waiting, with one bulk_write of likes and one comment append per post. A like
+# already queued for the same (post, user) is dropped, and the flush still only
+# adds likes the post does not have.
+#
+# The queue holds at most WRITE_BEHIND_MAX_QUEUE writes. When it is full, writers
+# wait up to WRITE_BEHIND_ENQUEUE_TIMEOUT_MS for room and then get QueueFull.
+# flush_user() applies one user's queued writes and waits for those already being
+# flushed, which gives that user read-your-writes. close() flushes what is left.
+# Writes in a flush that fails are logged and lost.
+#
+# WriteBehind runs its flusher in a thread for app.py; AsyncWriteBehind runs it
+# as a task on the event loop of asgi_app.py.
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class PendingWrites:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # post id -> {"author": ..., "likes": {user id: None}, "comments": [...]}, in arrival order
+        self.posts = {}
+        self.size = 0
+        # user id -> that user's writes that are queued or being flushed
+        self.unapplied = Counter()
+
+    def full(self):
+        return self.size >= self.max_size
+
+    def _batch(self, post_id, author):
+        return self.posts.setdefault(post_id, {"author": author, "likes": {}, "comments": []})
+
+    # Queue a like; returns False if the same like is already queued
+    def add_like(self, post_id, author, user_id):
+        likes = self._batch(post_id, author)["likes"]
+        if user_id in likes:
+            return False
+        likes[user_id] = None
+        self.size += 1
+        self.unapplied[user_id] += 1
+        return True
+
+    def add_comment(self, post_id, author, comment):
+        self._batch(post_id, author)["comments"].append(comment)
+        self.size += 1
+        self.unapplied[comment["author"]] += 1
+        return True
+
+    # Ids of the posts `user_id` has queued writes for
+    def posts_of(self, user_id):
+        return [
+            post_id for post_id, batch in self.posts.items()
+            if user_id in batch["likes"] or any(comment["author"] == user_id for comment in batch["comments"])
+        ]
+
+    # Remove and return the batches of `post_ids`, or of every post
+    def take(self, post_ids=None):
+        if post_ids is None:
+            post_ids = list(self.posts)
+        batches = {post_id: self.posts.pop(post_id) for post_id in post_ids if post_id in self.posts}
+        self.size -= sum(len(batch["likes"]) + len(batch["comments"]) for batch in batches.values())
+        return batches
+
+    # Forget taken batches once their flush is over
+    def done(self, batches):
+        for batch in batches.values():
+            self.unapplied.subtract(list(batch["likes"]))
+            self.unapplied.subtract(comment["author"] for comment in batch["comments"])
+        self.unapplied += Counter()  # drop the users left at zero
+
+
+def _like_updates(post_id, user_ids):
+    return [
+        UpdateOne(
+            {"_id": post_id, "likes": {"$ne": user_id}},
+            {"$push": {"likes": user_id}, "$inc": {"likeCount": 1, "likesVersion": 1}}
+        )
+        for user_id in user_ids
+    ]
+
+
+# Apply taken batches; the authors of changed posts get one postsVersion bump each
+def apply_batches(db, batches, bucket_size, preview_size):
+    authors = []
+    for post_id, batch in batches.items():
+        changed = False
+        if batch["likes"]:
+            result = db.posts.bulk_write(_like_updates(post_id, batch["likes"]), ordered=False)
+            changed = result.modified_count > 0
+        if batch["comments"]:
+            changed = comments.add_comments(db, post_id, batch["comments"], bucket_size, preview_size) or changed
+        if changed:
+            authors.append(batch["author"])
+    versions.bump(db.users, authors, "postsVersion")
+
+
+async def apply_batches_async(db, batches, bucket_size, preview_size):
+    authors = []
+    for post_id, batch in batches.items():
+        changed = False
+        if batch["likes"]:
+            result = await db.posts.bulk_write(_like_updates(post_id, batch["likes"]), ordered=False)
+            changed = result.modified_count > 0
+        if batch["comments"]:
+            author = await comments.add_comments_async(db, post_id, batch["comments"], bucket_size, preview_size)
+            changed = author or changed
+        if changed:
+            authors.append(batch["author"])
+    await versions.bump_async(db.users, authors, "postsVersion")
+
+
+class WriteBehind:
+    def __init__(self, db, config):
+        self.db = db
+        self.pending = PendingWrites(config["WRITE_BEHIND_MAX_QUEUE"])
+        self.flush_size = config["WRITE_BEHIND_FLUSH_SIZE"]
+        self.interval = config["WRITE_BEHIND_FLUSH_INTERVAL_MS"] / 1000
+        self.enqueue_timeout = config["WRITE_BEHIND_ENQUEUE_TIMEOUT_MS"] / 1000
+        self.bucket_size = config["COMMENT_BUCKET_SIZE"]
+        self.preview_size = config["COMMENT_PREVIEW_SIZE"]
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
+
+    # The flusher starts with the first write, so forked server workers each get their own
+    def _start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def _enqueue(self, add):
+        with self.condition:
+            if not self.condition.wait_for(lambda: not self.pending.full(), self.enqueue_timeout):
+                raise QueueFull()
+            self._start()
+            queued = add()
+            if self.pending.size >= self.flush_size:
+                self.condition.notify_all()
+            return queued
+
+    # Queue a like; returns False if the same like is already queued
+    def like(self, post_id, author, user_id):
+        return self._enqueue(lambda: self.pending.add_like(post_id, author, user_id))
+
+    def comment(self, post_id, author, comment):
+        return self._enqueue(lambda: self.pending.add_comment(post_id, author, comment))
+
+    # Apply the queued writes of `post_ids`, or all of them
+    def flush(self, post_ids=None):
+        with self.condition:
+            batches = self.pending.take(post_ids)
+            # Wake writers waiting for room
+            self.condition.notify_all()
+        if not batches:
+            return
+        try:
+            apply_batches(self.db, batches, self.bucket_size, self.preview_size)
+        except Exception:
+            logger.exception("write-behind flush of %d posts failed", len(batches))
+        finally:
+            with self.condition:
+                self.pending.done(batches)
+                self.condition.notify_all()
+
+    # Read-your-writes: apply the user's queued writes and wait for those being flushed
+    def flush_user(self, user_id):
+        with self.condition:
+            if not self.pending.unapplied[user_id]:
+                return
+            post_ids = self.pending.posts_of(user_id)
+        self.flush(post_ids)
+        with self.condition:
+            self.condition.wait_for(lambda: not self.pending.unapplied[user_id])
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or self.pending.size >= self.flush_size, self.interval)
+                if self.closed:
+                    return
+            self.flush()
+
+    # Stop the flusher and apply whatever is still queued
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+
+class AsyncWriteBehind:
+    def __init__(self, config):
+        self.db = None
+        self.pending = PendingWrites(config["WRITE_BEHIND_MAX_QUEUE"])
+        self.flush_size = config["WRITE_BEHIND_FLUSH_SIZE"]
+        self.interval = config["WRITE_BEHIND_FLUSH_INTERVAL_MS"] / 1000
+        self.enqueue_timeout = config["WRITE_BEHIND_ENQUEUE_TIMEOUT_MS"] / 1000
+        self.bucket_size = config["COMMENT_BUCKET_SIZE"]
+        self.preview_size = config["COMMENT_PREVIEW_SIZE"]
+        self.condition = None
+        self.task = None
+        self.closed = False
+
+    # Called once the event loop is running and the database is connected
+    def start(self, db):
+        self.db = db
+        self.condition = asyncio.Condition()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _wait_for(self, predicate, timeout):
+        try:
+            await asyncio.wait_for(self.condition.wait_for(predicate), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return predicate()
+
+    async def _enqueue(self, add):
+        async with self.condition:
+            if not await self._wait_for(lambda: not self.pending.full(), self.enqueue_timeout):
+                raise QueueFull()
+            queued = add()
+            if self.pending.size >= self.flush_size:
+                self.condition.notify_all()
+            return queued
+
+    async def like(self, post_id, author, user_id):
+        return await self._enqueue(lambda: self.pending.add_like(post_id, author, user_id))
+
+    async def comment(self, post_id, author, comment):
+        return await self._enqueue(lambda: self.pending.add_comment(post_id, author, comment))
+
+    async def flush(self, post_ids=None):
+        async with self.condition:
+            batches = self.pending.take(post_ids)
+            self.condition.notify_all()
+        if not batches:
+            return
+        try:
+            await apply_batches_async(self.db, batches, self.bucket_size, self.preview_size)
+        except Exception:
+            logger.exception("write-behind flush of %d posts failed", len(batches))
+        finally:
+            async with self.condition:
+                self.pending.done(batches)
+                self.condition.notify_all()
+
+    async def flush_user(self, user_id):
+        async with self.condition:
+            if not self.pending.unapplied[user_id]:
+                return
+            post_ids = self.pending.posts_of(user_id)
+        await self.flush(post_ids)
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.pending.unapplied[user_id])
+
+    async def _run(self):
+        while True:
+            async with self.condition:
+                await self._wait_for(lambda: self.closed or self.pending.size >= self.flush_size, self.interval)
+                if self.closed:
+                    return
+            await self.flush()
+
+    async def close(self):
+        if self.task is None:
+            return
+        async with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        await self.task
+        await self.flush()
@@ -0,0 +1,130 @@
+"""Load test: per-route latency with and without admission control.
+
+Starts app.py under gunicorn twice against the same synthetic graph: once
+without limits and once with the admission settings given by --set (by
+default a feed concurrency cap and a short queue deadline). Both runs drive
+the same feed-dominated workload hard enough to saturate the feed, and the
+table shows p50/p99 latency and shed requests (503) per route side by side.
+With admission control the feed sheds load while the cheap routes, likes in
+particular, keep their p99. The database is wiped with /cleanup before and
+after, so point --mongo-uri at a scratch database:
+
+    python bench/admission.py --mongo-uri mongodb://localhost:27017/bench_admission --workers 64
+    python bench/admission.py --set FEED_MAX_CONCURRENCY=4 --set ADMISSION_QUEUE_TIMEOUT_MS=20
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from dataclasses import asdict
+from datetime import datetime, timezone
+
+import requests
+
+from load_test import BENCH_DIR, WORKLOADS, git_commit, run, summarize, workload_requests
+from server_sweep import APP_DIR, stop_server, wait_until_ready
+from social_graph import GraphConfig, build_graph
+
+DEFAULT_SETTINGS = ["FEED_MAX_CONCURRENCY=2", "ADMISSION_QUEUE_TIMEOUT_MS=50"]
+
+
+def start_server(args, settings):
+    env = dict(
+        os.environ,
+        MONGO_URI=args.mongo_uri,
+        GUNICORN_BIND=f"127.0.0.1:{args.port}",
+        GUNICORN_WORKERS=str(args.server_workers),
+        GUNICORN_THREADS=str(args.threads),
+        GUNICORN_ACCESS_LOG="",
+        **settings,
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"], cwd=APP_DIR, env=env
+    )
+
+
+def print_table(results):
+    names = list(results)
+    routes = sorted({route for result in results.values() for route in result["routes"]})
+    header = "".join(f" {name + ' p50':>16} {'p99':>9} {'shed':>6}" for name in names)
+    print(f"\n{'route':<32}{header}")
+    for route in routes:
+        cells = ""
+        for name in names:
+            stats = results[name]["routes"].get(route)
+            if stats:
+                cells += f" {stats['p50_ms']:>16} {stats['p99_ms']:>9} {stats['statuses'].get('503', 0):>6}"
+            else:
+                cells += f" {'-':>16} {'-':>9} {'-':>6}"
+        print(f"{route:<32}{cells}")
+    print("(latency in ms; shed: 503 responses)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/bench_admission")
+    parser.add_argument("--port", type=int, default=5056)
+    parser.add_argument("--set", action="append", metavar="NAME=VALUE",
+                        help=f"admission setting for the second run; repeatable (default: {' '.join(DEFAULT_SETTINGS)})")
+    parser.add_argument("--server-workers", type=int, default=1, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=8, help="GUNICORN_THREADS per worker")
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="feed-heavy")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per run")
+    parser.add_argument("--warmup", type=float, default=3, help="unrecorded seconds before each run")
+    parser.add_argument("--workers", type=int, default=64, help="concurrent client threads")
+    parser.add_argument("--users", type=int, default=GraphConfig.users)
+    parser.add_argument("--seed", type=int, default=GraphConfig.seed)
+    parser.add_argument("--output", help="report path (default: bench/results/admission-<timestamp>.json)")
+    args = parser.parse_args()
+
+    settings = dict(setting.split("=", 1) for setting in (args.set or DEFAULT_SETTINGS))
+    runs = {"baseline": {}, "admission": settings}
+    base_url = f"http://127.0.0.1:{args.port}"
+    config = GraphConfig(users=args.users, seed=args.seed)
+    next_request = workload_requests(args.workload)
+    graph = None
+    results = {}
+    for index, (name, run_settings) in enumerate(runs.items()):
+        server = start_server(args, run_settings)
+        try:
+            wait_until_ready(base_url, server)
+            if graph is None:
+                requests.post(f"{base_url}/cleanup").raise_for_status()
+                graph = build_graph(base_url, config)
+            if args.warmup:
+                run(base_url, graph, next_request, args.workers, args.warmup, args.seed)
+            results[name] = summarize(*run(base_url, graph, next_request, args.workers, args.duration, args.seed))
+            print(f"{name}: {results[name]['throughput_rps']} req/s, {results[name]['errors']} errors")
+            if index == len(runs) - 1:
+                requests.post(f"{base_url}/cleanup").raise_for_status()
+        finally:
+            stop_server(server)
+
+    print_table(results)
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "workload": args.workload,
+            "client_workers": args.workers,
+            "server_workers": args.server_workers,
+            "server_threads": args.threads,
+            "duration_s": args.duration,
+            "settings": settings,
+            "graph": asdict(config),
+        },
+        "runs": results,
+    }
+    output = args.output or os.path.join(
+        BENCH_DIR, "results", f"admission-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nreport written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""Benchmark: memory and read latency before and after archiving old posts.
+
+Seeds a scratch database straight through PyMongo, in the shapes the app writes:
+--posts posts by --authors users, created evenly over the last --days days, with
+likes arrays and comment buckets. The first --readers users follow
+--follows-per-reader authors each. Then it times the read routes in-process,
+through the app's test client:
+- a reader's first feed page, and a feed page from before the archive cutoff;
+- the likes and the comments of old and of recent posts.
+It runs the archival job (archive.py) for posts older than --archive-after-days
+and times the same reads again.
+
+Collection and index sizes before and after show how much smaller the hot
+collections get. The bytes WiredTiger read into its cache during each round of
+reads show what the reads cost in memory; that only says something when the data
+is larger than the cache, so seed more posts than fit, or start mongod with a
+small --wiredTigerCacheSizeGB. Prints a table and writes a JSON report in
+bench/results/:
+
+    MONGO_URI=mongodb://localhost:27017/bench_archive python bench/archive.py --posts 200000
+
+The database is dropped at the end.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson.objectid import ObjectId
+
+from load_test import BENCH_DIR, git_commit, percentile
+from social_graph import zipf_weights
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/bench_archive")
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "app"))
+
+import archive  # noqa: E402
+import indexes  # noqa: E402
+from app import app, mongo  # noqa: E402
+from pagination import encode_cursor  # noqa: E402
+
+BATCH_SIZE = 5000
+COLLECTIONS = ("posts", "comment_buckets", "posts_archive")
+# Posts whose likes and comments are timed, per age group
+SAMPLE_POSTS = 50
+
+
+def seed(db, args, now):
+    rng = random.Random(args.seed)
+    bucket_size = app.config["COMMENT_BUCKET_SIZE"]
+    preview_size = app.config["COMMENT_PREVIEW_SIZE"]
+    authors = [ObjectId() for _ in range(args.authors)]
+    db.users.insert_many([
+        {"_id": author, "firstName": f"Author{i}", "lastName": "Archive", "birthDate": "1990-01-01", "bio": "Bio",
+         "followerCount": 0, "followingCount": 0}
+        for i, author in enumerate(authors)
+    ])
+    readers = authors[:args.readers]
+    db.follows.insert_many([
+        {"follower": reader, "followee": followee, "createdAt": now}
+        for reader in readers
+        for followee in rng.sample(authors, min(args.follows_per_reader, len(authors)))
+    ])
+
+    author_weights = list(itertools.accumulate(zipf_weights(args.authors, 1.0)))
+    old, recent = [], []
+    cutoff = now - timedelta(days=args.archive_after_days)
+    for first in range(0, args.posts, BATCH_SIZE):
+        posts, buckets = [], []
+        for _ in range(first, min(first + BATCH_SIZE, args.posts)):
+            post_id = ObjectId()
+            created_at = now - timedelta(days=rng.random() * args.days)
+            likes = rng.sample(authors, min(rng.randint(0, args.likes_per_post * 2), len(authors)))
+            comments = [
+                {"_id": ObjectId(), "author": rng.choice(authors), "text": f"Comment {i} " + "x" * 80,
+                 "createdAt": created_at}
+                for i in range(rng.randint(0, args.comments_per_post * 2))
+            ]
+            for seq in range(0, len(comments), bucket_size):
+                chunk = comments[seq:seq + bucket_size]
+                buckets.append({"post": post_id, "seq": seq // bucket_size, "count": len(chunk), "comments": chunk})
+            posts.append({
+                "_id": post_id,
+                "author": rng.choices(authors, cum_weights=author_weights)[0],
+                "content": "Post " + "y" * rng.randint(20, 280),
+                "createdAt": created_at,
+                "likes": likes,
+                "likeCount": len(likes),
+                "likesVersion": len(likes),
+                "commentCount": len(comments),
+                "commentsVersion": len(comments),
+                "commentPreview": comments[-preview_size:],
+            })
+            if likes and comments:
+                (old if created_at < cutoff else recent).append(post_id)
+        db.posts.insert_many(posts, ordered=False)
+        if buckets:
+            db.comment_buckets.insert_many(buckets, ordered=False)
+        print(f"\rseeded {first + len(posts)}/{args.posts} posts", end="", flush=True)
+    print()
+    return readers, rng.sample(old, min(SAMPLE_POSTS, len(old))), rng.sample(recent, min(SAMPLE_POSTS, len(recent)))
+
+
+def collection_stats(db):
+    stats = {}
+    for name in COLLECTIONS:
+        result = db.command("collStats", name)
+        stats[name] = {key: result.get(key, 0) for key in ("count", "size", "storageSize", "totalIndexSize")}
+    return stats
+
+
+# Bytes WiredTiger has read into its cache so far, or None without WiredTiger
+def cache_bytes_read(db):
+    cache = db.command("serverStatus").get("wiredTiger", {}).get("cache", {})
+    return cache.get("bytes read into cache")
+
+
+def timed(client, paths, repeat):
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        response = client.get(paths[i % len(paths)])
+        durations.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.get_data(as_text=True)
+    durations.sort()
+    return {
+        "p50_ms": round(percentile(durations, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(durations, 0.95) * 1000, 2),
+    }
+
+
+def measure(db, client, cases, repeat):
+    before = cache_bytes_read(db)
+    latencies = {name: timed(client, paths, repeat) for name, paths in cases.items()}
+    after = cache_bytes_read(db)
+    return {
+        "latency": latencies,
+        "cache_bytes_read": after - before if before is not None and after is not None else None,
+    }
+
+
+def hot_bytes(stats):
+    return sum(stats[name]["size"] + stats[name]["totalIndexSize"] for name in ("posts", "comment_buckets"))
+
+
+def print_report(report):
+    print(f"\n{'collection':<16} {'before MB':>10} {'after MB':>10} {'storage MB':>11} {'index MB':>9}")
+    for name in COLLECTIONS:
+        before, after = report["before"]["collections"][name], report["after"]["collections"][name]
+        print(f"{name:<16} {before['size'] / 2**20:>10.1f} {after['size'] / 2**20:>10.1f} "
+              f"{after['storageSize'] / 2**20:>11.1f} {after['totalIndexSize'] / 2**20:>9.1f}")
+    print(f"hot data + indexes: {report['before']['hot_bytes'] / 2**20:.1f} MB -> "
+          f"{report['after']['hot_bytes'] / 2**20:.1f} MB")
+    print(f"\n{'case':<24} {'before p50':>11} {'p95':>8} {'after p50':>10} {'p95':>8}")
+    for name, before in report["before"]["latency"].items():
+        after = report["after"]["latency"][name]
+        print(f"{name:<24} {before['p50_ms']:>11} {before['p95_ms']:>8} {after['p50_ms']:>10} {after['p95_ms']:>8}")
+    print(f"cache bytes read by the reads: {report['before']['cache_bytes_read']} -> "
+          f"{report['after']['cache_bytes_read']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--posts", type=int, default=200000)
+    parser.add_argument("--authors", type=int, default=5000)
+    parser.add_argument("--days", type=float, default=730, help="posts are created evenly over this many days")
+    parser.add_argument("--archive-after-days", type=float, default=365)
+    parser.add_argument("--likes-per-post", type=int, default=20, help="mean likes per post")
+    parser.add_argument("--comments-per-post", type=int, default=5, help="mean comments per post")
+    parser.add_argument("--readers", type=int, default=200, help="users whose feeds are timed")
+    parser.add_argument("--follows-per-reader", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=200, help="timed requests per case")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="report path (default: bench/results/archive-<timestamp>.json)")
+    args = parser.parse_args()
+
+    client = app.test_client()
+    with app.app_context():
+        db = mongo.db
+        mongo.cx.drop_database(db.name)
+        now = datetime.utcnow()
+        readers, old_posts, recent_posts = seed(db, args, now)
+        indexes.ensure_indexes(db)
+
+        # A feed page that starts before the cutoff, so after archiving it is served from the archive
+        old_cursor = encode_cursor(now - timedelta(days=args.archive_after_days + 1), ObjectId("f" * 24))
+        cases = {
+            "feed first page": [f"/users/{reader}/feed" for reader in readers],
+            "feed old page": [f"/users/{reader}/feed?cursor={old_cursor}" for reader in readers],
+            "likes old post": [f"/posts/{post}/likes" for post in old_posts],
+            "comments old post": [f"/posts/{post}/comments" for post in old_posts],
+            "likes recent post": [f"/posts/{post}/likes" for post in recent_posts],
+            "comments recent post": [f"/posts/{post}/comments" for post in recent_posts],
+        }
+        cases = {name: paths for name, paths in cases.items() if paths}
+
+        report = {"before": measure(db, client, cases, args.repeat)}
+        report["before"]["collections"] = collection_stats(db)
+        report["before"]["hot_bytes"] = hot_bytes(report["before"]["collections"])
+
+        start = time.perf_counter()
+        archived = archive.archive_posts(
+            db, now - timedelta(days=args.archive_after_days), app.config["ARCHIVE_BATCH_SIZE"],
+            app.config["COMMENT_PREVIEW_SIZE"]
+        )
+        elapsed = time.perf_counter() - start
+        print(f"archived {archived} posts in {elapsed:.1f} s")
+
+        report["after"] = measure(db, client, cases, args.repeat)
+        report["after"]["collections"] = collection_stats(db)
+        report["after"]["hot_bytes"] = hot_bytes(report["after"]["collections"])
+        report["meta"] = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "posts": args.posts,
+            "authors": args.authors,
+            "days": args.days,
+            "archive_after_days": args.archive_after_days,
+            "archived": archived,
+            "archive_seconds": round(elapsed, 2),
+        }
+        mongo.cx.drop_database(db.name)
+
+    print_report(report)
+    output = args.output or os.path.join(
+        BENCH_DIR, "results", f"archive-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nreport written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
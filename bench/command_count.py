@@ -0,0 +1,98 @@
+"""Regression benchmark: number of Mongo commands issued per read request.
+
+Seeds one post with many likes and comments through the API, then counts the
+commands each read route sends to Mongo. The counts must stay flat as the
+number of likers/commenters grows, so an N+1 lookup pattern fails the run.
+
+    MONGO_URI=mongodb://localhost:27017/bench_command_count python bench/command_count.py
+"""
+import argparse
+import os
+import sys
+import time
+
+from pymongo import monitoring
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/bench_command_count")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        self.commands.append(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# Listeners must be registered before the app creates its MongoClient
+counter = CommandCounter()
+monitoring.register(counter)
+
+from app import app, mongo  # noqa: E402
+
+# Maximum commands per request, independent of the number of likes/comments
+BUDGETS = {
+    "likes": 4,
+    "comments": 4,
+}
+
+
+def seed(client, size):
+    author = client.post("/users", json={
+        "firstName": "Bench", "lastName": "Author", "birthDate": "1990-01-01", "bio": "Bio"
+    }).get_json()["userId"]
+    post = client.post("/posts", json={"authorId": author, "content": "Viral post"}).get_json()["postId"]
+    for i in range(size):
+        user = client.post("/users", json={
+            "firstName": f"User{i}", "lastName": "Bench", "birthDate": "1990-01-01", "bio": "Bio"
+        }).get_json()["userId"]
+        client.post(f"/posts/{post}/likes", json={"userId": user})
+        client.post(f"/posts/{post}/comments", json={"authorId": user, "text": f"Comment {i}"})
+    return post
+
+
+def drop_database():
+    with app.app_context():
+        mongo.cx.drop_database(mongo.db.name)
+
+
+def measure(client, path):
+    counter.commands.clear()
+    start = time.perf_counter()
+    response = client.get(path)
+    elapsed = time.perf_counter() - start
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return list(counter.commands), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=500, help="likes and comments on the seeded post")
+    args = parser.parse_args()
+
+    client = app.test_client()
+    drop_database()
+    post = seed(client, args.size)
+
+    failed = False
+    for route, path in (("likes", f"/posts/{post}/likes"), ("comments", f"/posts/{post}/comments")):
+        commands, elapsed = measure(client, path)
+        budget = BUDGETS[route]
+        status = "ok" if len(commands) <= budget else "FAIL"
+        failed = failed or status == "FAIL"
+        print(f"{route:<10} size={args.size:<6} commands={len(commands):<4} budget={budget:<3} "
+              f"{elapsed * 1000:8.1f} ms  {status}  {commands}")
+
+    drop_database()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,326 @@
+"""Load test: throughput and latency percentiles per route under mixed workloads.
+
+Loads a synthetic social graph (see social_graph.py) into a running server,
+drives named workloads or replays a JSONL trace against it, and writes a JSON
+report with throughput and p50/p95/p99 latency per route. The server's
+database is wiped with /cleanup before and after the run, so point the server
+at a scratch database:
+
+    MONGO_URI=mongodb://localhost:27017/bench_load python app/app.py &
+    python bench/load_test.py --users 2000 --workload feed-heavy --workload viral-post
+    python bench/load_test.py --trace bench/traces/mixed.jsonl
+
+Runs with the same --seed and graph options generate the same graph and
+request sequence (per worker), so reports from two commits can be compared.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from dataclasses import asdict
+from datetime import datetime, timezone
+
+import requests
+
+from social_graph import GraphConfig, build_graph
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# Each operation picks its targets from the graph and returns (route, method, path, body).
+# `route` is the route template the latencies are grouped by.
+def read_feed(graph, rng):
+    user = graph.random_user(rng)
+    return "GET /users/<id>/feed", "GET", f"/users/{user}/feed", None
+
+
+def read_likes(graph, rng):
+    return "GET /posts/<id>/likes", "GET", f"/posts/{graph.random_post(rng)}/likes", None
+
+
+def read_comments(graph, rng):
+    return "GET /posts/<id>/comments", "GET", f"/posts/{graph.random_post(rng)}/comments", None
+
+
+def create_post(graph, rng):
+    # Popular authors post most, which is what makes fan-out on write expensive
+    author = graph.popular_user(rng)
+    return "POST /posts", "POST", "/posts", {"authorId": author, "content": "Load test post"}
+
+
+def like_post(graph, rng):
+    post, user = graph.random_post(rng), graph.random_user(rng)
+    return "POST /posts/<id>/likes", "POST", f"/posts/{post}/likes", {"userId": user}
+
+
+def comment_post(graph, rng):
+    post, user = graph.random_post(rng), graph.random_user(rng)
+    return "POST /posts/<id>/comments", "POST", f"/posts/{post}/comments", {"authorId": user, "text": "Load test"}
+
+
+def follow_user(graph, rng):
+    user, followee = graph.random_user(rng), graph.popular_user(rng)
+    return "POST /users/<id>/follow", "POST", f"/users/{user}/follow", {"followId": followee}
+
+
+def unfollow_user(graph, rng):
+    user, followee = graph.random_user(rng), graph.popular_user(rng)
+    return "POST /users/<id>/unfollow", "POST", f"/users/{user}/unfollow", {"unfollowId": followee}
+
+
+def like_viral(graph, rng):
+    user = graph.random_user(rng)
+    return "POST /posts/<id>/likes", "POST", f"/posts/{graph.viral_post}/likes", {"userId": user}
+
+
+def comment_viral(graph, rng):
+    user = graph.random_user(rng)
+    body = {"authorId": user, "text": "Load test"}
+    return "POST /posts/<id>/comments", "POST", f"/posts/{graph.viral_post}/comments", body
+
+
+def read_viral_likes(graph, rng):
+    return "GET /posts/<id>/likes", "GET", f"/posts/{graph.viral_post}/likes", None
+
+
+def read_viral_comments(graph, rng):
+    return "GET /posts/<id>/comments", "GET", f"/posts/{graph.viral_post}/comments", None
+
+
+# Workload name -> [(operation, weight)]
+WORKLOADS = {
+    "feed-heavy": [
+        (read_feed, 80), (read_likes, 8), (read_comments, 7), (like_post, 5),
+    ],
+    "write-heavy": [
+        (create_post, 30), (like_post, 30), (comment_post, 25),
+        (follow_user, 5), (unfollow_user, 5), (read_feed, 5),
+    ],
+    "viral-post": [
+        (like_viral, 40), (comment_viral, 20), (read_viral_likes, 20),
+        (read_viral_comments, 10), (read_feed, 10),
+    ],
+}
+
+
+def workload_requests(name):
+    operations, weights = zip(*WORKLOADS[name])
+
+    def next_request(graph, rng):
+        return rng.choices(operations, weights=weights, k=1)[0](graph, rng)
+    return next_request
+
+
+# Traces are JSONL, one request per line:
+#   {"method": "POST", "path": "/posts/{post}/likes", "json": {"userId": "{user}"}}
+# Placeholders are filled from the graph for every request: {user} a random user,
+# {popular_user} a user picked by popularity, {post} a random post and
+# {viral_post} the viral post. "route" optionally overrides the grouping name.
+PLACEHOLDER = re.compile(r"\{(user|popular_user|post|viral_post)\}")
+
+
+def load_trace(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+def _fill(value, graph, rng):
+    if isinstance(value, str):
+        pickers = {
+            "user": graph.random_user,
+            "popular_user": graph.popular_user,
+            "post": graph.random_post,
+            "viral_post": lambda rng: graph.viral_post,
+        }
+        return PLACEHOLDER.sub(lambda match: pickers[match.group(1)](rng), value)
+    if isinstance(value, dict):
+        return {key: _fill(item, graph, rng) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_fill(item, graph, rng) for item in value]
+    return value
+
+
+def trace_requests(trace):
+    # Workers share one position in the trace, so it is replayed in order (and repeated if the run outlasts it)
+    position = iter(range(sys.maxsize))
+    lock = threading.Lock()
+
+    def next_request(graph, rng):
+        with lock:
+            line = trace[next(position) % len(trace)]
+        method = line.get("method", "GET").upper()
+        route = line.get("route") or f"{method} {line['path'].split('?')[0]}"
+        return route, method, _fill(line["path"], graph, rng), _fill(line.get("json"), graph, rng)
+    return next_request
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run(base_url, graph, next_request, workers, duration, seed):
+    """Drive requests from `workers` threads for `duration` seconds; return raw samples per route."""
+    latencies = defaultdict(list)
+    statuses = defaultdict(Counter)
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        session = requests.Session()
+        local_latencies = defaultdict(list)
+        local_statuses = defaultdict(Counter)
+        while time.perf_counter() < deadline:
+            route, method, path, body = next_request(graph, rng)
+            start = time.perf_counter()
+            try:
+                response = session.request(method, base_url + path, json=body)
+                # Read the whole body so streamed responses are fully timed
+                response.content
+                status = str(response.status_code)
+            except requests.RequestException:
+                status = "error"
+            local_latencies[route].append(time.perf_counter() - start)
+            local_statuses[route][status] += 1
+        with lock:
+            for route, values in local_latencies.items():
+                latencies[route].extend(values)
+                statuses[route].update(local_statuses[route])
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, time.perf_counter() - started
+
+
+def _is_error(status):
+    return status == "error" or status.startswith("5")
+
+
+def summarize(latencies, statuses, elapsed):
+    routes = {}
+    for route in sorted(latencies):
+        values = sorted(latencies[route])
+        routes[route] = {
+            "requests": len(values),
+            "throughput_rps": round(len(values) / elapsed, 1),
+            "errors": sum(count for status, count in statuses[route].items() if _is_error(status)),
+            "statuses": dict(statuses[route]),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+            "max_ms": round(values[-1] * 1000, 2),
+        }
+    total = sum(route["requests"] for route in routes.values())
+    return {
+        "elapsed_s": round(elapsed, 2),
+        "requests": total,
+        "throughput_rps": round(total / elapsed, 1) if elapsed else 0,
+        "errors": sum(route["errors"] for route in routes.values()),
+        "routes": routes,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(name, result):
+    print(f"\n{name}: {result['requests']} requests in {result['elapsed_s']} s, "
+          f"{result['throughput_rps']} req/s, {result['errors']} errors")
+    print(f"  {'route':<32} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for route, stats in result["routes"].items():
+        print(f"  {route:<32} {stats['throughput_rps']:>8} {stats['p50_ms']:>8} "
+              f"{stats['p95_ms']:>8} {stats['p99_ms']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--base-url", default="http://127.0.0.1:5000")
+    parser.add_argument("--workload", action="append", choices=sorted(WORKLOADS),
+                        help="workload to run; repeatable (default: all)")
+    parser.add_argument("--trace", help="JSONL trace to replay instead of the named workloads")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per workload")
+    parser.add_argument("--warmup", type=float, default=5, help="unrecorded seconds before each workload")
+    parser.add_argument("--workers", type=int, default=16, help="concurrent client threads")
+    parser.add_argument("--users", type=int, default=GraphConfig.users)
+    parser.add_argument("--follows-per-user", type=int, default=GraphConfig.follows_per_user)
+    parser.add_argument("--zipf-exponent", type=float, default=GraphConfig.zipf_exponent)
+    parser.add_argument("--posts-per-user", type=float, default=GraphConfig.posts_per_user)
+    parser.add_argument("--likes-per-post", type=float, default=GraphConfig.likes_per_post)
+    parser.add_argument("--comments-per-post", type=float, default=GraphConfig.comments_per_post)
+    parser.add_argument("--seed", type=int, default=GraphConfig.seed)
+    parser.add_argument("--output", help="report path (default: bench/results/load-<timestamp>.json)")
+    parser.add_argument("--keep-data", action="store_true", help="do not clean up the database after the run")
+    args = parser.parse_args()
+
+    config = GraphConfig(
+        users=args.users, follows_per_user=args.follows_per_user, zipf_exponent=args.zipf_exponent,
+        posts_per_user=args.posts_per_user, likes_per_post=args.likes_per_post,
+        comments_per_post=args.comments_per_post, seed=args.seed
+    )
+    if args.trace:
+        runs = [(os.path.basename(args.trace), trace_requests(load_trace(args.trace)))]
+    else:
+        runs = [(name, workload_requests(name)) for name in (args.workload or sorted(WORKLOADS))]
+
+    requests.post(f"{args.base_url}/cleanup").raise_for_status()
+    started = time.perf_counter()
+    graph = build_graph(args.base_url, config)
+    seed_seconds = time.perf_counter() - started
+    print(f"graph: {len(graph.user_ids)} users, {sum(map(len, graph.following.values()))} follows, "
+          f"{len(graph.post_ids)} posts, loaded in {seed_seconds:.1f} s")
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "base_url": args.base_url,
+            "workers": args.workers,
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "graph": asdict(config),
+            "graph_load_s": round(seed_seconds, 2),
+        },
+        "workloads": {},
+    }
+    for name, next_request in runs:
+        if args.warmup:
+            run(args.base_url, graph, next_request, args.workers, args.warmup, args.seed)
+        result = summarize(*run(args.base_url, graph, next_request, args.workers, args.duration, args.seed))
+        report["workloads"][name] = result
+        print_summary(name, result)
+
+    if not args.keep_data:
+        requests.post(f"{args.base_url}/cleanup").raise_for_status()
+
+    output = args.output or os.path.join(
+        BENCH_DIR, "results", f"load-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nreport written to {output}")
+    return 1 if any(result["errors"] for result in report["workloads"].values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+"""Benchmark: GET /search latency at 1M posts, against a $regex scan.
+
+Seeds a scratch database straight through PyMongo, in the shapes the app
+writes: --posts posts of Zipf-distributed words from a synthetic vocabulary,
+by --authors users, with comment buckets on a share of them. Then it builds
+the indexes (indexes.py) and times the search aggregation (search.py) for
+terms of falling frequency, with an author filter and on a second cursor
+page, next to the $regex queries a search without a text index would run.
+Prints a table and writes a JSON report in bench/results/:
+
+    python bench/search.py --mongo-uri mongodb://localhost:27017/bench_search --posts 1000000
+
+Seeding 1M posts takes a few minutes; --keep leaves the database in place, and
+a later run with the same --posts and --seed reuses it.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson.objectid import ObjectId
+from pymongo import MongoClient
+
+from load_test import BENCH_DIR, git_commit, percentile
+from social_graph import zipf_weights
+
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "app"))
+
+import indexes  # noqa: E402
+import search  # noqa: E402
+from pagination import decode_rank_cursor  # noqa: E402
+
+SYLLABLES = ["ka", "lo", "ri", "sa", "tu", "me", "no", "vi", "da", "pe", "gi", "ra", "ju", "te", "bo", "ne"]
+BATCH_SIZE = 10000
+
+
+def vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words, key=lambda word: rng.random())
+
+
+def text(rng, words, cum_weights, length):
+    return " ".join(rng.choices(words, cum_weights=cum_weights, k=length))
+
+
+def seed(db, args):
+    rng = random.Random(args.seed)
+    words = vocabulary(args.vocabulary, rng)
+    cum_weights = list(itertools.accumulate(zipf_weights(args.vocabulary, args.zipf_exponent)))
+    authors = [ObjectId() for _ in range(args.authors)]
+    db.users.insert_many([
+        {"_id": author, "firstName": f"Author{i}", "lastName": "Search", "birthDate": "1990-01-01", "bio": "Bio",
+         "followerCount": 0, "followingCount": 0}
+        for i, author in enumerate(authors)
+    ])
+    author_weights = list(itertools.accumulate(zipf_weights(args.authors, 1.0)))
+    start = datetime.utcnow() - timedelta(days=365)
+    for first in range(0, args.posts, BATCH_SIZE):
+        posts, buckets = [], []
+        for i in range(first, min(first + BATCH_SIZE, args.posts)):
+            post_id = ObjectId()
+            comments = []
+            if rng.random() < args.commented_share:
+                comments = [
+                    {"_id": ObjectId(), "author": rng.choice(authors),
+                     "text": text(rng, words, cum_weights, rng.randint(3, 12)), "createdAt": start}
+                    for _ in range(rng.randint(1, args.comments_per_post * 2))
+                ]
+                buckets.append({"post": post_id, "seq": 0, "count": len(comments), "comments": comments})
+            posts.append({
+                "_id": post_id,
+                "author": rng.choices(authors, cum_weights=author_weights)[0],
+                "content": text(rng, words, cum_weights, rng.randint(5, 30)),
+                "createdAt": start + timedelta(seconds=i * 30),
+                "likes": [],
+                "likeCount": 0,
+                "commentCount": len(comments),
+                "commentPreview": comments[-3:],
+            })
+        db.posts.insert_many(posts, ordered=False)
+        if buckets:
+            db.comment_buckets.insert_many(buckets, ordered=False)
+        print(f"\rseeded {first + len(posts)}/{args.posts} posts", end="", flush=True)
+    print()
+    return words, authors[0]
+
+
+def timed(function, repeat):
+    durations = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    return result, {
+        "p50_ms": round(percentile(durations, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(durations, 0.95) * 1000, 2),
+    }
+
+
+def search_page(db, query, author, after, limit):
+    return list(db.posts.aggregate(search.search_stages(query, author, after, limit + 1, 3, "http")))
+
+
+# What a search without a text index runs: a case-insensitive word $regex over both collections
+def regex_page(db, query, limit):
+    pattern = {"$regex": rf"\b{re.escape(query)}\b", "$options": "i"}
+    posts = list(db.posts.find({"content": pattern}, {"_id": 1}).limit(limit))
+    buckets = list(db.comment_buckets.find({"comments.text": pattern}, {"post": 1}).limit(limit))
+    return posts + buckets
+
+
+def measure(db, words, author, args):
+    # Terms by frequency rank in the Zipf vocabulary
+    ranks = {"common": 0, "frequent": args.vocabulary // 200, "medium": args.vocabulary // 10,
+             "rare": args.vocabulary - 1}
+    cases = [(f"{name} (rank {rank + 1})", words[rank], None) for name, rank in ranks.items()]
+    cases += [
+        ("two terms", f"{words[ranks['frequent']]} {words[ranks['medium']]}", None),
+        ("medium + author", words[ranks["medium"]], author),
+    ]
+    rows = []
+    for name, query, author_id in cases:
+        content_matches = db.posts.count_documents({"$text": {"$search": query}})
+        page, first = timed(lambda: search_page(db, query, author_id, None, args.limit), args.repeat)
+        row = {"case": name, "query": query, "content_matches": content_matches, "results": len(page),
+               "search_first_page": first}
+        if len(page) > args.limit:
+            last = page[args.limit - 1]
+            after = decode_rank_cursor(search.next_cursor(last))
+            _, row["search_second_page"] = timed(
+                lambda: search_page(db, query, author_id, after, args.limit), args.repeat
+            )
+        if author_id is None and " " not in query:
+            _, row["regex_scan"] = timed(lambda: regex_page(db, query, args.limit), args.regex_repeat)
+        rows.append(row)
+        print(f"{name:<22} {content_matches:>9} content matches  search p50 {first['p50_ms']:>9} ms"
+              + (f"  regex p50 {row['regex_scan']['p50_ms']:>9} ms" if "regex_scan" in row else ""))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/bench_search")
+    parser.add_argument("--posts", type=int, default=1000000)
+    parser.add_argument("--authors", type=int, default=10000)
+    parser.add_argument("--vocabulary", type=int, default=20000, help="distinct words")
+    parser.add_argument("--zipf-exponent", type=float, default=1.0, help="word frequency skew")
+    parser.add_argument("--commented-share", type=float, default=0.2, help="share of posts with comments")
+    parser.add_argument("--comments-per-post", type=int, default=3, help="mean comments on a commented post")
+    parser.add_argument("--limit", type=int, default=20, help="page size")
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per search query")
+    parser.add_argument("--regex-repeat", type=int, default=3, help="timed runs per $regex query")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="keep the seeded database")
+    parser.add_argument("--output", help="report path (default: bench/results/search-<timestamp>.json)")
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongo_uri)
+    db = client.get_default_database()
+    if db.posts.estimated_document_count() != args.posts:
+        client.drop_database(db.name)
+        words, author = seed(db, args)
+    else:
+        # Same --posts and --seed: regenerate the vocabulary and first author without reseeding
+        rng = random.Random(args.seed)
+        words = vocabulary(args.vocabulary, rng)
+        author = db.users.find_one(sort=[("firstName", 1)])["_id"]
+    start = time.perf_counter()
+    indexes.ensure_indexes(db)
+    print(f"indexes ready in {time.perf_counter() - start:.1f} s")
+
+    rows = measure(db, words, author, args)
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "posts": args.posts,
+            "comment_buckets": db.comment_buckets.estimated_document_count(),
+            "authors": args.authors,
+            "vocabulary": args.vocabulary,
+            "limit": args.limit,
+        },
+        "cases": rows,
+    }
+    if not args.keep:
+        client.drop_database(db.name)
+    output = args.output or os.path.join(
+        BENCH_DIR, "results", f"search-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nreport written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""Benchmark: Python-side cost of serializing one feed page.
+
+Compares the old path, which post-processed every aggregated post in Python
+(stringify _id, isoformat the dates, flatten authorDetails) and then serialized
+it with Flask's default JSON provider, with the current path, where the
+aggregation emits the response shape and the app's JSON provider serializes it
+as is. Runs without Mongo on synthetic pages shaped like the pipeline output:
+
+    python bench/serialization.py --page-size 20 --page-size 100
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+import json_provider  # noqa: E402
+
+
+# Pipeline output before the conversions moved into the aggregation
+def raw_post(index, now):
+    created_at = now - timedelta(minutes=index)
+    return {
+        "_id": ObjectId(),
+        "content": f"Post {index} " + "lorem ipsum " * 10,
+        "createdAt": created_at,
+        "likes": index * 3,
+        "commentCount": 12,
+        "comments": [
+            {"text": "Nice post", "author": str(ObjectId()), "createdAt": created_at + timedelta(seconds=n)}
+            for n in range(3)
+        ],
+        "authorDetails": [{"firstName": "Jonas", "lastName": "Petraitis"}],
+    }
+
+
+# What the pipeline emits now with dateFormat=rfc3339: ids and dates already strings, author names flattened
+def converted_post(post):
+    return {
+        "_id": str(post["_id"]),
+        "content": post["content"],
+        "createdAt": post["createdAt"].strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+        "likes": post["likes"],
+        "commentCount": post["commentCount"],
+        "comments": [
+            dict(comment, createdAt=comment["createdAt"].strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z")
+            for comment in post["comments"]
+        ],
+        "authorFirstName": post["authorDetails"][0]["firstName"],
+        "authorLastName": post["authorDetails"][0]["lastName"],
+    }
+
+
+# The per-post loop get_feed used to run
+def legacy_serialize_post(post):
+    post["_id"] = str(post["_id"])
+    post["createdAt"] = post["createdAt"].isoformat()
+    if "authorDetails" in post and post["authorDetails"]:
+        author = post["authorDetails"][0]
+        post["authorFirstName"] = author["firstName"]
+        post["authorLastName"] = author["lastName"]
+        del post["authorDetails"]
+    return post
+
+
+def measure(app, page_size, number):
+    now = datetime.utcnow()
+    raw_pages = [[raw_post(i, now) for i in range(page_size)] for _ in range(number)]
+    converted = [converted_post(post) for post in raw_pages[0]]
+
+    def copies():
+        # The legacy loop mutates its input, so every run gets fresh shallow copies
+        return iter([[dict(post) for post in page] for page in raw_pages])
+
+    results = {}
+    with app.app_context():
+        app.json = DefaultJSONProvider(app)
+        pages = copies()
+        results["before: python loop + flask default"] = timeit.timeit(
+            lambda: app.json.response([legacy_serialize_post(post) for post in next(pages)]).get_data(),
+            number=number
+        )
+        for name in ("stdlib", "orjson"):
+            if name == "orjson" and json_provider.orjson is None:
+                continue
+            app.json = json_provider.create_provider(app, name)
+            results[f"after: pipeline shape + {name}"] = timeit.timeit(
+                lambda: app.json.response(converted).get_data(), number=number
+            )
+    return {name: round(total / number * 1e6, 1) for name, total in results.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--page-size", type=int, action="append", help="posts per page; repeatable (default: 20, 100)")
+    parser.add_argument("--number", type=int, default=2000, help="pages serialized per measurement")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    report = {size: measure(app, size, args.number) for size in (args.page_size or [20, 100])}
+    if args.json:
+        print(json.dumps({"us_per_page": report}, indent=2))
+        return 0
+    for size, results in report.items():
+        print(f"page size {size}")
+        for name, micros in results.items():
+            print(f"  {name:<40} {micros:>10.1f} us/page")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""Server sweep: throughput and latency of the gunicorn server per worker and pool count.
+
+Starts app.py under gunicorn (app/gunicorn.conf.py) once per combination of
+--server-workers and --pool-size, runs one load_test.py workload against each,
+and prints a table of throughput and p50/p99 latency per combination, plus a
+JSON report in bench/results/. The synthetic graph is loaded once, through the
+first server, and the database is wiped with /cleanup before and after, so
+point --mongo-uri at a scratch database:
+
+    python bench/server_sweep.py --mongo-uri mongodb://localhost:27017/bench_sweep \\
+        --server-workers 1 --server-workers 2 --server-workers 4 --pool-size 10 --pool-size 50
+"""
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+from dataclasses import asdict
+from datetime import datetime, timezone
+
+import requests
+
+from load_test import BENCH_DIR, WORKLOADS, git_commit, run, summarize, workload_requests
+from social_graph import GraphConfig, build_graph
+
+APP_DIR = os.path.join(BENCH_DIR, "..", "app")
+
+
+def start_server(args, workers, pool_size):
+    env = dict(
+        os.environ,
+        MONGO_URI=args.mongo_uri,
+        GUNICORN_BIND=f"127.0.0.1:{args.port}",
+        GUNICORN_WORKERS=str(workers),
+        GUNICORN_THREADS=str(args.threads),
+        GUNICORN_ACCESS_LOG="",
+        MONGO_MAX_POOL_SIZE=str(pool_size),
+        MONGO_WARMUP_CONNECTIONS=str(min(pool_size, args.threads)),
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"], cwd=APP_DIR, env=env
+    )
+
+
+def wait_until_ready(base_url, server, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"server exited with status {server.returncode}")
+        try:
+            if requests.get(f"{base_url}/metrics", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"server not ready after {timeout} s")
+
+
+def stop_server(server):
+    server.terminate()
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def print_table(rows):
+    print(f"\n{'workers':>7} {'pool':>6} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for row in rows:
+        result = row["result"]
+        p50 = max(route["p50_ms"] for route in result["routes"].values()) if result["routes"] else 0
+        p99 = max(route["p99_ms"] for route in result["routes"].values()) if result["routes"] else 0
+        print(f"{row['workers']:>7} {row['pool_size']:>6} {result['throughput_rps']:>9} "
+              f"{p50:>8} {p99:>8} {result['errors']:>7}")
+    print("(p50/p99: slowest route)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/bench_sweep")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--server-workers", type=int, action="append", help="gunicorn workers; repeatable")
+    parser.add_argument("--pool-size", type=int, action="append", help="MONGO_MAX_POOL_SIZE; repeatable")
+    parser.add_argument("--threads", type=int, default=8, help="GUNICORN_THREADS per worker")
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="feed-heavy")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per combination")
+    parser.add_argument("--warmup", type=float, default=3, help="unrecorded seconds before each combination")
+    parser.add_argument("--workers", type=int, default=32, help="concurrent client threads")
+    parser.add_argument("--users", type=int, default=GraphConfig.users)
+    parser.add_argument("--seed", type=int, default=GraphConfig.seed)
+    parser.add_argument("--output", help="report path (default: bench/results/sweep-<timestamp>.json)")
+    args = parser.parse_args()
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    combinations = list(itertools.product(args.server_workers or [1, 2, 4], args.pool_size or [10, 100]))
+    config = GraphConfig(users=args.users, seed=args.seed)
+    next_request = workload_requests(args.workload)
+    graph = None
+    rows = []
+    for index, (workers, pool_size) in enumerate(combinations):
+        server = start_server(args, workers, pool_size)
+        try:
+            wait_until_ready(base_url, server)
+            if graph is None:
+                requests.post(f"{base_url}/cleanup").raise_for_status()
+                graph = build_graph(base_url, config)
+            if args.warmup:
+                run(base_url, graph, next_request, args.workers, args.warmup, args.seed)
+            result = summarize(*run(base_url, graph, next_request, args.workers, args.duration, args.seed))
+            rows.append({"workers": workers, "pool_size": pool_size, "result": result})
+            print(f"workers={workers} pool={pool_size}: {result['throughput_rps']} req/s, {result['errors']} errors")
+            if index == len(combinations) - 1:
+                requests.post(f"{base_url}/cleanup").raise_for_status()
+        finally:
+            stop_server(server)
+
+    print_table(rows)
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "workload": args.workload,
+            "client_workers": args.workers,
+            "server_threads": args.threads,
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "graph": asdict(config),
+        },
+        "runs": rows,
+    }
+    output = args.output or os.path.join(
+        BENCH_DIR, "results", f"sweep-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nreport written to {output}")
+    return 1 if any(row["result"]["errors"] for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""Synthetic social graph for benchmarks.
+
+Users follow others with Zipf-weighted popularity, so follower counts follow a
+power law: a few authors have most of the followers. The graph is generated
+from a seed and loaded through the API's bulk endpoints.
+"""
+import random
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import requests
+
+
+@dataclass
+class GraphConfig:
+    users: int = 1000
+    follows_per_user: int = 50
+    zipf_exponent: float = 1.1
+    posts_per_user: float = 5
+    likes_per_post: float = 10
+    comments_per_post: float = 2
+    seed: int = 42
+
+
+@dataclass
+class SocialGraph:
+    config: GraphConfig
+    user_ids: list = field(default_factory=list)
+    # Indexes into user_ids, most popular first
+    popularity: list = field(default_factory=list)
+    following: dict = field(default_factory=dict)
+    post_ids: list = field(default_factory=list)
+    post_authors: dict = field(default_factory=dict)
+    weights: list = field(default_factory=list)
+    viral_post: str = None
+
+    # A user picked by popularity, so well-followed authors come up most often
+    def popular_user(self, rng):
+        return self.user_ids[rng.choices(self.popularity, weights=self.weights, k=1)[0]]
+
+    def random_user(self, rng):
+        return rng.choice(self.user_ids)
+
+    def random_post(self, rng):
+        return rng.choice(self.post_ids)
+
+
+def zipf_weights(count, exponent):
+    return [1 / (rank ** exponent) for rank in range(1, count + 1)]
+
+
+def _poisson(rng, mean):
+    # Knuth's method is fine for the small means used here
+    if mean <= 0:
+        return 0
+    if mean > 30:
+        return max(0, round(rng.gauss(mean, mean ** 0.5)))
+    limit, k, p = pow(2.718281828459045, -mean), 0, 1.0
+    while True:
+        p *= rng.random()
+        if p <= limit:
+            return k
+        k += 1
+
+
+def _post_bulk(session, base_url, kind, items, chunk_size=5000):
+    results = []
+    for start in range(0, len(items), chunk_size):
+        response = session.post(f"{base_url}/bulk/{kind}", json=items[start:start + chunk_size])
+        response.raise_for_status()
+        results.extend(response.json()["results"])
+    failed = [result for result in results if "error" in result]
+    if failed:
+        raise RuntimeError(f"bulk {kind}: {len(failed)} items failed, first: {failed[0]}")
+    return results
+
+
+def build_graph(base_url, config, workers=16):
+    """Generate the graph and load it into the server at base_url."""
+    rng = random.Random(config.seed)
+    session = requests.Session()
+    graph = SocialGraph(config)
+
+    users = [{
+        "firstName": f"User{i}", "lastName": "Bench", "birthDate": "1990-01-01", "bio": "Synthetic user"
+    } for i in range(config.users)]
+    graph.user_ids = [result["userId"] for result in _post_bulk(session, base_url, "users", users)]
+
+    # Popularity rank is a random permutation, so user ids carry no ordering bias
+    graph.popularity = list(range(config.users))
+    rng.shuffle(graph.popularity)
+    graph.weights = weights = zipf_weights(config.users, config.zipf_exponent)
+
+    follows = []
+    for index, user_id in enumerate(graph.user_ids):
+        wanted = min(config.follows_per_user, config.users - 1)
+        targets = set()
+        while len(targets) < wanted:
+            sample = rng.choices(graph.popularity, weights=weights, k=wanted)
+            targets.update(t for t in sample if t != index)
+        targets = list(targets)[:wanted]
+        graph.following[user_id] = [graph.user_ids[t] for t in targets]
+        follows.extend({"userId": user_id, "followId": graph.user_ids[t]} for t in targets)
+    _post_bulk(session, base_url, "follows", follows)
+
+    posts = []
+    for user_id in graph.user_ids:
+        for n in range(_poisson(rng, config.posts_per_user)):
+            posts.append({"authorId": user_id, "content": f"Post {n} by {user_id}"})
+    for post, result in zip(posts, _post_bulk(session, base_url, "posts", posts)):
+        graph.post_ids.append(result["postId"])
+        graph.post_authors[result["postId"]] = post["authorId"]
+
+    likes = []
+    for post_id in graph.post_ids:
+        count = min(_poisson(rng, config.likes_per_post), config.users)
+        likes.extend({"postId": post_id, "userId": user_id} for user_id in rng.sample(graph.user_ids, count))
+    _post_bulk(session, base_url, "likes", likes)
+
+    # There is no bulk comment route, so comments go through the single-item route in parallel
+    comments = [
+        (post_id, {"authorId": graph.random_user(rng), "text": f"Comment {n}"})
+        for post_id in graph.post_ids
+        for n in range(_poisson(rng, config.comments_per_post))
+    ]
+    def add_comment(item):
+        requests.post(f"{base_url}/posts/{item[0]}/comments", json=item[1]).raise_for_status()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(add_comment, comments))
+
+    # The viral post belongs to the most followed author
+    top_author = graph.user_ids[graph.popularity[0]]
+    top_posts = [post_id for post_id, author in graph.post_authors.items() if author == top_author]
+    graph.viral_post = top_posts[0] if top_posts else (graph.post_ids[0] if graph.post_ids else None)
+    return graph
@@ -1,13 +1,78 @@
+import os
+import sys
 import unittest
 import json
+import uuid
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from bson.objectid import ObjectId
 
-BASE_URL = "http://127.0.0.1:5000"
+# The suite runs against a live server at API_BASE_URL, or with TEST_IN_PROCESS=1 against
+# app.create_app() through Flask's test client. Either way the app must run with
+# TEST_DATABASES=on: every test works in a test_* database of its own, named in the
+# X-Test-Database header, and drops it when it is done, so tests can run in parallel
+# (pytest -n auto with pytest-xdist).
+BASE_URL = os.environ.get("API_BASE_URL", "http://127.0.0.1:5000")
+IN_PROCESS = os.environ.get("TEST_IN_PROCESS") == "1"
+
+class LiveClient:
+    def __init__(self, database):
+        self.headers = {"X-Test-Database": database}
+
+    def request(self, method, path, headers=None, **kwargs):
+        return requests.request(method, f"{BASE_URL}{path}", headers={**self.headers, **(headers or {})}, **kwargs)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request("PATCH", path, **kwargs)
+
+# The parts of a requests response the tests use, for a Flask test client response
+class InProcessResponse:
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = response.get_data()
+        self.text = response.get_data(as_text=True)
+        # As a WSGI server does once the body is sent, which records the request's metrics
+        response.close()
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_lines(self):
+        return iter(self.content.splitlines())
+
+class InProcessClient(LiveClient):
+    app = None
+
+    def __init__(self, database):
+        super().__init__(database)
+        if InProcessClient.app is None:
+            sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "app"))
+            import app as app_module
+            InProcessClient.app = app_module.create_app({"TEST_DATABASES": "on"})
+
+    def request(self, method, path, headers=None, params=None, **kwargs):
+        # A client per request, so concurrent tests do not share one
+        response = self.app.test_client().open(
+            path, method=method, headers={**self.headers, **(headers or {})}, query_string=params, **kwargs
+        )
+        return InProcessResponse(response)
 
 class NoSQLAppLiveTestCase(unittest.TestCase):
     def setUp(self):
-        response = requests.post(f"{BASE_URL}/cleanup")
+        database = f"test_{os.getpid()}_{uuid.uuid4().hex[:12]}"
+        self.api = InProcessClient(database) if IN_PROCESS else LiveClient(database)
+
+    def tearDown(self):
+        # Drops the test's database
+        response = self.api.post("/cleanup")
         self.assertEqual(response.status_code, 200)
 
     def create_user(self, firstName="Jonas", lastName="Petraitis", birthDate="1990-01-01", bio="Test bio"):
@@ -17,7 +82,7 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
             "birthDate": birthDate,
             "bio": bio
         }
-        response = requests.post(f"{BASE_URL}/users", json=data)
+        response = self.api.post("/users", json=data)
         return response.json()
 
     def create_post(self, authorId, content="Test post content"):
@@ -25,12 +90,12 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
             "authorId": authorId,
             "content": content
         }
-        response = requests.post(f"{BASE_URL}/posts", json=data)
+        response = self.api.post("/posts", json=data)
         return response.json()
 
     def test_create_user_missing_fields(self):
         data = {"firstName": "Jonas", "lastName": "Petraitis"}
-        response = requests.post(f"{BASE_URL}/users", json=data)
+        response = self.api.post("/users", json=data)
         self.assertEqual(response.status_code, 400)
         res = response.json()
         self.assertIn("error", res)
@@ -42,12 +107,12 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
 
     def test_create_post_missing_fields(self):
         data = {"authorId": str(ObjectId())}
-        response = requests.post(f"{BASE_URL}/posts", json=data)
+        response = self.api.post("/posts", json=data)
         self.assertEqual(response.status_code, 400)
 
     def test_create_post_invalid_authorId(self):
         data = {"authorId": "invalid", "content": "Some content"}
-        response = requests.post(f"{BASE_URL}/posts", json=data)
+        response = self.api.post("/posts", json=data)
         self.assertEqual(response.status_code, 400)
         res = response.json()
         self.assertEqual(res["error"], "Invalid authorId")
@@ -60,7 +125,7 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
 
     def test_add_comment_invalid_postId(self):
         data = {"authorId": str(ObjectId()), "text": "Nice post!"}
-        response = requests.post(f"{BASE_URL}/posts/invalid_id/comments", json=data)
+        response = self.api.post("/posts/invalid_id/comments", json=data)
         self.assertEqual(response.status_code, 400)
         res = response.json()
         self.assertEqual(res["error"], "Invalid postId")
@@ -69,7 +134,7 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
         user = self.create_user("Antanas", "Petraitis", "1995-12-12", "Bio")
         post = self.create_post(user["userId"], "Post content")
         data = {"authorId": "invalid", "text": "Great!"}
-        response = requests.post(f"{BASE_URL}/posts/{post['postId']}/comments", json=data)
+        response = self.api.post(f"/posts/{post['postId']}/comments", json=data)
         self.assertEqual(response.status_code, 400)
         res = response.json()
         self.assertEqual(res["error"], "Invalid authorId")
@@ -79,7 +144,7 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
         post = self.create_post(user["userId"], "Content")
         long_text = "a" * 501
         data = {"authorId": user["userId"], "text": long_text}
-        response = requests.post(f"{BASE_URL}/posts/{post['postId']}/comments", json=data)
+        response = self.api.post(f"/posts/{post['postId']}/comments", json=data)
         self.assertEqual(response.status_code, 400)
         res = response.json()
         self.assertEqual(res["error"], "Comment too long")
@@ -87,7 +152,7 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
     def test_add_comment_post_not_found(self):
         data = {"authorId": str(ObjectId()), "text": "Nice!"}
         fake_post_id = str(ObjectId())
-        response = requests.post(f"{BASE_URL}/posts/{fake_post_id}/comments", json=data)
+        response = self.api.post(f"/posts/{fake_post_id}/comments", json=data)
         self.assertEqual(response.status_code, 404)
         res = response.json()
         self.assertEqual(res["error"], "Post not found")
@@ -96,14 +161,14 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
         user = self.create_user("Mantas", "Jankauskas", "1988-08-08", "Bio")
         post = self.create_post(user["userId"], "Content")
         data = {"authorId": user["userId"], "text": "Interesting post"}
-        response = requests.post(f"{BASE_URL}/posts/{post['postId']}/comments", json=data)
+        response = self.api.post(f"/posts/{post['postId']}/comments", json=data)
         self.assertEqual(response.status_code, 200)
         res = response.json()
         self.assertEqual(res["message"], "Comment added")
 
     def test_add_like_invalid_postId(self):
         data = {"userId": str(ObjectId())}
-        response = requests.post(f"{BASE_URL}/posts/invalid_id/likes", json=data)
+        response = self.api.post("/posts/invalid_id/likes", json=data)
         self.assertEqual(response.status_code, 400)
         res = response.json()
         self.assertEqual(res["error"], "Invalid postId")
@@ -112,14 +177,14 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
         user = self.create_user("Giedre", "Kazlauskiene", "1906-12-09", "Bio")
         post = self.create_post(user["userId"], "Content")
         data = {}
-        response = requests.post(f"{BASE_URL}/posts/{post['postId']}/likes", json=data)
+        response = self.api.post(f"/posts/{post['postId']}/likes", json=data)
         self.assertEqual(response.status_code, 400)
 
     def test_add_like_invalid_userId(self):
         user = self.create_user("Vytautas", "Jonaitis", "1863-07-30", "Bio")
         post = self.create_post(user["userId"], "Content")
         data = {"userId": "invalid"}
-        response = requests.post(f"{BASE_URL}/posts/{post['postId']}/likes", json=data)
+        response = self.api.post(f"/posts/{post['postId']}/likes", json=data)
         self.assertEqual(response.status_code, 400)
         res = response.json()
         self.assertEqual(res["error"], "Invalid userId")
@@ -127,7 +192,7 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
     def test_add_like_post_not_found(self):
         data = {"userId": str(ObjectId())}
         fake_post_id = str(ObjectId())
-        response = requests.post(f"{BASE_URL}/posts/{fake_post_id}/likes", json=data)
+        response = self.api.post(f"/posts/{fake_post_id}/likes", json=data)
         self.assertEqual(response.status_code, 404)
         res = response.json()
         self.assertEqual(res["error"], "Post not found")
@@ -136,16 +201,16 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
         user = self.create_user("Ieva", "Martinkiene", "1999-09-09", "Bio")
         post = self.create_post(user["userId"], "Content")
         data = {"userId": user["userId"]}
-        response1 = requests.post(f"{BASE_URL}/posts/{post['postId']}/likes", json=data)
+        response1 = self.api.post(f"/posts/{post['postId']}/likes", json=data)
         self.assertEqual(response1.status_code, 200)
-        response2 = requests.post(f"{BASE_URL}/posts/{post['postId']}/likes", json=data)
+        response2 = self.api.post(f"/posts/{post['postId']}/likes", json=data)
         self.assertEqual(response2.status_code, 400)
         res = response2.json()
         self.assertEqual(res["error"], "User already liked this post")
 
     def test_follow_user_invalid_userId(self):
         data = {"followId": str(ObjectId())}
-        response = requests.post(f"{BASE_URL}/users/invalid_id/follow", json=data)
+        response = self.api.post("/users/invalid_id/follow", json=data)
         self.assertEqual(response.status_code, 400)
         res = response.json()
         self.assertEqual(res["error"], "Invalid userId")
@@ -153,7 +218,7 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
     def test_follow_user_invalid_followId(self):
         user = self.create_user("Jokubas", "Vaitkus", "1980-01-01", "Bio")
         data = {"followId": "invalid"}
-        response = requests.post(f"{BASE_URL}/users/{user['userId']}/follow", json=data)
+        response = self.api.post(f"/users/{user['userId']}/follow", json=data)
         self.assertEqual(response.status_code, 400)
         res = response.json()
         self.assertEqual(res["error"], "Invalid followId")
@@ -161,30 +226,30 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
     def test_follow_user_not_found(self):
         fake_user_id = str(ObjectId())
         data = {"followId": str(ObjectId())}
-        response = requests.post(f"{BASE_URL}/users/{fake_user_id}/follow", json=data)
+        response = self.api.post(f"/users/{fake_user_id}/follow", json=data)
         self.assertEqual(response.status_code, 404)
 
     def test_follow_user_already_following(self):
         user1 = self.create_user("Karla", "Giedraitiene", "1975-10-05", "Bio")
         user2 = self.create_user("Linas", "Zabiela", "1974-11-11", "Bio")
         data = {"followId": user2["userId"]}
-        resp1 = requests.post(f"{BASE_URL}/users/{user1['userId']}/follow", json=data)
+        resp1 = self.api.post(f"/users/{user1['userId']}/follow", json=data)
         self.assertEqual(resp1.status_code, 200)
-        resp2 = requests.post(f"{BASE_URL}/users/{user1['userId']}/follow", json=data)
+        resp2 = self.api.post(f"/users/{user1['userId']}/follow", json=data)
         self.assertEqual(resp2.status_code, 400)
 
     def test_follow_user_success(self):
         user1 = self.create_user("Milda", "Jankauskaite", "1988-03-03", "Bio")
         user2 = self.create_user("Vincas", "Zabiela", "1985-04-04", "Bio")
         data = {"followId": user2["userId"]}
-        response = requests.post(f"{BASE_URL}/users/{user1['userId']}/follow", json=data)
+        response = self.api.post(f"/users/{user1['userId']}/follow", json=data)
         self.assertEqual(response.status_code, 200)
         res = response.json()
         self.assertEqual(res["message"], "Now following the user")
 
     def test_unfollow_user_invalid_userId(self):
         data = {"unfollowId": str(ObjectId())}
-        response = requests.post(f"{BASE_URL}/users/invalid_id/unfollow", json=data)
+        response = self.api.post("/users/invalid_id/unfollow", json=data)
         self.assertEqual(response.status_code, 400)
         res = response.json()
         self.assertEqual(res["error"], "Invalid userId")
@@ -192,7 +257,7 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
     def test_unfollow_user_invalid_unfollowId(self):
         user = self.create_user("Nora", "Petrauskiene", "1960-02-02", "Bio")
         data = {"unfollowId": "invalid"}
-        response = requests.post(f"{BASE_URL}/users/{user['userId']}/unfollow", json=data)
+        response = self.api.post(f"/users/{user['userId']}/unfollow", json=data)
         self.assertEqual(response.status_code, 400)
         res = response.json()
         self.assertEqual(res["error"], "Invalid unfollowId")
@@ -200,7 +265,7 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
     def test_unfollow_user_not_following(self):
         user = self.create_user("Oskaras", "Bernotas", "1854-10-16", "Bio")
         data = {"unfollowId": str(ObjectId())}
-        response = requests.post(f"{BASE_URL}/users/{user['userId']}/unfollow", json=data)
+        response = self.api.post(f"/users/{user['userId']}/unfollow", json=data)
         self.assertEqual(response.status_code, 400)
         res = response.json()
         self.assertEqual(res["message"], "Not following this user")
@@ -210,21 +275,56 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
         user2 = self.create_user("Dainius", "Zabiela", "1972-05-02", "Bio")
         follow_data = {"followId": user2["userId"]}
         unfollow_data = {"unfollowId": user2["userId"]}
-        requests.post(f"{BASE_URL}/users/{user1['userId']}/follow", json=follow_data)
-        response = requests.post(f"{BASE_URL}/users/{user1['userId']}/unfollow", json=unfollow_data)
+        self.api.post(f"/users/{user1['userId']}/follow", json=follow_data)
+        response = self.api.post(f"/users/{user1['userId']}/unfollow", json=unfollow_data)
         self.assertEqual(response.status_code, 200)
         res = response.json()
         self.assertEqual(res["message"], "Unfollowed the user")
 
+    def test_followers_and_following(self):
+        user1 = self.create_user("Rokas", "Zabiela", "1990-01-01", "Bio")
+        user2 = self.create_user("Saule", "Vaitkute", "1991-01-01", "Bio")
+        user3 = self.create_user("Tomas", "Grigas", "1992-01-01", "Bio")
+        for follower in (user1, user2):
+            self.api.post(f"/users/{follower['userId']}/follow", json={"followId": user3["userId"]})
+        # Repeating a follow changes nothing
+        self.api.post(f"/users/{user1['userId']}/follow", json={"followId": user3["userId"]})
+
+        response = self.api.get(f"/users/{user3['userId']}/followers", params={"limit": 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["X-Total-Count"], "2")
+        first_page = response.json()
+        self.assertEqual(len(first_page), 1)
+        response = self.api.get(f"/users/{user3['userId']}/followers",
+                                params={"limit": 1, "cursor": response.headers["X-Next-Cursor"]})
+        second_page = response.json()
+        self.assertNotIn("X-Next-Cursor", response.headers)
+        self.assertEqual({user["userId"] for user in first_page + second_page}, {user1["userId"], user2["userId"]})
+
+        response = self.api.get(f"/users/{user1['userId']}/following")
+        self.assertEqual(response.headers["X-Total-Count"], "1")
+        self.assertEqual([user["userId"] for user in response.json()], [user3["userId"]])
+
+        self.api.post(f"/users/{user1['userId']}/unfollow", json={"unfollowId": user3["userId"]})
+        response = self.api.get(f"/users/{user3['userId']}/followers")
+        self.assertEqual(response.headers["X-Total-Count"], "1")
+        self.assertEqual([user["userId"] for user in response.json()], [user2["userId"]])
+
+    def test_followers_not_found(self):
+        response = self.api.get(f"/users/{ObjectId()}/followers")
+        self.assertEqual(response.status_code, 404)
+        response = self.api.get("/users/invalid_id/following")
+        self.assertEqual(response.status_code, 400)
+
     def test_get_post_likes_invalid_postId(self):
-        response = requests.get(f"{BASE_URL}/posts/invalid_id/likes")
+        response = self.api.get("/posts/invalid_id/likes")
         self.assertEqual(response.status_code, 400)
         res = response.json()
         self.assertEqual(res["error"], "Invalid postId")
 
     def test_get_post_likes_nonexistent(self):
         fake_post_id = str(ObjectId())
-        response = requests.get(f"{BASE_URL}/posts/{fake_post_id}/likes")
+        response = self.api.get(f"/posts/{fake_post_id}/likes")
         self.assertEqual(response.status_code, 404)
         res = response.json()
         self.assertEqual(res["error"], "Post not found")
@@ -233,13 +333,627 @@ class NoSQLAppLiveTestCase(unittest.TestCase):
         user = self.create_user("Rasa", "Jankauskaite", "1969-05-05", "Bio")
         post = self.create_post(user["userId"], "Content")
         like_data = {"userId": user["userId"]}
-        requests.post(f"{BASE_URL}/posts/{post['postId']}/likes", json=like_data)
-        response = requests.get(f"{BASE_URL}/posts/{post['postId']}/likes")
+        self.api.post(f"/posts/{post['postId']}/likes", json=like_data)
+        response = self.api.get(f"/posts/{post['postId']}/likes")
         self.assertEqual(response.status_code, 200)
         res = response.json()
         self.assertIsInstance(res, list)
         if res:
             self.assertIn("userId", res[0])
 
+    def test_get_feed_invalid_userId(self):
+        response = self.api.get("/users/invalid_id/feed")
+        self.assertEqual(response.status_code, 400)
+        res = response.json()
+        self.assertEqual(res["error"], "Invalid userId")
+
+    def test_get_feed_success(self):
+        reader = self.create_user("Egle", "Vaitkute", "1991-06-06", "Bio")
+        author = self.create_user("Rokas", "Petrauskas", "1989-07-07", "Bio")
+        self.api.post(f"/users/{reader['userId']}/follow", json={"followId": author["userId"]})
+        first = self.create_post(author["userId"], "First")
+        second = self.create_post(author["userId"], "Second")
+        response = self.api.get(f"/users/{reader['userId']}/feed")
+        self.assertEqual(response.status_code, 200)
+        res = response.json()
+        self.assertEqual([post["_id"] for post in res], [second["postId"], first["postId"]])
+        self.assertEqual(res[0]["authorFirstName"], "Rokas")
+        self.assertNotIn("authorDetails", res[0])
+        # Post dates keep their isoformat() strings unless dateFormat=rfc3339 asks for milliseconds
+        self.assertRegex(res[0]["createdAt"], r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d{6})?$")
+        response = self.api.get(f"/users/{reader['userId']}/feed", params={"dateFormat": "rfc3339"})
+        self.assertRegex(response.json()[0]["createdAt"], r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}Z$")
+        response = self.api.get(f"/users/{reader['userId']}/feed", params={"dateFormat": "unix"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "Invalid dateFormat")
+
+    def test_get_feed_backfill_and_unfollow(self):
+        reader = self.create_user("Lina", "Grigaite", "1993-03-03", "Bio")
+        author = self.create_user("Jonas", "Butkus", "1987-08-08", "Bio")
+        post = self.create_post(author["userId"], "Posted before follow")
+        self.api.post(f"/users/{reader['userId']}/follow", json={"followId": author["userId"]})
+        response = self.api.get(f"/users/{reader['userId']}/feed")
+        self.assertEqual([p["_id"] for p in response.json()], [post["postId"]])
+        self.api.post(f"/users/{reader['userId']}/unfollow", json={"unfollowId": author["userId"]})
+        response = self.api.get(f"/users/{reader['userId']}/feed")
+        self.assertEqual(response.json(), [])
+
+    def test_get_feed_cursor_pagination(self):
+        reader = self.create_user("Ruta", "Kazlauskaite", "1994-04-04", "Bio")
+        author = self.create_user("Petras", "Jonaitis", "1986-06-06", "Bio")
+        self.api.post(f"/users/{reader['userId']}/follow", json={"followId": author["userId"]})
+        post_ids = [self.create_post(author["userId"], f"Post {i}")["postId"] for i in range(5)]
+
+        seen = []
+        params = {"limit": 2}
+        while True:
+            response = self.api.get(f"/users/{reader['userId']}/feed", params=params)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(post["_id"] for post in response.json())
+            if "X-Next-Cursor" not in response.headers:
+                break
+            params = {"limit": 2, "cursor": response.headers["X-Next-Cursor"]}
+        self.assertEqual(seen, list(reversed(post_ids)))
+
+        response = self.api.get(f"/users/{reader['userId']}/feed", params={"limit": 2, "page": 2})
+        self.assertEqual([post["_id"] for post in response.json()], seen[2:4])
+
+    def test_get_feed_invalid_cursor(self):
+        reader = self.create_user("Asta", "Butkute", "1990-10-10", "Bio")
+        author = self.create_user("Mindaugas", "Grigas", "1984-04-04", "Bio")
+        self.api.post(f"/users/{reader['userId']}/follow", json={"followId": author["userId"]})
+        response = self.api.get(f"/users/{reader['userId']}/feed", params={"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "Invalid cursor")
+
+    def test_remove_like_success(self):
+        user = self.create_user("Simona", "Petrauskaite", "1996-06-06", "Bio")
+        post = self.create_post(user["userId"], "Content")
+        data = {"userId": user["userId"]}
+        self.api.post(f"/posts/{post['postId']}/likes", json=data)
+        response = self.api.post(f"/posts/{post['postId']}/unlike", json=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["message"], "Like removed")
+        response = self.api.get(f"/posts/{post['postId']}/likes")
+        self.assertEqual(response.json(), [])
+
+    def test_remove_like_not_liked(self):
+        user = self.create_user("Tadas", "Vaitkus", "1983-03-03", "Bio")
+        post = self.create_post(user["userId"], "Content")
+        response = self.api.post(f"/posts/{post['postId']}/unlike", json={"userId": user["userId"]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "User has not liked this post")
+
+    def test_remove_like_post_not_found(self):
+        data = {"userId": str(ObjectId())}
+        response = self.api.post(f"/posts/{ObjectId()}/unlike", json=data)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["error"], "Post not found")
+
+    def test_add_like_concurrent(self):
+        reader = self.create_user("Urte", "Jankauskaite", "1997-07-07", "Bio")
+        author = self.create_user("Vilius", "Kazlauskas", "1982-02-02", "Bio")
+        self.api.post(f"/users/{reader['userId']}/follow", json={"followId": author["userId"]})
+        post = self.create_post(author["userId"], "Viral")
+        likers = [self.create_user(f"User{i}", "Liker", "2000-01-01", "Bio")["userId"] for i in range(20)]
+
+        def like(user_id):
+            return self.api.post(f"/posts/{post['postId']}/likes", json={"userId": user_id}).status_code
+
+        # Every liker fires three times in parallel; exactly one like per user may succeed
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            statuses = list(pool.map(like, likers * 3))
+        self.assertEqual(statuses.count(200), len(likers))
+        self.assertEqual(statuses.count(400), 2 * len(likers))
+
+        response = self.api.get(f"/posts/{post['postId']}/likes")
+        self.assertEqual(len(response.json()), len(likers))
+        feed = self.api.get(f"/users/{reader['userId']}/feed").json()
+        self.assertEqual(feed[0]["likes"], len(likers))
+
+    def test_get_posts_comments_pagination(self):
+        user = self.create_user("Gabija", "Petraitiene", "1998-08-08", "Bio")
+        post = self.create_post(user["userId"], "Content")
+        for i in range(7):
+            data = {"authorId": user["userId"], "text": f"Comment {i}"}
+            self.api.post(f"/posts/{post['postId']}/comments", json=data)
+
+        texts = []
+        params = {"limit": 3}
+        while True:
+            response = self.api.get(f"/posts/{post['postId']}/comments", params=params)
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            self.assertLessEqual(len(page), 3)
+            texts.extend(comment["text"] for comment in page)
+            if "X-Next-Cursor" not in response.headers:
+                break
+            params = {"limit": 3, "cursor": response.headers["X-Next-Cursor"]}
+        self.assertEqual(texts, [f"Comment {i}" for i in range(7)])
+        self.assertEqual(page[0]["authorFirstName"], "Gabija")
+        # HTTP dates by default, RFC 3339 with milliseconds on request
+        self.assertRegex(page[0]["createdAt"], r"^\w{3}, \d{2} \w{3} \d{4} \d{2}:\d{2}:\d{2} GMT$")
+        response = self.api.get(f"/posts/{post['postId']}/comments", params={"dateFormat": "rfc3339"})
+        self.assertRegex(response.json()[0]["createdAt"], r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}Z$")
+
+    def test_get_posts_comments_invalid_cursor(self):
+        user = self.create_user("Kestas", "Butkus", "1981-01-01", "Bio")
+        post = self.create_post(user["userId"], "Content")
+        response = self.api.get(f"/posts/{post['postId']}/comments", params={"cursor": "bad"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "Invalid cursor")
+
+    def test_get_feed_comment_preview(self):
+        reader = self.create_user("Ona", "Grigiene", "1979-09-09", "Bio")
+        author = self.create_user("Saulius", "Vaitkus", "1978-08-08", "Bio")
+        self.api.post(f"/users/{reader['userId']}/follow", json={"followId": author["userId"]})
+        post = self.create_post(author["userId"], "Content")
+        for i in range(5):
+            data = {"authorId": reader["userId"], "text": f"Comment {i}"}
+            self.api.post(f"/posts/{post['postId']}/comments", json=data)
+        feed = self.api.get(f"/users/{reader['userId']}/feed").json()
+        self.assertEqual(feed[0]["commentCount"], 5)
+        self.assertEqual([c["text"] for c in feed[0]["comments"]], ["Comment 2", "Comment 3", "Comment 4"])
+
+    def test_bulk_create_users(self):
+        data = [
+            {"firstName": "Ada", "lastName": "Bulk", "birthDate": "1990-01-01", "bio": "Bio"},
+            {"firstName": "Missing fields"},
+            "not an object"
+        ]
+        response = self.api.post("/bulk/users", json=data)
+        self.assertEqual(response.status_code, 200)
+        res = response.json()
+        self.assertEqual((res["succeeded"], res["failed"]), (1, 2))
+        self.assertEqual(res["results"][0]["status"], 201)
+        self.assertIn("userId", res["results"][0])
+        self.assertEqual(res["results"][1]["error"], "Missing fields")
+        self.assertEqual(res["results"][2]["error"], "Invalid item")
+
+    def test_bulk_create_posts_ndjson(self):
+        user = self.create_user("Bronius", "Bulkus", "1980-01-01", "Bio")
+        lines = [
+            json.dumps({"authorId": user["userId"], "content": "First"}),
+            json.dumps({"authorId": "invalid", "content": "Second"}),
+            json.dumps({"authorId": user["userId"], "content": "Third"})
+        ]
+        response = self.api.post(
+            "/bulk/posts",
+            data="\n".join(lines),
+            headers={"Content-Type": "application/x-ndjson"}
+        )
+        self.assertEqual(response.status_code, 200)
+        res = response.json()
+        self.assertEqual([r["status"] for r in res["results"]], [201, 400, 201])
+        self.assertEqual(res["results"][1]["error"], "Invalid authorId")
+
+    def test_bulk_invalid_body(self):
+        response = self.api.post("/bulk/users", json={"firstName": "Not a list"})
+        self.assertEqual(response.status_code, 400)
+        response = self.api.post(
+            "/bulk/users",
+            data="{not json}",
+            headers={"Content-Type": "application/x-ndjson"}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "Invalid JSON on line 1")
+
+    def test_bulk_follows_and_likes(self):
+        reader = self.create_user("Dalia", "Bulkiene", "1985-05-05", "Bio")
+        author = self.create_user("Edvardas", "Bulkus", "1975-05-05", "Bio")
+        post = self.create_post(author["userId"], "Content")
+
+        follows = [
+            {"userId": reader["userId"], "followId": author["userId"]},
+            {"userId": reader["userId"], "followId": author["userId"]},
+            {"userId": str(ObjectId()), "followId": author["userId"]},
+            {"userId": reader["userId"]}
+        ]
+        res = self.api.post("/bulk/follows", json=follows).json()
+        self.assertEqual([r["status"] for r in res["results"]], [200, 400, 404, 400])
+        self.assertEqual(res["results"][3]["error"], "Invalid followId")
+
+        likes = [
+            {"postId": post["postId"], "userId": reader["userId"]},
+            {"postId": post["postId"], "userId": author["userId"]},
+            {"postId": post["postId"], "userId": reader["userId"]},
+            {"postId": str(ObjectId()), "userId": reader["userId"]},
+            {"postId": post["postId"]}
+        ]
+        res = self.api.post("/bulk/likes", json=likes).json()
+        self.assertEqual([r["status"] for r in res["results"]], [200, 200, 400, 404, 400])
+        self.assertEqual(res["results"][4]["error"], "Missing userId")
+
+        feed = self.api.get(f"/users/{reader['userId']}/feed").json()
+        self.assertEqual(feed[0]["likes"], 2)
+
+    def get_ndjson(self, path, **params):
+        response = self.api.get(path, params=params, headers={"Accept": "application/x-ndjson"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Type"], "application/x-ndjson")
+        return [json.loads(line) for line in response.iter_lines() if line]
+
+    def test_streaming_ndjson_responses(self):
+        reader = self.create_user("Vaida", "Streamaite", "1992-12-12", "Bio")
+        author = self.create_user("Zigmas", "Streamas", "1971-01-01", "Bio")
+        self.api.post(f"/users/{reader['userId']}/follow", json={"followId": author["userId"]})
+        post_ids = [self.create_post(author["userId"], f"Post {i}")["postId"] for i in range(25)]
+        for i in range(4):
+            data = {"authorId": reader["userId"], "text": f"Comment {i}"}
+            self.api.post(f"/posts/{post_ids[0]}/comments", json=data)
+        self.api.post(f"/posts/{post_ids[0]}/likes", json={"userId": reader["userId"]})
+
+        # Without a limit the streamed feed is not cut at one page
+        feed = self.get_ndjson(f"/users/{reader['userId']}/feed")
+        self.assertEqual([post["_id"] for post in feed], list(reversed(post_ids)))
+        self.assertEqual(len(self.get_ndjson(f"/users/{reader['userId']}/feed", limit=5)), 5)
+
+        comments = self.get_ndjson(f"/posts/{post_ids[0]}/comments")
+        self.assertEqual([c["text"] for c in comments], [f"Comment {i}" for i in range(4)])
+        self.assertEqual(len(self.get_ndjson(f"/posts/{post_ids[0]}/comments", limit=2)), 2)
+        response = self.api.get(
+            f"/posts/{post_ids[0]}/comments", params={"limit": -1}, headers={"Accept": "application/x-ndjson"}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "Invalid limit")
+
+        likes = self.get_ndjson(f"/posts/{post_ids[0]}/likes")
+        self.assertEqual(likes, [{"userId": reader["userId"], "firstName": "Vaida", "lastName": "Streamaite"}])
+
+    def feed_requests(self):
+        # The count of successful feed requests the server has recorded so far
+        lines = self.api.get("/metrics").text.splitlines()
+        prefix = 'http_requests_total{method="GET",route="/users/<user_id>/feed",status="200"} '
+        return next((int(line[len(prefix):]) for line in lines if line.startswith(prefix)), 0)
+
+    def test_metrics_endpoint(self):
+        user = self.create_user("Aiste", "Metrikaite", "1990-02-02", "Bio")
+        response = self.api.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+        self.assertIn('http_requests_total{method="POST",route="/users",status="201"}', response.text)
+        self.assertIn('http_request_duration_seconds_bucket{method="POST",route="/users",le="+Inf"}', response.text)
+        # A streamed response is recorded too, once its body is sent
+        before = self.feed_requests()
+        self.get_ndjson(f"/users/{user['userId']}/feed")
+        self.assertGreater(self.feed_requests(), before)
+
+    def assert_not_modified_until(self, path, change):
+        # The route answers 304 to its own ETag until `change` happens, then sends a new one
+        response = self.api.get(path)
+        etag = response.headers["ETag"]
+        cached = self.api.get(path, headers={"If-None-Match": etag})
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.content, b"")
+        change()
+        response = self.api.get(path, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        return response.json()
+
+    def test_conditional_get_likes_and_comments(self):
+        author = self.create_user("Ugne", "Etagaite", "1990-01-01", "Bio")
+        post = self.create_post(author["userId"], "Polled post")
+        likes = self.assert_not_modified_until(
+            f"/posts/{post['postId']}/likes",
+            lambda: self.api.post(f"/posts/{post['postId']}/likes", json={"userId": author["userId"]})
+        )
+        self.assertEqual(len(likes), 1)
+        comments = self.assert_not_modified_until(
+            f"/posts/{post['postId']}/comments",
+            lambda: self.api.post(f"/posts/{post['postId']}/comments",
+                                  json={"authorId": author["userId"], "text": "New"})
+        )
+        self.assertEqual(len(comments), 1)
+
+    def test_conditional_get_feed(self):
+        reader = self.create_user("Vytas", "Etagas", "1990-01-01", "Bio")
+        author = self.create_user("Zita", "Etagaite", "1990-01-01", "Bio")
+        feed_path = f"/users/{reader['userId']}/feed"
+        self.assert_not_modified_until(
+            feed_path,
+            lambda: self.api.post(f"/users/{reader['userId']}/follow", json={"followId": author["userId"]})
+        )
+        posts = self.assert_not_modified_until(feed_path, lambda: self.create_post(author["userId"], "Fresh"))
+        self.assertEqual([p["content"] for p in posts], ["Fresh"])
+        posts = self.assert_not_modified_until(
+            feed_path,
+            lambda: self.api.post(f"/posts/{posts[0]['_id']}/likes", json={"userId": reader["userId"]})
+        )
+        self.assertEqual(posts[0]["likes"], 1)
+
+    def test_write_behind_read_your_writes(self):
+        author = self.create_user("Rasa", "Eilute", "1990-01-01", "Bio")
+        liker = self.create_user("Kestas", "Laukia", "1990-01-01", "Bio")
+        post = self.create_post(author["userId"], "Queued post")
+        likes_url = f"/posts/{post['postId']}/likes"
+        response = self.api.post(likes_url, json={"userId": liker["userId"]})
+        if response.status_code == 200:
+            self.skipTest("server runs with WRITE_BEHIND off")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["message"], "Like accepted")
+        # Queued or applied, a second like by the same user is a duplicate
+        response = self.api.post(likes_url, json={"userId": liker["userId"]})
+        self.assertEqual(response.status_code, 400)
+
+        response = self.api.post(f"/posts/{post['postId']}/comments",
+                                 json={"authorId": liker["userId"], "text": "Queued"})
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["message"], "Comment accepted")
+
+        # X-User-Id applies the reader's queued writes before the read
+        headers = {"X-User-Id": liker["userId"]}
+        likes = self.api.get(likes_url, headers=headers).json()
+        self.assertEqual([like["userId"] for like in likes], [liker["userId"]])
+        comments = self.api.get(f"/posts/{post['postId']}/comments", headers=headers).json()
+        self.assertEqual([comment["text"] for comment in comments], ["Queued"])
+
+        response = self.api.post(f"/posts/{post['postId']}/unlike", json={"userId": liker["userId"]})
+        self.assertEqual(response.status_code, 200)
+
+    def test_search_posts_and_comments(self):
+        author = self.create_user("Sarunas", "Paieska", "1990-01-01", "Bio")
+        other = self.create_user("Dovile", "Paieskaite", "1990-01-01", "Bio")
+        by_author = self.create_post(author["userId"], "Zalgiris won the final")
+        by_other = self.create_post(other["userId"], "Weather is fine today")
+        self.create_post(other["userId"], "Nothing to see")
+        self.api.post(f"/posts/{by_other['postId']}/comments",
+                      json={"authorId": author["userId"], "text": "Zalgiris fans celebrate"})
+
+        response = self.api.get("/search", params={"q": "zalgiris"})
+        self.assertEqual(response.status_code, 200)
+        posts = response.json()
+        self.assertEqual(sorted(p["_id"] for p in posts), sorted([by_author["postId"], by_other["postId"]]))
+        self.assertGreaterEqual(posts[0]["score"], posts[1]["score"])
+        self.assertIn("authorFirstName", posts[0])
+
+        # One post per page, linked by cursors
+        pages = []
+        params = {"q": "zalgiris", "limit": 1}
+        while True:
+            response = self.api.get("/search", params=params)
+            pages += [p["_id"] for p in response.json()]
+            if "X-Next-Cursor" not in response.headers:
+                break
+            params["cursor"] = response.headers["X-Next-Cursor"]
+        self.assertEqual(pages, [p["_id"] for p in posts])
+
+        response = self.api.get("/search", params={"q": "zalgiris", "authorId": author["userId"]})
+        self.assertEqual([p["_id"] for p in response.json()], [by_author["postId"]])
+
+    def test_search_comments_by_post_author(self):
+        # Comments are searched with $text inside a $unionWith sub-pipeline, which the server has to accept
+        author = self.create_user("Vytautas", "Rasytojas", "1990-01-01", "Bio")
+        commenter = self.create_user("Jurate", "Komentatore", "1990-01-01", "Bio")
+        post = self.create_post(author["userId"], "Rungtynes")
+        other_post = self.create_post(commenter["userId"], "Kitas irasas")
+        for target in (post, other_post):
+            self.api.post(f"/posts/{target['postId']}/comments",
+                          json={"authorId": commenter["userId"], "text": "Arena pilna"})
+
+        response = self.api.get("/search", params={"q": "arena"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(p["_id"] for p in response.json()), sorted([post["postId"], other_post["postId"]]))
+        # The filter is on the post's author, not the commenter
+        response = self.api.get("/search", params={"q": "arena", "authorId": author["userId"]})
+        self.assertEqual([p["_id"] for p in response.json()], [post["postId"]])
+
+    def test_search_invalid_params(self):
+        self.assertEqual(self.api.get("/search").json()["error"], "Missing q")
+        response = self.api.get("/search", params={"q": "x", "authorId": "invalid"})
+        self.assertEqual(response.json()["error"], "Invalid authorId")
+        response = self.api.get("/search", params={"q": "x", "cursor": "bad"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "Invalid cursor")
+
+    def test_multi_get_users_and_posts(self):
+        first = self.create_user("Ieva", "Kazlauskiene", "1985-02-02", "Bio")
+        second = self.create_user("Tomas", "Kazlauskas", "1983-03-03", "Bio")
+        post = self.create_post(first["userId"], "Pirmas")
+        missing = str(ObjectId())
+        ids = f"{second['userId']},{missing},{first['userId']},{second['userId']}"
+        response = self.api.get("/users", params={"ids": ids})
+        self.assertEqual(response.status_code, 200)
+        users = response.json()
+        # Request order, duplicates and unknown ids dropped
+        self.assertEqual([user["userId"] for user in users], [second["userId"], first["userId"]])
+        self.assertEqual(users[0]["firstName"], "Tomas")
+        self.assertEqual(users[0]["followerCount"], 0)
+
+        response = self.api.get("/posts", params={"ids": f"{post['postId']},{missing}"})
+        self.assertEqual(response.status_code, 200)
+        posts = response.json()
+        self.assertEqual(len(posts), 1)
+        self.assertEqual(posts[0]["_id"], post["postId"])
+        self.assertEqual(posts[0]["author"], first["userId"])
+        self.assertEqual(posts[0]["content"], "Pirmas")
+
+    def test_multi_get_invalid_ids(self):
+        self.assertEqual(self.api.get("/users").json()["error"], "Missing ids")
+        response = self.api.get("/posts", params={"ids": "invalid"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "Invalid ids")
+        ids = ",".join(str(ObjectId()) for _ in range(101))
+        self.assertEqual(self.api.get("/users", params={"ids": ids}).json()["error"], "Too many ids")
+
+    def test_update_user_refreshes_names(self):
+        user = self.create_user("Rasa", "Jankauskaite", "1969-05-05", "Bio")
+        post = self.create_post(user["userId"], "Content")
+        self.api.post(f"/posts/{post['postId']}/likes", json={"userId": user["userId"]})
+        likes_path = f"/posts/{post['postId']}/likes"
+        # X-User-Id reads the like even if it is still queued (WRITE_BEHIND=on)
+        reader = {"X-User-Id": user["userId"]}
+        response = self.api.get(likes_path, headers=reader)
+        self.assertEqual(response.json()[0]["firstName"], "Rasa")
+        likes_etag = response.headers["ETag"]
+        follower = self.create_user("Jurgis", "Sekejas", "1990-01-01", "Bio")
+        self.api.post(f"/users/{follower['userId']}/follow", json={"followId": user["userId"]})
+        feed_path = f"/users/{follower['userId']}/feed"
+        feed_etag = self.api.get(feed_path).headers["ETag"]
+        # A post the user commented but did not like
+        other = self.create_post(follower["userId"], "Kitas")
+        self.api.post(f"/posts/{other['postId']}/likes", json={"userId": follower["userId"]})
+        self.api.post(f"/posts/{other['postId']}/comments", json={"authorId": user["userId"], "text": "Labas"})
+        other_likes_path, other_comments_path = f"/posts/{other['postId']}/likes", f"/posts/{other['postId']}/comments"
+        other_likes_etag = self.api.get(other_likes_path, headers={"X-User-Id": follower["userId"]}).headers["ETag"]
+        comments_etag = self.api.get(other_comments_path, headers=reader).headers["ETag"]
+
+        response = self.api.patch(f"/users/{user['userId']}", json={"firstName": "Rasele"})
+        self.assertEqual(response.status_code, 200)
+        # Only the lists that show the name change
+        response = self.api.get(other_likes_path, headers={"If-None-Match": other_likes_etag})
+        self.assertEqual(response.status_code, 304)
+        response = self.api.get(other_comments_path, headers={"If-None-Match": comments_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]["authorFirstName"], "Rasele")
+        # Copies cached under the old name are stale
+        response = self.api.get(likes_path, headers={"If-None-Match": likes_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]["firstName"], "Rasele")
+        response = self.api.get(feed_path, headers={"If-None-Match": feed_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()[0]["authorFirstName"], "Rasele")
+        user_record = self.api.get("/users", params={"ids": user["userId"]}).json()[0]
+        self.assertEqual((user_record["firstName"], user_record["lastName"]), ("Rasele", "Jankauskaite"))
+
+        response = self.api.patch(f"/users/{user['userId']}", json={"age": 50})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "No fields to update")
+        response = self.api.patch(f"/users/{ObjectId()}", json={"bio": "x"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_archived_posts_stay_readable(self):
+        if not IN_PROCESS:
+            self.skipTest("archiving needs the app's database handle (TEST_IN_PROCESS=1)")
+        import archive
+        author = self.create_user("Vytautas", "Senas", "1970-01-01", "Bio")
+        reader = self.create_user("Egle", "Skaitytoja", "1995-01-01", "Bio")
+        self.api.post(f"/users/{reader['userId']}/follow", json={"followId": author["userId"]})
+        old = self.create_post(author["userId"], "Senas irasas")
+        self.api.post(f"/posts/{old['postId']}/likes", json={"userId": reader["userId"]})
+        for i in range(3):
+            comment = {"authorId": reader["userId"], "text": f"Komentaras {i}"}
+            self.api.post(f"/posts/{old['postId']}/comments", json=comment)
+        # Archive everything so far, then post something new
+        app = InProcessClient.app
+        db = app.extensions["test_databases"][self.api.headers["X-Test-Database"]].db
+        with app.app_context():
+            self.assertEqual(archive.archive_posts(db, datetime.utcnow() + timedelta(seconds=1), 10, 3), 1)
+        new = self.create_post(author["userId"], "Naujas irasas")
+        self.assertEqual(db.posts.count_documents({}), 1)
+
+        feed_path = f"/users/{reader['userId']}/feed"
+        posts = self.api.get(feed_path).json()
+        self.assertEqual([post["_id"] for post in posts], [new["postId"], old["postId"]])
+        self.assertEqual((posts[1]["likes"], posts[1]["commentCount"]), (1, 3))
+        # The second page comes from the archive, by cursor and by page number
+        response = self.api.get(feed_path, params={"limit": 1})
+        page = self.api.get(feed_path, params={"limit": 1, "cursor": response.headers["X-Next-Cursor"]}).json()
+        self.assertEqual([post["_id"] for post in page], [old["postId"]])
+        page = self.api.get(feed_path, params={"limit": 1, "page": 2}).json()
+        self.assertEqual([post["_id"] for post in page], [old["postId"]])
+
+        likes = self.api.get(f"/posts/{old['postId']}/likes").json()
+        self.assertEqual([like["userId"] for like in likes], [reader["userId"]])
+        comments_path = f"/posts/{old['postId']}/comments"
+        response = self.api.get(comments_path, params={"limit": 2})
+        self.assertEqual([c["text"] for c in response.json()], ["Komentaras 0", "Komentaras 1"])
+        response = self.api.get(comments_path, params={"cursor": response.headers["X-Next-Cursor"]})
+        self.assertEqual([c["text"] for c in response.json()], ["Komentaras 2"])
+        posts = self.api.get("/posts", params={"ids": f"{old['postId']},{new['postId']}"}).json()
+        self.assertEqual([post["_id"] for post in posts], [old["postId"], new["postId"]])
+
+        # Archived posts are read-only
+        response = self.api.post(f"/posts/{old['postId']}/likes", json={"userId": author["userId"]})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["error"], "Post is archived")
+
+    def test_migrate_embedded_comments(self):
+        if not IN_PROCESS:
+            self.skipTest("migrating needs the app's database handle (TEST_IN_PROCESS=1)")
+        import comments
+        author = self.create_user("Ona", "Senoji", "1970-01-01", "Bio")
+        app = InProcessClient.app
+        db = app.extensions["test_databases"][self.api.headers["X-Test-Database"]].db
+        # A post from before comment buckets, commented once since
+        post_id = db.posts.insert_one({
+            "author": ObjectId(author["userId"]), "content": "Senas", "createdAt": datetime.utcnow(), "likes": [],
+            "comments": [{"author": ObjectId(author["userId"]), "text": f"Senas {i}", "createdAt": datetime.utcnow()}
+                         for i in range(3)]
+        }).inserted_id
+        comments_path = f"/posts/{post_id}/comments"
+        self.api.post(comments_path, json={"authorId": author["userId"], "text": "Naujas"})
+        sizes = app.config["COMMENT_BUCKET_SIZE"], app.config["COMMENT_PREVIEW_SIZE"]
+        posts_version = db.users.find_one({"_id": ObjectId(author["userId"])}).get("postsVersion", 0)
+        self.assertEqual(comments.migrate_embedded(db, *sizes), 1)
+        self.assertEqual(comments.migrate_embedded(db, *sizes), 0)
+        # Feeds showing the post's comment preview must not be served from an old ETag
+        self.assertEqual(db.users.find_one({"_id": ObjectId(author["userId"])})["postsVersion"], posts_version + 1)
+
+        texts = []
+        params = {"limit": 3}
+        while True:
+            response = self.api.get(comments_path, params=params)
+            texts += [c["text"] for c in response.json()]
+            if "X-Next-Cursor" not in response.headers:
+                break
+            params["cursor"] = response.headers["X-Next-Cursor"]
+        self.assertEqual(texts, ["Senas 0", "Senas 1", "Senas 2", "Naujas"])
+        post = db.posts.find_one({"_id": post_id})
+        self.assertEqual((post["commentCount"], len(post["commentPreview"])), (4, 3))
+        self.assertNotIn("comments", post)
+        # Rewritten buckets keep the post's author for searches by author
+        self.assertEqual(db.comment_buckets.distinct("author", {"post": post_id}), [ObjectId(author["userId"])])
+
+        # A count ahead of the stored comments does not send a cursor past them
+        db.posts.update_one({"_id": post_id}, {"$inc": {"commentCount": 1}})
+        response = self.api.get(comments_path, params={"cursor": params["cursor"]})
+        self.assertEqual([c["text"] for c in response.json()], ["Naujas"])
+        self.assertNotIn("X-Next-Cursor", response.headers)
+
+    def test_comments_pagination_short_bucket(self):
+        if not IN_PROCESS:
+            self.skipTest("writing buckets needs the app's database handle (TEST_IN_PROCESS=1)")
+        import comments
+        author = self.create_user("Rasa", "Jankiene", "1984-04-04", "Bio")
+        post = self.create_post(author["userId"], "Content")
+        app = InProcessClient.app
+        db = app.extensions["test_databases"][self.api.headers["X-Test-Database"]].db
+        bucket_size = app.config["COMMENT_BUCKET_SIZE"]
+        # A failed write left the first bucket one comment short of the bucket size
+        texts = [f"Comment {i}" for i in range(bucket_size + 1)]
+        chunks = [texts[:bucket_size - 1], texts[bucket_size - 1:]]
+        for seq, chunk in enumerate(chunks):
+            db.comment_buckets.insert_one({"post": ObjectId(post["postId"]), "seq": seq, "count": len(chunk), "comments": [
+                {"author": ObjectId(author["userId"]), "text": text, "createdAt": datetime.utcnow()} for text in chunk
+            ]})
+        db.posts.update_one({"_id": ObjectId(post["postId"])}, {"$set": {"commentCount": bucket_size + 2}})
+
+        read = []
+        params = {"limit": 3}
+        while True:
+            response = self.api.get(f"/posts/{post['postId']}/comments", params=params)
+            read += [c["text"] for c in response.json()]
+            if "X-Next-Cursor" not in response.headers:
+                break
+            params["cursor"] = response.headers["X-Next-Cursor"]
+        self.assertEqual(read, texts)
+        # Buckets from before they stored the post's author get it from the backfill
+        self.assertEqual(comments.backfill_authors(db), 2)
+        self.assertEqual(db.comment_buckets.count_documents({"author": ObjectId(author["userId"])}), 2)
+
+    def test_rate_limit_per_client(self):
+        reader = self.create_user("Lina", "Ribaite", "1990-01-01", "Bio")
+        feed_path = f"/users/{reader['userId']}/feed"
+        for _ in range(100):
+            # A fresh X-User-Id per request does not escape the client's limit
+            response = self.api.get(feed_path, headers={"X-User-Id": str(ObjectId())})
+            if response.status_code != 200:
+                break
+        else:
+            self.skipTest("server runs without RATE_LIMIT_PER_S, or with RATE_LIMIT_TRUST_USER_HEADER=on")
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response.headers["Retry-After"]), 1)
+
 if __name__ == '__main__':
     unittest.main()